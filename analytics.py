@@ -0,0 +1,87 @@
+# Time-bucketed sales and purchase analytics
+#
+# Reads the per-day rollups (sales_daily, purchases_daily) that triggers keep
+# up to date on every sale and purchase, so a year of data is a few thousand
+# small rows at most instead of a scan of the sales table.
+from datetime import date
+
+import database
+
+# SQL for the first day of each bucket, given a 'YYYY-MM-DD' column
+BUCKETS = {
+    "day": "{day}",
+    "week": "date({day}, '-6 days', 'weekday 1')",  # the Monday starting the week
+    "month": "strftime('%Y-%m-01', {day})",
+}
+
+# Grouping key: (SQL expression, needs the products join)
+SALES_GROUPS = {
+    None: ("NULL", False),
+    "product": ("r.product_id", False),
+    "category": ("COALESCE(NULLIF(p.category, ''), 'Sin categoría')", True),
+    "method": ("r.method", False),
+}
+PURCHASE_GROUPS = {key: value for key, value in SALES_GROUPS.items() if key != "method"}
+
+def _day_range(column, since, until):
+    """WHERE clause (or "") and params for since <= column < until."""
+    where, params = [], []
+    if since:
+        where.append(f"{column} >= ?")
+        params.append(since[:10])
+    if until:
+        where.append(f"{column} < ?")
+        params.append(until[:10])
+    return ("WHERE " + " AND ".join(where) if where else ""), params
+
+def _series(table, values, groups, bucket, by, since, until):
+    if bucket not in BUCKETS:
+        raise ValueError(f"Periodo desconocido: {bucket}")
+    if by not in groups:
+        raise ValueError(f"Agrupación desconocida: {by}")
+    key, join = groups[by]
+    start = BUCKETS[bucket].format(day="r.day")
+    where, params = _day_range("r.day", since, until)
+    return database.get_connection().execute(f'''
+        SELECT {start} AS bucket, {key} AS grouping, {values}
+        FROM {table} r {"LEFT JOIN products p ON p.id = r.product_id" if join else ""}
+        {where}
+        GROUP BY bucket, grouping
+        ORDER BY bucket, grouping
+    ''', params).fetchall()
+
+def sales_series(bucket="day", by=None, since=None, until=None):
+    """[(bucket start 'YYYY-MM-DD', key, revenue, units, sales)] ordered by bucket.
+
+    bucket is 'day', 'week' (Monday to Sunday) or 'month'; by is None (one
+    row per bucket, key None), 'product' (key: product id), 'category' or
+    'method'. since/until are dates; until is exclusive.
+    """
+    return _series("sales_daily", "SUM(r.revenue), SUM(r.units), SUM(r.sales_count)",
+                   SALES_GROUPS, bucket, by, since, until)
+
+def purchases_series(bucket="day", by=None, since=None, until=None):
+    """[(bucket start, key, cost, units, purchases)]; like sales_series without 'method'."""
+    return _series("purchases_daily", "SUM(r.cost), SUM(r.units), SUM(r.purchases_count)",
+                   PURCHASE_GROUPS, bucket, by, since, until)
+
+def trend(bucket="month", since=None, until=None):
+    """[(bucket start, revenue, purchase outflow)] for every bucket with either.
+
+    Reads daily_totals (one row per day) rather than the per-product rollups.
+    """
+    if bucket not in BUCKETS:
+        raise ValueError(f"Periodo desconocido: {bucket}")
+    where, params = _day_range("day", since, until)
+    return database.get_connection().execute(f'''
+        SELECT {BUCKETS[bucket].format(day="day")} AS bucket, SUM(sales_total), SUM(purchases_total)
+        FROM daily_totals {where}
+        GROUP BY bucket HAVING SUM(sales_total) != 0 OR SUM(purchases_total) != 0
+        ORDER BY bucket
+    ''', params).fetchall()
+
+def month_start(months_back=0, today=None):
+    """'YYYY-MM-01' of the month `months_back` months before today's."""
+    today = today or date.today()
+    year, month = divmod(today.year * 12 + today.month - 1 - months_back, 12)
+    return f"{year:04d}-{month + 1:02d}-01"
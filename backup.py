@@ -0,0 +1,213 @@
+# Online backups of the database and its yearly archives
+#
+#   python backup.py             (one backup into backups/, keeps the newest KEEP)
+#
+# Copies with the sqlite3 backup API a few pages at a time and sleeps between
+# steps, so a sale being recorded never waits on the copy. Each backup is a
+# folder (backups/20261018_101500_123456/) holding the main file plus its
+# archive files, laid out like the originals so it can be restored by copying
+# it back. Every copy is checked with PRAGMA integrity_check before the
+# folder is published (renamed from .part) and older backups rotated out.
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from datetime import datetime
+
+import database
+import diagnostics
+
+BACKUP_DIR = "backups"
+KEEP = 7                # backup folders kept by rotate()
+PAGES_PER_STEP = 64     # pages copied per backup step (256 KB with 4 KB pages)
+STEP_PAUSE = 0.005      # seconds slept between steps, while writers get the database
+MAX_RESTARTS = 5        # a copy restarted this often by concurrent writes finishes in one step
+
+_FOLDER = re.compile(r"^\d{8}_\d{6}_\d{6}$")
+
+BackupResult = namedtuple("BackupResult", "path files pages bytes seconds mb_per_s restarts")
+
+class BackupError(RuntimeError):
+    pass
+
+class _TooBusy(Exception):
+    pass
+
+def copy_database(source, target, pages=PAGES_PER_STEP, pause=STEP_PAUSE, max_restarts=MAX_RESTARTS):
+    """Copies the SQLite file `source` to `target` online; returns (pages, restarts).
+
+    A write by another connection between two steps makes SQLite restart the
+    copy. After max_restarts of those the rest is done in a single step,
+    which in WAL mode only holds a read snapshot and still doesn't block
+    writers. Raises BackupError if the copy fails PRAGMA integrity_check.
+    """
+    state = {"remaining": None, "total": 0, "restarts": 0}
+
+    def progress(status, remaining, total):
+        if state["remaining"] is not None and remaining >= state["remaining"]:
+            state["restarts"] += 1
+            if state["restarts"] > max_restarts:
+                raise _TooBusy()
+        state["remaining"], state["total"] = remaining, total
+        if remaining and pause:
+            time.sleep(pause)
+
+    src = sqlite3.connect(source, timeout=database.BUSY_TIMEOUT)
+    dst = sqlite3.connect(target)
+    try:
+        try:
+            src.backup(dst, pages=pages, progress=progress)
+        except _TooBusy:
+            src.backup(dst)
+        # The copy keeps the source's WAL setting; a backup is a single self-contained file
+        dst.execute("PRAGMA journal_mode = DELETE")
+        problems = [row[0] for row in dst.execute("PRAGMA integrity_check")]
+        if problems != ["ok"]:
+            raise BackupError(f"Respaldo dañado ({os.path.basename(target)}): {'; '.join(problems[:5])}")
+        page_count = dst.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+    return page_count, state["restarts"]
+
+def _archive_files(source):
+    # Registered archive paths are relative to the main file (see database.archive_year)
+    conn = sqlite3.connect(source, timeout=database.BUSY_TIMEOUT)
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archives'").fetchone():
+            return []
+        return [path for (path,) in conn.execute("SELECT path FROM archives WHERE year > 0 ORDER BY year")]
+    finally:
+        conn.close()
+
+def run_backup(directory=BACKUP_DIR, keep=KEEP, source=None, **options):
+    """Backs up `source` (database.DB_NAME by default) and its archives into a new folder of `directory`.
+
+    options go to copy_database. Returns a BackupResult; the timing is also
+    recorded as "backup" in diagnostics.
+    """
+    source = os.path.abspath(source or database.DB_NAME)
+    folder = os.path.join(directory, datetime.now().strftime("%Y%m%d_%H%M%S_%f"))
+    partial = folder + ".part"
+    os.makedirs(partial)
+    started = time.perf_counter()
+    files, pages, size, restarts = [], 0, 0, 0
+    try:
+        names = [os.path.basename(source)] + _archive_files(source)
+        for name in names:
+            original = os.path.join(os.path.dirname(source), name)
+            if name != names[0] and not os.path.exists(original):
+                continue  # registered but missing: nothing to copy (reads of that year fail already)
+            target = os.path.join(partial, name)
+            copied, restarted = copy_database(original, target, **options)
+            files.append(name)
+            pages += copied
+            restarts += restarted
+            size += os.path.getsize(target)
+        os.replace(partial, folder)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    seconds = time.perf_counter() - started
+    diagnostics.record("backup", seconds * 1000, pages)
+    rotate(directory, keep)
+    return BackupResult(folder, files, pages, size, seconds, size / 1e6 / seconds if seconds else 0.0, restarts)
+
+def get_backups(directory=BACKUP_DIR):
+    """Paths of the finished backup folders in `directory`, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if _FOLDER.match(name)]
+
+def rotate(directory=BACKUP_DIR, keep=KEEP):
+    """Deletes all but the newest `keep` backups, plus leftovers of interrupted ones."""
+    removed = get_backups(directory)[:-keep] if keep else get_backups(directory)
+    removed += [os.path.join(directory, name) for name in os.listdir(directory)
+                if name.endswith(".part") and _FOLDER.match(name[:-5])
+                and time.time() - os.path.getmtime(os.path.join(directory, name)) > 3600]
+    for path in removed:
+        shutil.rmtree(path, ignore_errors=True)
+    return removed
+
+class BackupService:
+    """Runs run_backup on a background thread, every `interval` seconds and on run_now().
+
+    last_result / last_error keep the outcome of the latest run (read them
+    from any thread); nothing is called back, so the Tk app polls them.
+    """
+
+    def __init__(self, interval=None, **options):
+        self.interval = interval
+        self.options = options
+        self.last_result = None
+        self.last_error = None
+        self.running = False
+        self._requests = queue.Queue()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="backup", daemon=True)
+        self._thread.start()
+        return self
+
+    def run_now(self):
+        """Asks for a backup as soon as the current one (if any) is done; returns a Future."""
+        future = Future()
+        self._requests.put(future)
+        self._wake.set()
+        return future
+
+    def stop(self, timeout=None):
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        due = time.monotonic() + self.interval if self.interval else None
+        while True:
+            self._wake.wait(None if due is None else max(0.0, due - time.monotonic()))
+            self._wake.clear()
+            futures = []
+            while not self._requests.empty():
+                futures.append(self._requests.get())
+            if self._stopping:
+                for future in futures:
+                    future.cancel()
+                return
+            if not futures and (due is None or time.monotonic() < due):
+                continue
+            self.running = True
+            try:
+                result = run_backup(**self.options)
+            except Exception as e:
+                self.last_error = e
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                self.last_result, self.last_error = result, None
+                for future in futures:
+                    future.set_result(result)
+            finally:
+                self.running = False
+            if self.interval:
+                due = time.monotonic() + self.interval
+
+def main(argv):
+    directory = argv[0] if argv else BACKUP_DIR
+    result = run_backup(directory)
+    print(f"Respaldo en {result.path}: {', '.join(result.files)}")
+    print(f"{result.bytes / 1e6:.1f} MB en {result.seconds:.2f} s ({result.mb_per_s:.1f} MB/s), "
+          f"{result.restarts} reinicios por escrituras, integridad ok")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
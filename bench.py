@@ -0,0 +1,242 @@
+# Benchmarks for the database.py hot paths on synthetic, gym-sized data
+#
+#   python bench.py                         # default sizes, prints JSON
+#   python bench.py --output new.json --compare old.json
+#
+# The dataset is generated into a temporary database file; afterword.db is never touched.
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import analytics
+import costing
+import database
+import search
+
+DEFAULT_SIZES = {
+    "insumos": 200,
+    "products": 300,
+    "compounds": 150,     # products built from insumos and other compounds
+    "recipe_depth": 3,    # levels of compounds
+    "users": 500,
+    "days": 365 * 2,
+    "sales_per_day": 60,
+    "payments_per_day": 15,
+    "purchases_per_day": 3,
+}
+
+WORDS = ["proteina", "batido", "agua", "barra", "cafe", "whey", "creatina", "avena", "banano", "fresa",
+         "chocolate", "vainilla", "mani", "energia", "gel", "isotonica", "cafeina", "leche", "limon", "mango"]
+NAMES = ["Ana", "Beto", "Camila", "Diego", "Elena", "Felipe", "Gloria", "Hugo", "Isabel", "Juan",
+         "Karen", "Luis", "María", "Nicolás", "Óscar", "Paula", "Ramón", "Sofía", "Tomás", "Valeria"]
+METHODS = ["Efectivo", "Nequi", "Daviplata", "Transferencia"]
+
+def generate(sizes, seed=1):
+    """Fills the current database (see database.configure) with synthetic data; returns ids used by the benchmarks."""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    with database.transaction() as cursor:
+        def insert_products(count, p_type, price):
+            first = cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM products").fetchone()[0]
+            cursor.executemany(
+                "INSERT INTO products (name, price, stock, category, type, unit) VALUES (?, ?, ?, ?, ?, ?)",
+                [(f"{rng.choice(WORDS).title()} {rng.choice(WORDS)} {i}", price(), 10 ** 6,
+                  rng.choice(WORDS), p_type, "ml" if p_type == "INSUMO" else "unid") for i in range(count)])
+            return list(range(first, first + count))
+
+        insumos = insert_products(sizes["insumos"], "INSUMO", lambda: round(rng.uniform(1, 50), 2))
+        products = insert_products(sizes["products"], "PRODUCTO", lambda: rng.randrange(2000, 20000, 500))
+
+        # Each level of compounds uses insumos plus compounds of the previous levels
+        compounds, usable = [], list(insumos)
+        levels = max(1, sizes["recipe_depth"])
+        for level in range(levels):
+            count = sizes["compounds"] // levels + (1 if level < sizes["compounds"] % levels else 0)
+            ids = insert_products(count, "COMPUESTO", lambda: rng.randrange(8000, 30000, 500))
+            cursor.executemany("INSERT INTO recipes (product_id, ingredient_id, quantity) VALUES (?, ?, ?)",
+                               [(pid, ing, rng.randint(1, 50)) for pid in ids
+                                for ing in rng.sample(usable, min(len(usable), rng.randint(2, 5)))])
+            compounds.extend(ids)
+            usable.extend(ids)
+
+        first_user = cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM users").fetchone()[0]
+        cursor.executemany("INSERT INTO users (name, phone, balance) VALUES (?, ?, 0)",
+                           [(f"{rng.choice(NAMES)} {rng.choice(NAMES)} {i}", f"300{i:07d}")
+                            for i in range(sizes["users"])])
+        users = list(range(first_user, first_user + sizes["users"]))
+
+        sellable = products + compounds
+        for day in range(sizes["days"]):
+            date = start + timedelta(days=day)
+            def stamp():
+                return (date + timedelta(seconds=rng.randrange(6 * 3600, 22 * 3600))).strftime("%Y-%m-%d %H:%M:%S")
+            sales = []
+            for _ in range(sizes["sales_per_day"]):
+                quantity = rng.randint(1, 3)
+                user = rng.choice(users) if rng.random() < 0.6 else None
+                sales.append((rng.choice(sellable), user, quantity, quantity * 5000.0, stamp(),
+                              "Cartera" if user else rng.choice(METHODS)))
+            cursor.executemany("INSERT INTO sales (product_id, user_id, quantity, total_price, sale_date, method) VALUES (?, ?, ?, ?, ?, ?)", sales)
+            cursor.executemany("INSERT INTO payments (user_id, amount, method, payment_date) VALUES (?, ?, ?, ?)",
+                               [(rng.choice(users), rng.randrange(5000, 50000, 1000), rng.choice(METHODS), stamp())
+                                for _ in range(sizes["payments_per_day"])])
+            cursor.executemany("INSERT INTO purchases (product_id, quantity, cost_price, purchase_date) VALUES (?, ?, ?, ?)",
+                               [(rng.choice(insumos + products), rng.randint(10, 100), rng.randrange(10000, 200000, 1000), stamp())
+                                for _ in range(sizes["purchases_per_day"])])
+
+        # Balances consistent with the generated ledgers
+        cursor.execute('''
+            UPDATE users SET balance = COALESCE((SELECT total_paid - total_bought FROM user_totals WHERE user_id = users.id), 0)
+        ''')
+        busiest = cursor.execute("SELECT user_id FROM user_totals ORDER BY sales_count DESC LIMIT 1").fetchone()
+    database.get_connection().execute("ANALYZE")
+    return {"insumos": insumos, "products": products, "compounds": compounds, "users": users,
+            "busiest_user": busiest[0] if busiest else users[0], "deepest": compounds[-1] if compounds else products[0]}
+
+def timed(fn, repeat):
+    """Runs fn `repeat` times; returns timing stats in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return {"runs": repeat, "min_ms": round(min(samples), 3), "median_ms": round(statistics.median(samples), 3),
+            "mean_ms": round(statistics.fmean(samples), 3), "max_ms": round(max(samples), 3)}
+
+def benchmarks(ids):
+    """(name, callable, repeat factor) for every measured path."""
+    rng = random.Random(2)
+    deepest, user = ids["deepest"], ids["busiest_user"]
+    cart = [(pid, 1, 5000.0) for pid in rng.sample(ids["products"] + ids["compounds"], 5)]
+    catalog = search.product_catalog()
+
+    def cold_catalog():
+        search.product_catalog().sync()
+
+    def cold_flattened_recipe():
+        database._bom_cache.clear()
+        database.get_flattened_recipe(deepest)
+
+    def cold_table(read):
+        def run():
+            database._table_cache.clear()
+            read()
+        return run
+
+    def cold_costs():
+        costing.CostEngine().margins()
+
+    def last_month():
+        return list(database.iter_combined_history(since="2025-12-01", until="2026-01-01"))
+
+    return [
+        ("record_sale_compound", lambda: database.record_sale(deepest, 1, 5000.0, user), 1.0),
+        ("record_sale_cash", lambda: database.record_sale(ids["products"][0], 1, 5000.0, None), 1.0),
+        ("record_sales_batch_5", lambda: database.record_sales_batch(cart, user), 1.0),
+        ("get_flattened_recipe_cold", cold_flattened_recipe, 1.0),
+        ("cost_rollup_cold", cold_costs, 0.5),
+        ("get_combined_history_full", database.get_combined_history, 0.2),
+        ("get_combined_history_page", lambda: database.get_combined_history_page(None, 200), 1.0),
+        ("get_combined_history_month", last_month, 1.0),
+        ("get_sales_history_full", database.get_sales_history, 0.2),
+        ("get_financial_summary", database.get_financial_summary, 1.0),
+        ("analytics_12_months_by_category", lambda: analytics.sales_series("month", "category", "2025-01-01", "2026-01-01"), 1.0),
+        ("analytics_trend_weekly", lambda: analytics.trend("week"), 1.0),
+        ("get_user_financial_history", lambda: database.get_user_financial_history(user), 1.0),
+        ("get_user_financial_history_page", lambda: database.get_user_financial_history_page(user, None, 200), 1.0),
+        ("get_products_cached", database.get_products, 1.0),
+        ("get_products_cold", cold_table(database.get_products), 0.5),
+        ("get_sale_items_cold", cold_table(database.get_sale_items), 0.5),
+        ("get_products_page_filtered", lambda: database.get_products_page(None, 200, "bat"), 1.0),
+        ("search_catalog_build", cold_catalog, 0.2),
+        ("search_prefix", lambda: catalog.search("pro"), 1.0),
+        ("search_substring", lambda: catalog.search("tina"), 1.0),
+        ("search_multi_word", lambda: catalog.search("batido fresa"), 1.0),
+        ("search_no_match", lambda: catalog.search("zzzz"), 1.0),
+    ]
+
+def run(sizes=None, repeat=20, only=None, seed=1):
+    """Generates a temp dataset and returns the JSON-ready report."""
+    sizes = {**DEFAULT_SIZES, **(sizes or {})}
+    previous = database.DB_NAME
+    fd, path = tempfile.mkstemp(suffix=".db", prefix="afterword-bench-")
+    os.close(fd)
+    try:
+        database.configure(path)
+        database.init_db()
+        started = time.perf_counter()
+        ids = generate(sizes, seed)
+        generate_s = time.perf_counter() - started
+
+        results = {}
+        for name, fn, factor in benchmarks(ids):
+            if only and not any(part in name for part in only):
+                continue
+            fn()  # warm-up (connections, caches, first page loads)
+            results[name] = timed(fn, max(1, int(repeat * factor)))
+
+        counts = {table: database.get_connection().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                  for table in ("products", "recipes", "users", "sales", "payments", "purchases")}
+    finally:
+        database.configure(previous)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "schema_version": database.SCHEMA_VERSION,
+            "sizes": sizes,
+            "rows": counts,
+            "generate_s": round(generate_s, 2),
+        },
+        "results": results,
+    }
+
+def compare(report, baseline):
+    """Lines like 'name  12.1 ms -> 10.3 ms  (0.85x)' for benchmarks present in both reports."""
+    lines = []
+    for name, new in report["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if old:
+            ratio = new["median_ms"] / old["median_ms"] if old["median_ms"] else float("inf")
+            flag = "  <-- slower" if ratio > 1.2 else ""
+            lines.append(f"{name:34} {old['median_ms']:10.3f} ms -> {new['median_ms']:10.3f} ms  ({ratio:.2f}x){flag}")
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks database.py on a synthetic dataset")
+    for key, value in DEFAULT_SIZES.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=int, default=value)
+    parser.add_argument("--repeat", type=int, default=20, help="runs per benchmark")
+    parser.add_argument("--only", nargs="*", help="run benchmarks whose name contains any of these")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="previous JSON report to compare medians against")
+    args = parser.parse_args()
+
+    sizes = {key: getattr(args, key) for key in DEFAULT_SIZES}
+    report = run(sizes, args.repeat, args.only, args.seed)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print("\n".join(compare(report, json.load(f))))
+
+if __name__ == "__main__":
+    main()
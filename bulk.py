@@ -0,0 +1,309 @@
+# Bulk import / export for products, users, recipes and the money ledgers
+#
+#   python bulk.py import products lista_proveedor.csv
+#   python bulk.py import-web respaldo_localstorage.json
+#   python bulk.py export sales ventas.csv
+#   python bulk.py archive 2024      (moves a closed year to its archive file)
+#
+# Rows are streamed in chunks of executemany inside one transaction per
+# import, so a bad row rolls the whole file back and memory use does not grow
+# with the file. Exports stream the table with keyset queries.
+import csv
+import json
+import sqlite3
+import sys
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from itertools import chain, groupby, islice
+
+import database
+import events
+
+# Importable tables and their columns, in export order
+TABLES = {
+    "products": ("id", "name", "price", "stock", "category", "type", "unit"),
+    "users": ("id", "name", "phone", "balance"),
+    "recipes": ("id", "product_id", "ingredient_id", "quantity"),
+    "sales": ("id", "product_id", "user_id", "quantity", "total_price", "sale_date", "method"),
+    "payments": ("id", "user_id", "amount", "method", "payment_date"),
+    "purchases": ("id", "product_id", "quantity", "cost_price", "purchase_date"),
+}
+# Catalog rows with a known id are updated (e.g. a new supplier price list); ledger rows are only ever added
+UPSERT_TABLES = {"products", "users"}
+CHUNK_SIZE = 5000
+
+class BulkImportError(ValueError):
+    """A file that can't be imported; nothing from it was written."""
+
+@contextmanager
+def _open(file, mode):
+    """Accepts a path or an already open text file."""
+    if isinstance(file, (str, bytes)) or hasattr(file, "__fspath__"):
+        with open(file, mode, encoding="utf-8", newline="") as f:
+            yield f
+    else:
+        yield file
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+@contextmanager
+def _deferred_maintenance(cursor, tables):
+    """Drops the indexes and triggers of `tables` and recreates them on exit.
+
+    Inserting into indexed, trigger-maintained tables costs a B-tree update
+    and an aggregate UPSERT per row; building the indexes once at the end and
+    recomputing the running totals in one pass is much cheaper for big loads.
+    Runs inside the import transaction, so a failure restores everything.
+    """
+    marks = ",".join("?" * len(tables))
+    saved = cursor.execute(f'''
+        SELECT type, name, sql FROM sqlite_master
+        WHERE type IN ('index', 'trigger') AND tbl_name IN ({marks}) AND sql IS NOT NULL
+    ''', list(tables)).fetchall()
+    for kind, name, _ in saved:
+        cursor.execute(f"DROP {kind.upper()} {name}")
+    yield
+    try:
+        for _, _, sql in saved:
+            cursor.execute(sql)
+        # The triggers that were dropped maintain these
+        database.rebuild_aggregates()
+        cursor.execute("UPDATE change_counters SET value = value + 1")
+    except sqlite3.Error as e:
+        raise BulkImportError(f"Los datos importados no permiten rehacer índices y totales: {e}") from e
+
+def _foreign_key_violations(cursor, tables):
+    """{(table, rowid, parent)} for every dangling reference, one pass per table."""
+    return {(table, rowid, parent) for table in tables
+            for _, rowid, parent, _ in cursor.execute(f"PRAGMA foreign_key_check({table})")}
+
+def _check_foreign_keys(cursor, tables, known):
+    """Fails on references the import added; `known` ones (e.g. sales of deleted products) predate it."""
+    problems = [f"{table} fila {rowid} -> {parent}"
+                for table, rowid, parent in sorted(_foreign_key_violations(cursor, tables) - known)]
+    if problems:
+        more = f" (y {len(problems) - 5} más)" if len(problems) > 5 else ""
+        raise BulkImportError(f"Referencias inválidas: {', '.join(problems[:5])}{more}")
+
+def _insert_sql(table, columns):
+    if not columns:
+        return f"INSERT INTO {table} DEFAULT VALUES"
+    names = ", ".join(columns)
+    sql = f"INSERT INTO {table} ({names}) VALUES ({', '.join('?' * len(columns))})"
+    if table in UPSERT_TABLES and "id" in columns:
+        updates = ", ".join(f"{c} = excluded.{c}" for c in columns if c != "id")
+        sql += f" ON CONFLICT(id) DO UPDATE SET {updates}" if updates else " ON CONFLICT(id) DO NOTHING"
+    return sql
+
+def _load(cursor, table, rows, chunk_size):
+    """Inserts an iterable of dicts; the first row decides the columns. Returns the row count."""
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return 0
+    columns = [c for c in first if c in TABLES[table]]
+    unknown = set(first) - set(TABLES[table])
+    if unknown:
+        raise BulkImportError(f"Columnas desconocidas para {table}: {', '.join(sorted(unknown))}")
+
+    def present(row):
+        # Empty cells ('' in CSV, null in JSON) are left out of the INSERT so the column's
+        # default applies (e.g. CURRENT_TIMESTAMP for a date); an upsert keeps the stored value
+        return tuple(c for c in columns if row.get(c) not in ("", None))
+
+    count = 0
+    for chunk in _chunks(chain([first], rows), chunk_size):
+        # One executemany per run of rows filling the same columns, in file order
+        for names, run in groupby(chunk, key=present):
+            run = list(run)
+            try:
+                cursor.executemany(_insert_sql(table, names), [tuple(row[c] for c in names) for row in run])
+            except sqlite3.Error as e:
+                raise BulkImportError(f"Filas {count + 1}-{count + len(run)} de {table}: {e}") from e
+            count += len(run)
+    return count
+
+def import_rows(sources, chunk_size=CHUNK_SIZE, defer=None):
+    """Imports {table: iterable of row dicts} in one transaction; returns {table: rows imported}.
+
+    Tables load in TABLES order so references resolve, then foreign keys are
+    checked for all of them at once. defer=None drops and rebuilds the
+    indexes/triggers only when every target table starts empty (a first
+    load); pass True/False to force it.
+    """
+    tables = [t for t in TABLES if t in sources]
+    unknown = set(sources) - set(TABLES)
+    if unknown:
+        raise BulkImportError(f"Tablas desconocidas: {', '.join(sorted(unknown))}")
+
+    with database.transaction(immediate=True) as cursor:
+        if defer is None:
+            defer = all(cursor.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {t})").fetchone()[0] for t in tables)
+        known = _foreign_key_violations(cursor, tables)
+        counts = {}
+        with _deferred_maintenance(cursor, tables) if defer else nullcontext():
+            for table in tables:
+                counts[table] = _load(cursor, table, sources[table], chunk_size)
+        _check_foreign_keys(cursor, tables, known)
+        if "products" in tables:
+            database.reconcile_stock("IMPORTACION")  # journal the stock the file brought in
+        database._emit(events.TablesImported(tuple(tables)))  # published after the commit
+    return counts
+
+def import_csv(table, file, **kwargs):
+    """Imports a CSV with a header row of column names (see TABLES).
+
+    Missing columns and empty cells get the column's default in a new row
+    and keep the stored value of a product/user updated by id (a column
+    without a default, such as stock, still needs a value).
+    """
+    with _open(file, "r") as f:
+        return import_rows({table: csv.DictReader(f)}, **kwargs)[table]
+
+def import_jsonl(table, file, **kwargs):
+    """Imports JSON Lines: one object per line, streamed."""
+    with _open(file, "r") as f:
+        return import_rows({table: (json.loads(line) for line in f if line.strip())}, **kwargs)[table]
+
+# The web-port keeps its state in localStorage (web-port/src/context/StoreContext.jsx)
+WEB_TYPES = {"PRODUCTO SIMPLE": "PRODUCTO", "PRODUCTO COMPUESTO": "COMPUESTO"}
+DESKTOP_TYPES = {v: k for k, v in WEB_TYPES.items()}
+
+def _web_date(value):
+    """ISO timestamps ('2026-01-31T15:04:05.123Z') -> SQLite's 'YYYY-MM-DD HH:MM:SS' (UTC, like CURRENT_TIMESTAMP)."""
+    if not value:
+        return None
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc)
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+WEB_KEYS = {
+    "products": lambda p: {"id": p["id"], "name": p["name"], "price": p.get("price", 0), "stock": p.get("stock", 0),
+                           "category": p.get("category", ""), "type": WEB_TYPES.get(p.get("type"), p.get("type", "PRODUCTO")),
+                           "unit": p.get("unit", "unid")},
+    # The web app keeps debt as a positive balance; here debt is negative
+    "users": lambda u: {"id": u["id"], "name": u["name"], "phone": u.get("phone", ""), "balance": -(u.get("balance") or 0)},
+    "recipes": lambda r: {"id": r["id"], "product_id": r["productId"], "ingredient_id": r["ingredientId"],
+                          "quantity": r["quantity"]},
+    "sales": lambda s: {"id": s["id"], "product_id": s["productId"], "user_id": s.get("userId"),
+                        "quantity": s["quantity"], "total_price": s["totalPrice"], "sale_date": _web_date(s.get("saleDate")),
+                        "method": s.get("method") or "Efectivo"},
+    "payments": lambda p: {"id": p["id"], "user_id": p["userId"], "amount": p["amount"], "method": p.get("method", "Efectivo"),
+                           "payment_date": _web_date(p.get("paymentDate"))},
+    "purchases": lambda p: {"id": p["id"], "product_id": p["productId"], "quantity": p["quantity"],
+                            "cost_price": p["costPrice"], "purchase_date": _web_date(p.get("date"))},
+}
+
+def import_web_backup(file, **kwargs):
+    """Imports a dump of the web-port's localStorage: {"products": [...], "users": [...], ...}.
+
+    Ids are kept, so references between the keys stay valid. The dump is
+    parsed whole: localStorage is capped at a few MB, unlike the CSV/JSONL paths.
+    """
+    with _open(file, "r") as f:
+        data = json.load(f)
+    sources = {key: map(convert, data[key]) for key, convert in WEB_KEYS.items() if data.get(key)}
+    return import_rows(sources, **kwargs)
+
+def iter_table(table, chunk_size=CHUNK_SIZE):
+    """Streams a table as dicts in id order, one keyset query per chunk."""
+    columns = TABLES[table]
+    conn = database.get_connection()
+    after = -2 ** 63
+    while True:
+        rows = conn.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                            (after, chunk_size)).fetchall()
+        for row in rows:
+            yield dict(zip(columns, row))
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1][0]
+
+def export_csv(table, file):
+    """Writes a table as CSV (header + rows); returns the row count."""
+    count = 0
+    with _open(file, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=TABLES[table])
+        writer.writeheader()
+        for row in iter_table(table):
+            writer.writerow(row)
+            count += 1
+    return count
+
+def export_jsonl(table, file):
+    count = 0
+    with _open(file, "w") as f:
+        for row in iter_table(table):
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+def _web_rows(key):
+    for row in iter_table(key):
+        if key == "products":
+            row["type"] = DESKTOP_TYPES.get(row["type"], row["type"])
+            yield row
+        elif key == "users":
+            yield {"id": row["id"], "name": row["name"], "phone": row["phone"], "balance": -(row["balance"] or 0)}
+        elif key == "recipes":
+            yield {"id": row["id"], "productId": row["product_id"], "ingredientId": row["ingredient_id"], "quantity": row["quantity"]}
+        elif key == "sales":
+            yield {"id": row["id"], "productId": row["product_id"], "quantity": row["quantity"], "totalPrice": row["total_price"],
+                   "userId": row["user_id"], "method": row["method"], "saleDate": _iso(row["sale_date"])}
+        elif key == "payments":
+            yield {"id": row["id"], "userId": row["user_id"], "amount": row["amount"], "method": row["method"],
+                   "paymentDate": _iso(row["payment_date"])}
+        elif key == "purchases":
+            yield {"id": row["id"], "productId": row["product_id"], "quantity": row["quantity"],
+                   "costPrice": row["cost_price"], "date": _iso(row["purchase_date"])}
+
+def _iso(value):
+    return value.replace(" ", "T") + ".000Z" if value else None
+
+def export_web_backup(file):
+    """Writes every table in the web-port's localStorage layout, streaming each array."""
+    with _open(file, "w") as f:
+        f.write("{")
+        for index, key in enumerate(WEB_KEYS):
+            f.write(("," if index else "") + f"\n  {json.dumps(key)}: [")
+            for n, row in enumerate(_web_rows(key)):
+                f.write(("," if n else "") + "\n    " + json.dumps(row, ensure_ascii=False))
+            f.write("\n  ]")
+        f.write("\n}\n")
+
+def main(argv):
+    usage = ("uso: python bulk.py import <tabla> <archivo.csv|.jsonl>\n"
+             "     python bulk.py import-web <respaldo.json>\n"
+             "     python bulk.py export <tabla> <archivo.csv|.jsonl>\n"
+             "     python bulk.py export-web <respaldo.json>\n"
+             "     python bulk.py archive <año>")
+    database.init_db()
+    if len(argv) == 3 and argv[0] == "import":
+        load = import_jsonl if argv[2].endswith(".jsonl") else import_csv
+        print(f"{argv[1]}: {load(argv[1], argv[2])} filas importadas")
+    elif len(argv) == 2 and argv[0] == "import-web":
+        for table, count in import_web_backup(argv[1]).items():
+            print(f"{table}: {count} filas importadas")
+    elif len(argv) == 3 and argv[0] == "export":
+        dump = export_jsonl if argv[2].endswith(".jsonl") else export_csv
+        print(f"{argv[1]}: {dump(argv[1], argv[2])} filas exportadas")
+    elif len(argv) == 2 and argv[0] == "export-web":
+        export_web_backup(argv[1])
+        print(f"Respaldo escrito en {argv[1]}")
+    elif len(argv) == 2 and argv[0] == "archive" and argv[1].isdigit():
+        for table, count in database.archive_year(int(argv[1])).items():
+            print(f"{table}: {count} filas archivadas en {database.archive_path(argv[1])}")
+    else:
+        print(usage)
+        return 2
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
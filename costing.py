@@ -0,0 +1,132 @@
+# Rolled-up unit costs and margins from the recipes
+from collections import deque
+import threading
+
+import database
+
+SELLABLE = ("PRODUCTO", "COMPUESTO")
+
+class CostEngine:
+    """Unit cost of every product, rolled up through its recipe.
+
+    A product with a recipe costs the sum of quantity * cost of each
+    ingredient (compounds of compounds included). Products without one are
+    leaves: an INSUMO costs its price (the unit cost kept by the purchase
+    window), a PRODUCTO the unit cost of its last purchase. A cost is None
+    when some leaf under it has no known cost.
+
+    Costs are memoized. sync() re-reads the inputs only when the 'recipes' or
+    'costs' change counter moved, and then recomputes just the products whose
+    price or recipe changed plus everything that uses them, in topological
+    order (ingredients before the products made from them).
+    """
+
+    def __init__(self, load_products=None, load_edges=None, version=None):
+        self.load_products = load_products or database.get_cost_inputs
+        self.load_edges = load_edges or database.get_recipe_edges
+        self.version = version or (lambda: tuple(database.get_change_counters().get(n, 0) for n in ("recipes", "costs")))
+        self._lock = threading.RLock()  # the DB worker thread and the Tk thread may both ask
+        self.synced_version = None
+        self.products = {}     # id -> (name, type, sale price)
+        self.leaf_costs = {}   # id -> unit cost when it has no recipe (or None)
+        self.edges = {}        # id -> ((ingredient_id, quantity), ...)
+        self.parents = {}      # ingredient_id -> {ids of the products using it}
+        self.costs = {}        # id -> rolled-up unit cost (or None)
+        self.last_recomputed = set()
+
+    def sync(self):
+        with self._lock:
+            version = self.version()
+            if version == self.synced_version:
+                return
+            products, leaf_costs = {}, {}
+            for pid, name, p_type, price, last_cost in self.load_products():
+                products[pid] = (name, p_type, price)
+                leaf_costs[pid] = price if p_type == "INSUMO" else last_cost
+            edges = {}
+            for pid, ingredient, quantity in self.load_edges():
+                edges.setdefault(pid, []).append((ingredient, quantity))
+            edges = {pid: tuple(sorted(items)) for pid, items in edges.items()}
+
+            if self.synced_version is None:
+                dirty = set(products)
+            else:
+                dirty = {pid for pid in products.keys() | self.products.keys()
+                         if leaf_costs.get(pid) != self.leaf_costs.get(pid) or edges.get(pid) != self.edges.get(pid)}
+            self.products, self.leaf_costs, self.edges = products, leaf_costs, edges
+            self.parents = {}
+            for pid, items in edges.items():
+                for ingredient, _ in items:
+                    self.parents.setdefault(ingredient, set()).add(pid)
+            for pid in [pid for pid in self.costs if pid not in products]:
+                del self.costs[pid]
+            self._recompute(dirty)
+            self.synced_version = version
+
+    def _recompute(self, dirty):
+        # Everything that (indirectly) uses a dirty product has to be redone too
+        affected, queue = set(dirty), deque(dirty)
+        while queue:
+            for parent in self.parents.get(queue.popleft(), ()):
+                if parent not in affected:
+                    affected.add(parent)
+                    queue.append(parent)
+        affected &= self.products.keys()
+
+        # Kahn's algorithm over the affected part: a product is ready once its affected ingredients are
+        waiting = {pid: sum(1 for ingredient, _ in self.edges.get(pid, ()) if ingredient in affected) for pid in affected}
+        ready = deque(pid for pid, count in waiting.items() if count == 0)
+        done = set()
+        while ready:
+            pid = ready.popleft()
+            done.add(pid)
+            self.costs[pid] = self._cost_of(pid)
+            for parent in self.parents.get(pid, ()):
+                if parent in waiting:
+                    waiting[parent] -= 1
+                    if waiting[parent] == 0:
+                        ready.append(parent)
+        for pid in affected - done:
+            self.costs[pid] = None  # part of a recipe cycle (add_recipe_item refuses them, old data may not)
+        self.last_recomputed = affected
+
+    def _cost_of(self, pid):
+        items = self.edges.get(pid)
+        if not items:
+            return self.leaf_costs.get(pid)
+        total = 0.0
+        for ingredient, quantity in items:
+            cost = self.costs.get(ingredient)
+            if cost is None:
+                return None
+            total += quantity * cost
+        return total
+
+    def cost(self, product_id):
+        with self._lock:
+            self.sync()
+            return self.costs.get(product_id)
+
+    def all_costs(self):
+        with self._lock:
+            self.sync()
+            return dict(self.costs)
+
+    def margins(self):
+        """(id, name, sale price, unit cost, margin, margin %) for every sellable product.
+
+        Lowest margin % first; products with an unknown cost (cost, margin and
+        margin % None) go last.
+        """
+        with self._lock:
+            self.sync()
+            rows = []
+            for pid, (name, p_type, price) in self.products.items():
+                if p_type not in SELLABLE:
+                    continue
+                cost = self.costs.get(pid)
+                margin = price - cost if cost is not None else None
+                percent = margin / price * 100 if margin is not None and price else None
+                rows.append((pid, name, price, cost, margin, percent))
+        rows.sort(key=lambda r: (r[5] is None, r[5] if r[5] is not None else 0, r[1]))
+        return rows
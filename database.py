@@ -1,14 +1,443 @@
 import sqlite3
+import inspect
 import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import diagnostics
+import events
 
 DB_NAME = "afterword.db"
 
-def connect_db():
-    return sqlite3.connect(DB_NAME)
+# Connection tuning. Applied to every connection opened by connect_db();
+# change with configure() before the first query (or call close_connections()).
+PRAGMAS = {
+    "journal_mode": "WAL",      # readers don't block the writer (and vice versa)
+    "synchronous": "NORMAL",    # safe with WAL, avoids an fsync per commit
+    "cache_size": -16000,       # negative = KiB, ~16 MB page cache per connection
+    "mmap_size": 64 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+BUSY_TIMEOUT = 5.0  # seconds to wait on a locked database before failing
+WRITE_RETRIES = 3   # attempts for a write that still finds the database locked after BUSY_TIMEOUT
+RETRY_DELAY = 0.25  # seconds before the first retry, doubled on each one
+SNAPSHOT_EVERY = 5000  # stock movements after which a snapshot is taken even within the same day
+
+# Typed rows: namedtuples keep the positional access (p[1]) older code relies on
+# and add names (p.name). Queries list their columns, so a migration adding a
+# column to a table doesn't shift what the screens get.
+Product = namedtuple("Product", "id name price stock category type unit")
+User = namedtuple("User", "id name phone balance")
+SaleItem = namedtuple("SaleItem", "id name price stock type")  # what the sales screen needs of a product
+PRODUCT_COLUMNS = ", ".join(Product._fields)
+USER_COLUMNS = ", ".join(User._fields)
+
+_local = threading.local()
+_bom_cache = {}  # product_id -> flattened recipe, see get_flattened_recipe()
+_bom_lock = threading.Lock()  # the DB worker, the Tk thread and API threads all use _bom_cache
+_table_cache = {}  # cache name -> (version, rows), see _cached()
+_cache_stats = {}  # change counter name -> {"hits": n, "misses": n}
+_cache_lock = threading.Lock()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0  # bumped by close_connections(); a thread holding an older connection reopens
+
+def connect_db(db_name=None):
+    """Opens a new, tuned connection. Most code should use get_connection()."""
+    conn = sqlite3.connect(db_name or DB_NAME, timeout=BUSY_TIMEOUT,
+                           isolation_level=None, check_same_thread=False)
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    if diagnostics.TRACE_SQL:
+        conn.set_trace_callback(diagnostics.trace_statement)  # statements in the slow-query log
+    return conn
+
+def get_connection():
+    """Returns the long-lived connection of the calling thread, opening it on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.db_name != DB_NAME or _local.generation != _generation:
+        conn = connect_db()
+        with _connections_lock:
+            _connections.append(conn)
+            _local.conn, _local.db_name, _local.generation = conn, DB_NAME, _generation
+        _attach_archives(conn)
+    return conn
+
+def close_connections():
+    """Closes every pooled connection (all threads). They reopen lazily on next use.
+
+    Other threads still hold their closed handle in their thread-local; the
+    generation bump makes their next get_connection() open a new one.
+    """
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        for conn in _connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _connections.clear()
+    _local.__dict__.clear()
+
+def configure(db_name=None, **pragmas):
+    """Points the module at another database file and/or overrides PRAGMAS."""
+    global DB_NAME
+    if db_name:
+        DB_NAME = db_name
+    PRAGMAS.update(pragmas)
+    close_connections()
+    with _bom_lock:
+        _bom_cache.clear()
+    with _cache_lock:
+        _table_cache.clear()
+        _cache_stats.clear()
+
+@contextmanager
+def transaction(immediate=False):
+    """Yields a cursor inside a transaction: commit on success, rollback on error.
+
+    Nested use joins the outer transaction, so helpers can be composed freely.
+    immediate=True takes the write lock up front (BEGIN IMMEDIATE) instead of
+    at the first write, for read-then-write sequences that must not race.
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn.cursor()
+        return
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    _local.pending_events = []
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.rollback()
+        _local.pending_events = []
+        raise
+    conn.commit()
+    pending, _local.pending_events = _local.pending_events, []
+    for event in pending:
+        events.publish(event)
+
+def _emit(event):
+    """Publishes an events.* notification once the current transaction commits (dropped on rollback)."""
+    if get_connection().in_transaction:
+        # One notification per distinct event, e.g. a single RecipeChanged for set_recipe's many inserts
+        # (namedtuples compare as plain tuples, so the type is part of the key)
+        if (type(event), event) not in [(type(e), e) for e in _local.pending_events]:
+            _local.pending_events.append(event)
+    else:
+        events.publish(event)
+
+def _retry_when_busy(fn, *args):
+    """Calls fn(*args), retrying with backoff while another connection holds the write lock.
+
+    Inside an outer transaction there is nothing to retry on our own: the
+    error goes to the caller that owns it.
+    """
+    for attempt in range(WRITE_RETRIES):
+        try:
+            return fn(*args)
+        except sqlite3.OperationalError as e:
+            busy = "locked" in str(e) or "busy" in str(e)
+            if not busy or attempt == WRITE_RETRIES - 1 or get_connection().in_transaction:
+                raise
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+
+def _query(sql, params=(), row=None):
+    """fetchall() of sql; with row (a namedtuple type) every row comes back as one."""
+    cursor = get_connection().execute(sql, params)
+    return list(map(row._make, cursor)) if row is not None else cursor.fetchall()
+
+def _cached(name, sql, row=None, counter=None):
+    """Read-through cache for a whole-table read, keyed on a change counter (`name` by default).
+
+    Triggers bump the counter on every write to the table (from any
+    connection or process), so checking it costs one primary-key lookup and
+    stale rows are never returned.
+    """
+    version = get_change_counter(counter or name)
+    with _cache_lock:
+        stats = _cache_stats.setdefault(name, {"hits": 0, "misses": 0})
+        entry = _table_cache.get(name)
+        if entry is not None and entry[0] == version:
+            stats["hits"] += 1
+            return list(entry[1])
+        stats["misses"] += 1
+    # Version was read first: rows newer than it only cause one extra miss later
+    rows = _query(sql, row=row)
+    with _cache_lock:
+        _table_cache[name] = (version, rows)
+    return list(rows)
+
+def cache_stats():
+    """Hit/miss counts of the products/users cache, e.g. {'products': {'hits': 3, 'misses': 1}}."""
+    with _cache_lock:
+        return {name: dict(stats) for name, stats in _cache_stats.items()}
+
+# The money ledgers; closed years can be moved to archive files (see archive_year)
+LEDGER_COLUMNS = {
+    "sales": ("id", "product_id", "user_id", "quantity", "total_price", "sale_date", "method"),
+    "payments": ("id", "user_id", "amount", "method", "payment_date"),
+    "purchases": ("id", "product_id", "quantity", "cost_price", "purchase_date"),
+}
+LEDGER_DATES = {"sales": "sale_date", "payments": "payment_date", "purchases": "purchase_date"}
+
+def _ledger_sql(statements, sources=None):
+    """Fills the {sales}/{payments}/{purchases} placeholders with the hot tables or `sources`."""
+    sources = sources or {table: table for table in LEDGER_COLUMNS}
+    return tuple(sql.format(**sources) for sql in statements)
+
+# Recomputes ledger_totals / user_totals / daily_totals from the raw ledgers
+_REBUILD_AGGREGATES = (
+    "DELETE FROM ledger_totals",
+    "DELETE FROM user_totals",
+    "DELETE FROM daily_totals",
+    """INSERT INTO ledger_totals (id, sales_total, payments_total, purchases_total) VALUES (1,
+        (SELECT COALESCE(SUM(total_price), 0) FROM {sales}),
+        (SELECT COALESCE(SUM(amount), 0) FROM {payments}),
+        (SELECT COALESCE(SUM(cost_price), 0) FROM {purchases}))""",
+    """INSERT INTO user_totals (user_id, total_bought, sales_count, total_paid)
+        SELECT user_id, SUM(bought), SUM(n), SUM(paid) FROM (
+            SELECT user_id, total_price AS bought, 1 AS n, 0 AS paid FROM {sales} WHERE user_id IS NOT NULL
+            UNION ALL
+            SELECT user_id, 0, 0, amount FROM {payments}
+        ) GROUP BY user_id""",
+    """INSERT INTO daily_totals (day, sales_total, sales_count, payments_total, purchases_total)
+        SELECT day, SUM(s), SUM(n), SUM(pay), SUM(pur) FROM (
+            SELECT date(sale_date) AS day, total_price AS s, 1 AS n, 0 AS pay, 0 AS pur FROM {sales}
+            UNION ALL
+            SELECT date(payment_date), 0, 0, amount, 0 FROM {payments}
+            UNION ALL
+            SELECT date(purchase_date), 0, 0, 0, cost_price FROM {purchases}
+        ) GROUP BY day""",
+)
+
+# Recomputes the per-day rollups behind analytics.py from the raw ledgers
+_REBUILD_ROLLUPS = (
+    "DELETE FROM sales_daily",
+    "DELETE FROM purchases_daily",
+    """INSERT INTO sales_daily (day, product_id, method, revenue, units, sales_count)
+        SELECT date(sale_date), product_id, COALESCE(method, 'Efectivo'), SUM(total_price), SUM(quantity), COUNT(*)
+        FROM {sales} GROUP BY 1, 2, 3""",
+    """INSERT INTO purchases_daily (day, product_id, cost, units, purchases_count)
+        SELECT date(purchase_date), product_id, SUM(cost_price), SUM(quantity), COUNT(*)
+        FROM {purchases} GROUP BY 1, 2""",
+)
+
+# Versioned schema migrations, tracked in PRAGMA user_version.
+# MIGRATIONS[n] upgrades a database from version n to n + 1; never edit a
+# released step, append a new one instead.
+MIGRATIONS = [
+    # 1: secondary indexes for the per-user ledgers, date-ordered history and recipe lookups
+    (
+        "CREATE INDEX IF NOT EXISTS idx_sales_user_date ON sales (user_id, sale_date, product_id, quantity, total_price)",
+        "CREATE INDEX IF NOT EXISTS idx_sales_date ON sales (sale_date)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_user_date ON payments (user_id, payment_date, amount, method)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_date ON payments (payment_date)",
+        "CREATE INDEX IF NOT EXISTS idx_recipes_product ON recipes (product_id, ingredient_id, quantity)",
+    ),
+    # 2: running totals (grand, per user, per day) kept in sync by triggers
+    (
+        """CREATE TABLE IF NOT EXISTS ledger_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            sales_total REAL NOT NULL DEFAULT 0,
+            payments_total REAL NOT NULL DEFAULT 0,
+            purchases_total REAL NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS user_totals (
+            user_id INTEGER PRIMARY KEY,
+            total_bought REAL NOT NULL DEFAULT 0,
+            sales_count INTEGER NOT NULL DEFAULT 0,
+            total_paid REAL NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS daily_totals (
+            day TEXT PRIMARY KEY,
+            sales_total REAL NOT NULL DEFAULT 0,
+            sales_count INTEGER NOT NULL DEFAULT 0,
+            payments_total REAL NOT NULL DEFAULT 0,
+            purchases_total REAL NOT NULL DEFAULT 0
+        ) WITHOUT ROWID""",
+        """CREATE TRIGGER IF NOT EXISTS trg_sales_totals AFTER INSERT ON sales BEGIN
+            INSERT INTO ledger_totals (id, sales_total) VALUES (1, NEW.total_price)
+                ON CONFLICT (id) DO UPDATE SET sales_total = sales_total + excluded.sales_total;
+            INSERT INTO daily_totals (day, sales_total, sales_count) VALUES (date(NEW.sale_date), NEW.total_price, 1)
+                ON CONFLICT (day) DO UPDATE SET sales_total = sales_total + excluded.sales_total, sales_count = sales_count + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_sales_user_totals AFTER INSERT ON sales WHEN NEW.user_id IS NOT NULL BEGIN
+            INSERT INTO user_totals (user_id, total_bought, sales_count) VALUES (NEW.user_id, NEW.total_price, 1)
+                ON CONFLICT (user_id) DO UPDATE SET total_bought = total_bought + excluded.total_bought, sales_count = sales_count + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_payments_totals AFTER INSERT ON payments BEGIN
+            INSERT INTO ledger_totals (id, payments_total) VALUES (1, NEW.amount)
+                ON CONFLICT (id) DO UPDATE SET payments_total = payments_total + excluded.payments_total;
+            INSERT INTO daily_totals (day, payments_total) VALUES (date(NEW.payment_date), NEW.amount)
+                ON CONFLICT (day) DO UPDATE SET payments_total = payments_total + excluded.payments_total;
+            INSERT INTO user_totals (user_id, total_paid) VALUES (NEW.user_id, NEW.amount)
+                ON CONFLICT (user_id) DO UPDATE SET total_paid = total_paid + excluded.total_paid;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_purchases_totals AFTER INSERT ON purchases BEGIN
+            INSERT INTO ledger_totals (id, purchases_total) VALUES (1, NEW.cost_price)
+                ON CONFLICT (id) DO UPDATE SET purchases_total = purchases_total + excluded.purchases_total;
+            INSERT INTO daily_totals (day, purchases_total) VALUES (date(NEW.purchase_date), NEW.cost_price)
+                ON CONFLICT (day) DO UPDATE SET purchases_total = purchases_total + excluded.purchases_total;
+        END""",
+    ) + _ledger_sql(_REBUILD_AGGREGATES),
+    # 3: change counters, bumped by triggers so every connection can tell when cached data is stale
+    (
+        "CREATE TABLE IF NOT EXISTS change_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID",
+        "INSERT OR IGNORE INTO change_counters (name) VALUES ('recipes')",
+        "CREATE TRIGGER IF NOT EXISTS trg_recipes_insert AFTER INSERT ON recipes BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'recipes'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_recipes_update AFTER UPDATE ON recipes BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'recipes'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_recipes_delete AFTER DELETE ON recipes BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'recipes'; END",
+    ),
+    # 4: counters for the searchable fields of products and users (stock/balance changes don't count)
+    (
+        "INSERT OR IGNORE INTO change_counters (name) VALUES ('product_names'), ('user_names')",
+        "CREATE TRIGGER IF NOT EXISTS trg_products_names_insert AFTER INSERT ON products BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'product_names'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_products_names_update AFTER UPDATE OF name, category ON products BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'product_names'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_products_names_delete AFTER DELETE ON products BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'product_names'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_users_names_insert AFTER INSERT ON users BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'user_names'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_users_names_update AFTER UPDATE OF name, phone ON users BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'user_names'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_users_names_delete AFTER DELETE ON users BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'user_names'; END",
+    ),
+    # 5: counters for any change to a products / users row (stock and balance included), see _cached()
+    (
+        "INSERT OR IGNORE INTO change_counters (name) VALUES ('products'), ('users')",
+        "CREATE TRIGGER IF NOT EXISTS trg_products_insert AFTER INSERT ON products BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'products'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_products_update AFTER UPDATE ON products BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'products'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_products_delete AFTER DELETE ON products BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'products'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_users_insert AFTER INSERT ON users BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'users'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_users_update AFTER UPDATE ON users BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'users'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'users'; END",
+    ),
+    # 6: one counter for the money ledgers (sales, payments, purchases), used to refresh cached screens
+    (
+        "INSERT OR IGNORE INTO change_counters (name) VALUES ('ledger')",
+        *(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_ledger_{event.lower()} AFTER {event} ON {table} "
+          "BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'ledger'; END"
+          for table in ("sales", "payments", "purchases") for event in ("INSERT", "UPDATE", "DELETE")),
+    ),
+    # 7: counter for the inputs of the cost roll-up (prices, types, purchases), see costing.py
+    (
+        "CREATE INDEX IF NOT EXISTS idx_purchases_product ON purchases (product_id, id)",
+        "INSERT OR IGNORE INTO change_counters (name) VALUES ('costs')",
+        "CREATE TRIGGER IF NOT EXISTS trg_products_costs_insert AFTER INSERT ON products BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'costs'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_products_costs_update AFTER UPDATE OF price, type ON products BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'costs'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_products_costs_delete AFTER DELETE ON products BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'costs'; END",
+        *(f"CREATE TRIGGER IF NOT EXISTS trg_purchases_costs_{event.lower()} AFTER {event} ON purchases "
+          "BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'costs'; END"
+          for event in ("INSERT", "UPDATE", "DELETE")),
+    ),
+    # 8: payment method on sales, and per-day rollups by product (and method) for analytics.py
+    (
+        "ALTER TABLE sales ADD COLUMN method TEXT NOT NULL DEFAULT 'Efectivo'",
+        """CREATE TABLE IF NOT EXISTS sales_daily (
+            day TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            revenue REAL NOT NULL DEFAULT 0,
+            units REAL NOT NULL DEFAULT 0,
+            sales_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product_id, method)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS purchases_daily (
+            day TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            cost REAL NOT NULL DEFAULT 0,
+            units REAL NOT NULL DEFAULT 0,
+            purchases_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product_id)
+        ) WITHOUT ROWID""",
+        """CREATE TRIGGER IF NOT EXISTS trg_sales_daily AFTER INSERT ON sales BEGIN
+            INSERT INTO sales_daily (day, product_id, method, revenue, units, sales_count)
+                VALUES (date(NEW.sale_date), NEW.product_id, COALESCE(NEW.method, 'Efectivo'), NEW.total_price, NEW.quantity, 1)
+                ON CONFLICT (day, product_id, method) DO UPDATE SET revenue = revenue + excluded.revenue,
+                    units = units + excluded.units, sales_count = sales_count + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_purchases_daily AFTER INSERT ON purchases BEGIN
+            INSERT INTO purchases_daily (day, product_id, cost, units, purchases_count)
+                VALUES (date(NEW.purchase_date), NEW.product_id, NEW.cost_price, NEW.quantity, 1)
+                ON CONFLICT (day, product_id) DO UPDATE SET cost = cost + excluded.cost,
+                    units = units + excluded.units, purchases_count = purchases_count + 1;
+        END""",
+    ) + _ledger_sql(_REBUILD_ROLLUPS),
+    # 9: registry of the yearly archive files (see archive_year) and a date index for purchases
+    (
+        """CREATE TABLE IF NOT EXISTS archives (
+            year INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            sales INTEGER NOT NULL DEFAULT 0,
+            payments INTEGER NOT NULL DEFAULT 0,
+            purchases INTEGER NOT NULL DEFAULT 0,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_purchases_date ON purchases (purchase_date)",
+    ),
+    # 10: append-only stock movement journal and the stock snapshots it is consolidated into (see get_stock_at)
+    (
+        """CREATE TABLE IF NOT EXISTS stock_movements (
+            id INTEGER PRIMARY KEY,
+            product_id INTEGER NOT NULL,
+            delta REAL NOT NULL,
+            reason TEXT NOT NULL,            -- 'ALTA', 'VENTA', 'COMPRA', 'AJUSTE' or 'IMPORTACION'
+            ref INTEGER,                     -- the sale / purchase row behind it, if any
+            moved_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_stock_movements_product ON stock_movements (product_id, moved_at, delta)",
+        """CREATE TABLE IF NOT EXISTS stock_snapshots (
+            id INTEGER PRIMARY KEY,
+            taken_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            last_movement INTEGER NOT NULL   -- movements up to this id are included
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_stock_snapshots_taken ON stock_snapshots (taken_at)",
+        """CREATE TABLE IF NOT EXISTS stock_snapshot_items (
+            snapshot_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            stock REAL NOT NULL,
+            PRIMARY KEY (snapshot_id, product_id)
+        ) WITHOUT ROWID""",
+        # The journal starts from the stock as it is now
+        "INSERT OR IGNORE INTO stock_snapshots (id, last_movement) VALUES (1, 0)",
+        "INSERT OR IGNORE INTO stock_snapshot_items (snapshot_id, product_id, stock) SELECT 1, id, stock FROM products",
+    ),
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_schema_version():
+    return get_connection().execute("PRAGMA user_version").fetchone()[0]
 
 def init_db():
-    conn = connect_db()
-    cursor = conn.cursor()
+    """Creates / upgrades the schema. A database that is already current costs one PRAGMA read."""
+    if get_schema_version() == SCHEMA_VERSION:
+        return
+    with transaction(immediate=True) as cursor:
+        _migrate(cursor)
+
+def _migrate(cursor):
+    """Brings the schema to SCHEMA_VERSION inside the caller's transaction: all steps or none."""
+    # Re-read under the write lock: another process may have migrated in the meantime
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"La base de datos (versión {version}) es más nueva que la aplicación (versión {SCHEMA_VERSION})")
+    if version == 0:
+        _create_schema(cursor)
+    for statements in MIGRATIONS[version:]:
+        for sql in statements:
+            cursor.execute(sql)
+    if version != SCHEMA_VERSION:
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+def _add_missing_columns(cursor, table, columns):
+    """ALTER TABLE ... ADD COLUMN for each {name: definition} the table doesn't have yet."""
+    existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    for name, definition in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+def _create_schema(cursor):
+    """Version 0: the tables as they were before versioning, including files created by older builds."""
     
     # Products table
     cursor.execute('''
@@ -80,277 +509,742 @@ def init_db():
         )
     ''')
 
-    # Migrations
-    try:
-        cursor.execute("ALTER TABLE sales ADD COLUMN user_id INTEGER REFERENCES users(id)")
-    except Exception: pass
-
-    try:
-        # type: 'PRODUCTO' or 'INSUMO'
-        cursor.execute("ALTER TABLE products ADD COLUMN type TEXT DEFAULT 'PRODUCTO'")
-    except Exception: pass
-
-    try:
-        # unit: 'unid', 'ml', 'gr', etc.
-        cursor.execute("ALTER TABLE products ADD COLUMN unit TEXT DEFAULT 'unid'")
-    except Exception: pass
-
-    conn.commit()
-    conn.close()
+    # Columns added after the first release; old files may still lack them
+    _add_missing_columns(cursor, "sales", {"user_id": "INTEGER REFERENCES users(id)"})
+    _add_missing_columns(cursor, "products", {
+        "type": "TEXT DEFAULT 'PRODUCTO'",  # 'PRODUCTO', 'INSUMO' or 'COMPUESTO'
+        "unit": "TEXT DEFAULT 'unid'",      # 'unid', 'ml', 'gr', etc.
+    })
 
 # Product Functions
 def add_product(name, price, stock, category="", p_type="PRODUCTO", unit="unid"):
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO products (name, price, stock, category, type, unit) VALUES (?, ?, ?, ?, ?, ?)", 
-                   (name, price, stock, category, p_type, unit))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("INSERT INTO products (name, price, stock, category, type, unit) VALUES (?, ?, ?, ?, ?, ?)", 
+                       (name, price, stock, category, p_type, unit))
+        product_id = cursor.lastrowid
+        _log_stock(cursor, {product_id: stock}, "ALTA")
+        _emit(events.ProductsAdded([product_id]))
+        return product_id
 
 def get_products():
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM products")
-    products = cursor.fetchall()
-    conn.close()
-    return products
+    """Every product as a Product."""
+    return _cached("products", f"SELECT {PRODUCT_COLUMNS} FROM products", Product)
+
+def get_sale_items():
+    """SaleItem (id, name, price, stock, type) of every product that can be sold (not an INSUMO)."""
+    return _cached("sale_items", "SELECT id, name, price, stock, type FROM products WHERE type IS NOT 'INSUMO'",
+                   SaleItem, counter="products")
 
 def update_product(product_id, name, price, stock, category="", p_type="PRODUCTO", unit="unid"):
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE products SET name = ?, price = ?, stock = ?, category = ?, type = ?, unit = ? WHERE id = ?", 
-                   (name, price, stock, category, p_type, unit, product_id))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        old = cursor.execute("SELECT stock FROM products WHERE id = ?", (product_id,)).fetchone()
+        cursor.execute("UPDATE products SET name = ?, price = ?, stock = ?, category = ?, type = ?, unit = ? WHERE id = ?", 
+                       (name, price, stock, category, p_type, unit, product_id))
+        if old:
+            _log_stock(cursor, {product_id: stock - old[0]}, "AJUSTE")
+        _emit(events.ProductsChanged([product_id]))
 
 def delete_product(prod_id):
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM products WHERE id=?", (prod_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM products WHERE id=?", (prod_id,))
+        _emit(events.ProductsDeleted([prod_id]))
 
 # User Functions
 def add_user(name, phone):
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO users (name, phone) VALUES (?, ?)", (name, phone))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("INSERT INTO users (name, phone) VALUES (?, ?)", (name, phone))
+        _emit(events.UsersChanged([cursor.lastrowid]))
+        return cursor.lastrowid
 
 def get_users():
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users")
-    users = cursor.fetchall()
-    conn.close()
-    return users
+    """Every user as a User."""
+    return _cached("users", f"SELECT {USER_COLUMNS} FROM users", User)
 
 def update_user_balance(user_id, amount):
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amount, user_id))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amount, user_id))
+        _emit(events.BalanceChanged([user_id]))
 
 def delete_user(user_id):
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        _emit(events.UsersDeleted([user_id]))
 
 # Payment Functions
 def record_payment(user_id, amount, method):
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO payments (user_id, amount, method) VALUES (?, ?, ?)", 
-                   (user_id, amount, method))
-    cursor.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amount, user_id))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("INSERT INTO payments (user_id, amount, method) VALUES (?, ?, ?)", 
+                       (user_id, amount, method))
+        cursor.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amount, user_id))
+        _emit(events.PaymentRecorded(user_id, amount, method))
+        _emit(events.BalanceChanged([user_id]))
 
 # Recipe Functions
 def add_recipe_item(product_id, ingredient_id, quantity):
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO recipes (product_id, ingredient_id, quantity) VALUES (?, ?, ?)",
-                   (product_id, ingredient_id, quantity))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        # Refuse edges that would close a loop (A uses B uses ... uses A)
+        cursor.execute('''
+            WITH RECURSIVE reach(id) AS (
+                SELECT ?
+                UNION
+                SELECT r.ingredient_id FROM recipes r JOIN reach ON r.product_id = reach.id
+            )
+            SELECT 1 FROM reach WHERE id = ? LIMIT 1
+        ''', (ingredient_id, product_id))
+        if cursor.fetchone():
+            raise ValueError(f"Receta cíclica: el item {ingredient_id} ya contiene al producto {product_id}")
+        cursor.execute("INSERT INTO recipes (product_id, ingredient_id, quantity) VALUES (?, ?, ?)",
+                       (product_id, ingredient_id, quantity))
+        _emit(events.RecipeChanged(product_id))
+
+def set_recipe(product_id, items):
+    """Replaces the whole recipe of a product with [(ingredient_id, quantity), ...] atomically."""
+    with transaction():
+        delete_recipe(product_id)
+        for ingredient_id, quantity in items:
+            add_recipe_item(product_id, ingredient_id, quantity)
+
+def get_flattened_recipe(product_id):
+    """Returns [(leaf_id, quantity_per_unit), ...]: the stock items one unit of product_id consumes.
+
+    A product without a recipe consumes itself. Results are cached until any
+    recipe changes (tracked by the 'recipes' change counter, so edits made by
+    other connections are seen too).
+    """
+    return list(_flattened_recipe(get_connection().cursor(), product_id))
+
+def _flattened_recipe(cursor, product_id):
+    generation = cursor.execute("SELECT value FROM change_counters WHERE name = 'recipes'").fetchone()[0]
+    with _bom_lock:
+        if _bom_cache.get("generation") != generation:
+            _bom_cache.clear()
+            _bom_cache["generation"] = generation
+        flat = _bom_cache.get(product_id)
+
+    if flat is None:
+        cursor.execute('''
+            WITH RECURSIVE bom(ingredient_id, quantity, depth) AS (
+                SELECT ingredient_id, quantity, 1 FROM recipes WHERE product_id = ?
+                UNION ALL
+                SELECT r.ingredient_id, bom.quantity * r.quantity, bom.depth + 1
+                FROM bom JOIN recipes r ON r.product_id = bom.ingredient_id
+                WHERE bom.depth < 32
+            )
+            SELECT ingredient_id, SUM(quantity) FROM bom
+            WHERE NOT EXISTS (SELECT 1 FROM recipes x WHERE x.product_id = bom.ingredient_id)
+            GROUP BY ingredient_id
+        ''', (product_id,))
+        flat = tuple(cursor.fetchall()) or ((product_id, 1),)
+        with _bom_lock:
+            # Another thread may have moved the cache to a newer generation meanwhile
+            if _bom_cache.get("generation") == generation:
+                _bom_cache[product_id] = flat
+    return flat
 
 def get_recipe(product_id):
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute('''
+    return _query('''
         SELECT r.ingredient_id, p.name, r.quantity 
         FROM recipes r
         JOIN products p ON r.ingredient_id = p.id
         WHERE r.product_id = ?
     ''', (product_id,))
-    recipe = cursor.fetchall()
-    conn.close()
-    return recipe
 
 def get_user_purchases(user_id):
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute('''
+    tables = _ledger_tables("sales")
+    branches = [f'''
         SELECT s.id, p.name, s.quantity, s.total_price, s.sale_date 
-        FROM sales s 
+        FROM {table} s 
         JOIN products p ON s.product_id = p.id
-        WHERE s.user_id = ?
-        ORDER BY s.sale_date DESC
-    ''', (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+        WHERE s.user_id = ?''' for table in tables]
+    return _query("\n        UNION ALL".join(branches) + "\n        ORDER BY 5 DESC", (user_id,) * len(tables))
 
 def delete_recipe(product_id):
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM recipes WHERE product_id = ?", (product_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM recipes WHERE product_id = ?", (product_id,))
+        _emit(events.RecipeChanged(product_id))
 
 def update_ingredient_unit_cost(item_id, total_cost, quantity):
     if quantity <= 0: return
-    conn = connect_db()
-    cursor = conn.cursor()
     unit_cost = total_cost / quantity
-    cursor.execute("UPDATE products SET price = ? WHERE id = ?", (unit_cost, item_id))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("UPDATE products SET price = ? WHERE id = ?", (unit_cost, item_id))
+        _emit(events.ProductsChanged([item_id]))
 
 def get_user_financial_history(user_id):
-    conn = connect_db()
-    cursor = conn.cursor()
     # Combine Sales and Payments for a specific user
     # Columns: ID, Type (COMPRA/ABONO), Detail (Product/Method), Info (Qty/-), Amount, Date
-    cursor.execute('''
+    branches = [f'''
         SELECT s.id, 'COMPRA' as type, p.name as detail, CAST(s.quantity AS TEXT) as info, s.total_price as amount, s.sale_date as date
-        FROM sales s
+        FROM {table} s
         JOIN products p ON s.product_id = p.id
-        WHERE s.user_id = ?
-        UNION ALL
+        WHERE s.user_id = ?''' for table in _ledger_tables("sales")]
+    branches += [f'''
         SELECT pay.id, 'ABONO' as type, pay.method as detail, '-' as info, pay.amount as amount, pay.payment_date as date
-        FROM payments pay
-        WHERE pay.user_id = ?
-        ORDER BY date DESC
-    ''', (user_id, user_id))
-    history = cursor.fetchall()
-    conn.close()
-    return history
+        FROM {table} pay
+        WHERE pay.user_id = ?''' for table in _ledger_tables("payments")]
+    return _query("\n        UNION ALL".join(branches) + "\n        ORDER BY date DESC", (user_id,) * len(branches))
 
 def get_user_financial_totals(user_id):
-    conn = connect_db()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT SUM(total_price) FROM sales WHERE user_id = ?", (user_id,))
-    total_bought = cursor.fetchone()[0] or 0.0
-    
-    cursor.execute("SELECT SUM(amount) FROM payments WHERE user_id = ?", (user_id,))
-    total_paid = cursor.fetchone()[0] or 0.0
-    
-    conn.close()
-    return total_bought, total_paid
+    row = get_connection().execute(
+        "SELECT total_bought, total_paid FROM user_totals WHERE user_id = ?", (user_id,)).fetchone()
+    return row if row else (0.0, 0.0)
+
+def get_daily_totals(day):
+    """Returns (sales, payments, purchases) for a 'YYYY-MM-DD' day."""
+    row = get_connection().execute(
+        "SELECT sales_total, payments_total, purchases_total FROM daily_totals WHERE day = ?", (day,)).fetchone()
+    return row if row else (0.0, 0.0, 0.0)
 
 # Sale Functions
+Shortage = namedtuple("Shortage", "product_id name needed available")
+
+class InsufficientStockError(ValueError):
+    """A sale needs more stock than there is; .shortages lists every item short (nothing was recorded)."""
+
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__("Stock insuficiente: " + ", ".join(
+            f"{s.name} (necesita {s.needed:g}, hay {s.available:g})" for s in shortages))
+
+def _stock_deltas(cursor, lines):
+    """{leaf product id: quantity} a cart takes from stock, recipes expanded and merged."""
+    deltas = {}
+    for product_id, quantity, *_ in lines:
+        for leaf_id, leaf_qty in _flattened_recipe(cursor, product_id):
+            deltas[leaf_id] = deltas.get(leaf_id, 0) + leaf_qty * quantity
+    return deltas
+
+def _shortages(cursor, deltas):
+    ids = list(deltas)
+    if not ids:
+        return []
+    rows = {row[0]: row for row in cursor.execute(
+        f"SELECT id, name, stock FROM products WHERE id IN ({','.join('?' * len(ids))})", ids)}
+    shortages = []
+    for leaf_id in ids:
+        _, name, stock = rows.get(leaf_id, (leaf_id, f"#{leaf_id}", 0))
+        if deltas[leaf_id] > stock:
+            shortages.append(Shortage(leaf_id, name, deltas[leaf_id], stock))
+    return shortages
+
+def check_stock(lines):
+    """Shortages a cart [(product_id, quantity, ...), ...] would hit right now; [] if it can be sold."""
+    cursor = get_connection().cursor()
+    return _shortages(cursor, _stock_deltas(cursor, lines))
+
 def deduct_recipe_recursive(cursor, product_id, quantity):
-    """Recursively deducts ingredients if product has a recipe."""
-    cursor.execute("SELECT ingredient_id, quantity FROM recipes WHERE product_id = ?", (product_id,))
-    recipe = cursor.fetchall()
-    
-    if recipe:
-        for ing_id, ing_qty in recipe:
-            # Recursive call: an ingredient could itself have a recipe
-            deduct_recipe_recursive(cursor, ing_id, ing_qty * quantity)
-    else:
-        # Base case: no recipe, deduct from stock directly
-        cursor.execute("UPDATE products SET stock = stock - ? WHERE id = ?", (quantity, product_id))
+    """Deducts stock for a sale: the leaf ingredients of the (cached, flattened) recipe, or the product itself."""
+    flat = _flattened_recipe(cursor, product_id)
+    cursor.executemany("UPDATE products SET stock = stock - ? WHERE id = ?",
+                       [(leaf_qty * quantity, leaf_id) for leaf_id, leaf_qty in flat])
+    _log_stock(cursor, {leaf_id: -leaf_qty * quantity for leaf_id, leaf_qty in flat}, "VENTA")
+    _emit(events.StockChanged([leaf_id for leaf_id, _ in flat]))
 
 def record_sale(product_id, quantity, total_price, user_id=None, method="Efectivo"):
-    conn = connect_db()
-    cursor = conn.cursor()
-    
-    # Process stock deduction recursively
-    deduct_recipe_recursive(cursor, product_id, quantity)
-    
-    # Insert sale record
-    cursor.execute("INSERT INTO sales (product_id, user_id, quantity, total_price) VALUES (?, ?, ?, ?)", 
-                   (product_id, user_id, quantity, total_price))
-    if user_id:
-        cursor.execute("UPDATE users SET balance = balance - ? WHERE id = ?", (total_price, user_id))
-    conn.commit()
-    conn.close()
+    record_sales_batch([(product_id, quantity, total_price)], user_id, method)
 
-def get_sales_history():
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute('''
+def record_sales_batch(lines, user_id=None, method="Efectivo"):
+    """Records a multi-item sale [(product_id, quantity, total_price), ...] in one transaction.
+
+    All or nothing: the write lock is taken up front (BEGIN IMMEDIATE), so
+    the stock checked is the stock deducted even with other stations or
+    processes selling at once. If any item (recipes expanded) is short,
+    InsufficientStockError reports every shortage and nothing is recorded.
+    Stock is deducted with a single executemany and the user's wallet is
+    charged once for the whole cart.
+    """
+    lines = list(lines)
+    if not lines: return
+    _retry_when_busy(_record_sales_batch, lines, user_id, method)
+
+def _record_sales_batch(lines, user_id, method):
+    with transaction(immediate=True) as cursor:
+        # Merge the stock deltas of all lines so each item is checked and updated once
+        deltas = _stock_deltas(cursor, lines)
+        shortages = _shortages(cursor, deltas)
+        if shortages:
+            raise InsufficientStockError(shortages)
+        cursor.executemany("UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?",
+                           [(qty, leaf_id, qty) for leaf_id, qty in deltas.items()])
+        if cursor.rowcount != len(deltas):
+            raise InsufficientStockError(_shortages(cursor, deltas))
+
+        # Insert sale records; each line's movements are journaled under its own sale id
+        for product_id, quantity, total_price in lines:
+            cursor.execute("INSERT INTO sales (product_id, user_id, quantity, total_price, method) VALUES (?, ?, ?, ?, ?)",
+                           (product_id, user_id, quantity, total_price, method))
+            line_deltas = _stock_deltas(cursor, [(product_id, quantity)])
+            _log_stock(cursor, {leaf_id: -qty for leaf_id, qty in line_deltas.items()}, "VENTA", cursor.lastrowid)
+        if user_id:
+            cursor.execute("UPDATE users SET balance = balance - ? WHERE id = ?",
+                           (sum(line[2] for line in lines), user_id))
+        _emit(events.StockChanged(list(deltas)))
+        _emit(events.SaleRecorded(user_id, lines))
+        if user_id:
+            _emit(events.BalanceChanged([user_id]))
+
+def get_sales_history(since=None, until=None, user_id=None):
+    return list(iter_sales_history(since, until, user_id))
+
+def get_combined_history(since=None, until=None, kind=None, user_id=None):
+    # Combine Sales and Payments
+    # We'll normalize columns: ID, Type (Sale/Payment), Entity (Product/User), Info (Qty/Method), Amount, Date
+    return list(iter_combined_history(since, until, kind, user_id))
+
+# Search support (see search.py)
+def get_change_counter(name):
+    """Current value of a change counter ('recipes', 'product_names', 'user_names', 'products', 'users', 'ledger', 'costs')."""
+    row = get_connection().execute("SELECT value FROM change_counters WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+def get_change_counters():
+    """Every change counter as {name: value}, in one read."""
+    return dict(_query("SELECT name, value FROM change_counters"))
+
+def get_product_search_fields():
+    return _query("SELECT id, name, category FROM products")
+
+def get_user_search_fields():
+    return _query("SELECT id, name, phone FROM users")
+
+# Cost roll-up support (see costing.py)
+def get_cost_inputs():
+    """(id, name, type, sale price, unit cost of its last purchase or None) for every product.
+
+    The last purchase is looked up in the main file, then in the archives from the newest year back.
+    """
+    main, *archived = _ledger_tables("purchases")
+    costs = [f"(SELECT cost_price / NULLIF(quantity, 0) FROM {table} "
+             f"WHERE id = (SELECT MAX(id) FROM {table} WHERE product_id = p.id))"
+             for table in [main, *sorted(archived, reverse=True)]]
+    cost = f"COALESCE({', '.join(costs)})" if archived else costs[0]
+    return _query(f"SELECT p.id, p.name, p.type, p.price, {cost} FROM products p")
+
+def get_recipe_edges():
+    """Every recipe line as (product_id, ingredient_id, quantity)."""
+    return _query("SELECT product_id, ingredient_id, quantity FROM recipes")
+
+def get_products_by_ids(ids):
+    """Products for the given ids, in the same order (missing ids are skipped)."""
+    ids = list(ids)
+    rows = {row.id: row for row in _query(
+        f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id IN ({','.join('?' * len(ids))})", ids, Product)} if ids else {}
+    return [rows[i] for i in ids if i in rows]
+
+def get_users_by_ids(ids):
+    """Users for the given ids, in the same order (missing ids are skipped)."""
+    ids = list(ids)
+    rows = {row.id: row for row in _query(
+        f"SELECT {USER_COLUMNS} FROM users WHERE id IN ({','.join('?' * len(ids))})", ids, User)} if ids else {}
+    return [rows[i] for i in ids if i in rows]
+
+# Paged reads (keyset pagination: pass the key of the last row already shown)
+_HISTORY_START = ("9999-12-31", 0, "~")  # sorts after every real (date, id, type) key
+
+def get_products_page(after_id=None, limit=200, query=""):
+    like = f"%{query}%"
+    return _query(f'''
+        SELECT {PRODUCT_COLUMNS} FROM products
+        WHERE id > ? AND (? = '' OR name LIKE ? OR category LIKE ?)
+        ORDER BY id LIMIT ?
+    ''', (after_id or 0, query, like, like, limit), Product)
+
+def get_users_page(after_id=None, limit=200, query=""):
+    like = f"%{query}%"
+    return _query(f'''
+        SELECT {USER_COLUMNS} FROM users
+        WHERE id > ? AND (? = '' OR name LIKE ? OR phone LIKE ?)
+        ORDER BY id LIMIT ?
+    ''', (after_id or 0, query, like, like, limit), User)
+
+HISTORY_KINDS = ("VENTA", "PAGO")
+
+def history_key(row):
+    """Keyset position of a history row: (date, id, type)."""
+    return (row[5], row[0], row[1])
+
+def sales_history_key(row):
+    """Keyset position of a get_sales_history() row: (date, id)."""
+    return (row[5], row[0])
+
+def _filters(date_column, user_column, since, until, user_id):
+    """Extra WHERE terms for since <= date < until and the user; None skips a filter."""
+    sql, params = "", []
+    if since is not None:
+        sql += f" AND {date_column} >= ?"
+        params.append(since)
+    if until is not None:
+        sql += f" AND {date_column} < ?"
+        params.append(until)
+    if user_id is not None:
+        sql += f" AND {user_column} = ?"
+        params.append(user_id)
+    return sql, params
+
+def get_combined_history_page(before=None, limit=200, since=None, until=None, kind=None, user_id=None):
+    """Newest-first page of get_combined_history() rows older than the history_key() `before`.
+
+    since/until bound the date (until is exclusive), kind keeps only 'VENTA' or
+    'PAGO' rows and user_id only that user's sales and payments.
+    """
+    if kind is not None and kind not in HISTORY_KINDS:
+        raise ValueError(f"Tipo de movimiento desconocido: {kind}")
+    before = before or _HISTORY_START
+    last = min(until or before[0], before[0])
+    branches, params = [], []
+    if kind in (None, "VENTA"):
+        where, args = _filters("s.sale_date", "s.user_id", since, until, user_id)
+        for table in _ledger_tables("sales", since, last):
+            branches.append(f'''
+        SELECT s.id as id, 'VENTA' as type, p.name as detail, s.quantity as info, s.total_price as amount, s.sale_date as date
+        FROM {table} s
+        JOIN products p ON s.product_id = p.id
+        WHERE (s.sale_date, s.id, 'VENTA') < (?, ?, ?){where}''')
+            params += [*before, *args]
+    if kind in (None, "PAGO"):
+        where, args = _filters("pay.payment_date", "pay.user_id", since, until, user_id)
+        for table in _ledger_tables("payments", since, last):
+            branches.append(f'''
+        SELECT pay.id as id, 'PAGO' as type, u.name as detail, pay.method as info, pay.amount as amount, pay.payment_date as date
+        FROM {table} pay
+        JOIN users u ON pay.user_id = u.id
+        WHERE (pay.payment_date, pay.id, 'PAGO') < (?, ?, ?){where}''')
+            params += [*before, *args]
+    sql = "\n        UNION ALL".join(branches) + "\n        ORDER BY date DESC, id DESC, type DESC\n        LIMIT ?"
+    return _query(sql, (*params, limit))
+
+def get_sales_history_page(before=None, limit=200, since=None, until=None, user_id=None):
+    """Newest-first page of get_sales_history() rows older than the sales_history_key() `before`."""
+    before = before or _HISTORY_START[:2]
+    where, args = _filters("s.sale_date", "s.user_id", since, until, user_id)
+    tables = _ledger_tables("sales", since, min(until or before[0], before[0]))
+    branches = [f'''
         SELECT s.id, p.name, u.name, s.quantity, s.total_price, s.sale_date 
-        FROM sales s 
+        FROM {table} s 
         JOIN products p ON s.product_id = p.id
         LEFT JOIN users u ON s.user_id = u.id
-        ORDER BY s.sale_date DESC
-    ''')
-    sales = cursor.fetchall()
-    conn.close()
-    return sales
-
-def get_combined_history():
-    conn = connect_db()
-    cursor = conn.cursor()
-    # Combine Sales and Payments using UNION
-    # We'll normalize columns: ID, Type (Sale/Payment), Entity (Product/User), Info (Qty/Method), Amount, Date
-    cursor.execute('''
-        SELECT s.id, 'VENTA' as type, p.name as detail, s.quantity as info, s.total_price as amount, s.sale_date as date
-        FROM sales s
+        WHERE (s.sale_date, s.id) < (?, ?){where}''' for table in tables]
+    sql = "\n        UNION ALL".join(branches) + "\n        ORDER BY 6 DESC, 1 DESC\n        LIMIT ?"
+    return _query(sql, (*[*before, *args] * len(tables), limit))
+
+def _iter_pages(fetch_page, key, batch):
+    before = None
+    while True:
+        rows = fetch_page(before, batch)
+        yield from rows
+        if len(rows) < batch:
+            return
+        before = key(rows[-1])
+
+def iter_combined_history(since=None, until=None, kind=None, user_id=None, batch=500):
+    """Streams get_combined_history_page() rows, newest first, `batch` rows per query."""
+    return _iter_pages(lambda before, limit: get_combined_history_page(before, limit, since, until, kind, user_id),
+                       history_key, batch)
+
+def iter_sales_history(since=None, until=None, user_id=None, batch=500):
+    """Streams get_sales_history_page() rows, newest first, `batch` rows per query."""
+    return _iter_pages(lambda before, limit: get_sales_history_page(before, limit, since, until, user_id),
+                       sales_history_key, batch)
+
+def get_user_financial_history_page(user_id, before=None, limit=200):
+    """Newest-first page of get_user_financial_history() rows older than the history_key() `before`."""
+    before = before or _HISTORY_START
+    branches, params = [], []
+    for table in _ledger_tables("sales", None, before[0]):
+        branches.append(f'''
+        SELECT s.id as id, 'COMPRA' as type, p.name as detail, CAST(s.quantity AS TEXT) as info, s.total_price as amount, s.sale_date as date
+        FROM {table} s
         JOIN products p ON s.product_id = p.id
-        UNION ALL
-        SELECT pay.id, 'PAGO' as type, u.name as detail, pay.method as info, pay.amount as amount, pay.payment_date as date
-        FROM payments pay
-        JOIN users u ON pay.user_id = u.id
-        ORDER BY date DESC
-    ''')
-    history = cursor.fetchall()
-    conn.close()
-    return history
+        WHERE s.user_id = ? AND (s.sale_date, s.id, 'COMPRA') < (?, ?, ?)''')
+        params += [user_id, *before]
+    for table in _ledger_tables("payments", None, before[0]):
+        branches.append(f'''
+        SELECT pay.id as id, 'ABONO' as type, pay.method as detail, '-' as info, pay.amount as amount, pay.payment_date as date
+        FROM {table} pay
+        WHERE pay.user_id = ? AND (pay.payment_date, pay.id, 'ABONO') < (?, ?, ?)''')
+        params += [user_id, *before]
+    sql = "\n        UNION ALL".join(branches) + "\n        ORDER BY date DESC, id DESC, type DESC\n        LIMIT ?"
+    return _query(sql, (*params, limit))
 
 # Purchase Functions
 def record_purchase(product_id, quantity, cost_price):
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE products SET stock = stock + ? WHERE id = ?", (quantity, product_id))
-    cursor.execute("INSERT INTO purchases (product_id, quantity, cost_price) VALUES (?, ?, ?)", 
-                   (product_id, quantity, cost_price))
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute("UPDATE products SET stock = stock + ? WHERE id = ?", (quantity, product_id))
+        cursor.execute("INSERT INTO purchases (product_id, quantity, cost_price) VALUES (?, ?, ?)", 
+                       (product_id, quantity, cost_price))
+        _log_stock(cursor, {product_id: quantity}, "COMPRA", cursor.lastrowid)
+        _emit(events.StockChanged([product_id]))
+        _emit(events.PurchaseRecorded(product_id, quantity, cost_price))
 
 def get_financial_summary():
-    conn = connect_db()
-    cursor = conn.cursor()
-    
-    # Total Sales Inflow
-    cursor.execute("SELECT SUM(total_price) FROM sales")
-    total_sales = cursor.fetchone()[0] or 0.0
+    cursor = get_connection().cursor()
     
-    # Total Purchase Outflow
-    cursor.execute("SELECT SUM(cost_price) FROM purchases")
-    total_purchases = cursor.fetchone()[0] or 0.0
+    # Total Sales Inflow / Purchase Outflow (maintained by triggers, see ledger_totals)
+    cursor.execute("SELECT sales_total, purchases_total FROM ledger_totals WHERE id = 1")
+    total_sales, total_purchases = cursor.fetchone() or (0.0, 0.0)
     
     # Sales by User (Including ID and Balance)
     cursor.execute('''
-        SELECT u.id, u.name, SUM(s.total_price), u.balance
-        FROM sales s 
-        JOIN users u ON s.user_id = u.id 
-        GROUP BY u.id
+        SELECT u.id, u.name, t.total_bought, u.balance
+        FROM user_totals t
+        JOIN users u ON t.user_id = u.id
+        WHERE t.sales_count > 0
     ''')
     user_sales = cursor.fetchall()
     
-    conn.close()
     return total_sales, total_purchases, user_sales
 
+_AGGREGATE_KEYS = (("ledger_totals", ("id",)), ("user_totals", ("user_id",)), ("daily_totals", ("day",)),
+                   ("sales_daily", ("day", "product_id", "method")), ("purchases_daily", ("day", "product_id")))
+
+def _aggregate_rows(cursor):
+    rows = {}
+    for table, key in _AGGREGATE_KEYS:
+        for row in cursor.execute(f"SELECT * FROM {table} ORDER BY {', '.join(key)}"):
+            rows[(table, row[0] if len(key) == 1 else row[:len(key)])] = tuple(round(v, 6) for v in row[len(key):])
+    return rows
+
+def rebuild_aggregates():
+    """Recomputes the running totals and daily rollups from sales/payments/purchases (archives included).
+
+    Returns a list of (table, key, stored, recomputed) for every row that had
+    drifted from the raw ledgers; an empty list means they were in sync.
+    """
+    with transaction() as cursor:
+        stored = _aggregate_rows(cursor)
+        for sql in _ledger_sql(_REBUILD_AGGREGATES + _REBUILD_ROLLUPS, _all_ledger_rows()):
+            cursor.execute(sql)
+        actual = _aggregate_rows(cursor)
+    return [(table, key, stored.get((table, key)), actual.get((table, key)))
+            for table, key in sorted(stored.keys() | actual.keys(), key=str)
+            if stored.get((table, key)) != actual.get((table, key))]
+
+# Stock journal
+#
+# Every stock change made through this module is appended to stock_movements
+# in the same transaction (_log_stock). On the first movement of each day
+# (UTC, like CURRENT_TIMESTAMP) and every SNAPSHOT_EVERY movements, the
+# journal is consolidated into a snapshot: the previous snapshot plus the
+# movements since, per product. The stock at any moment is then the nearest
+# earlier snapshot plus the movements between the two, never a full replay.
+def _log_stock(cursor, deltas, reason, ref=None):
+    """Appends {product_id: stock delta} to the journal; zero deltas are skipped."""
+    rows = [(product_id, delta, reason, ref) for product_id, delta in deltas.items() if delta]
+    if not rows:
+        return
+    due = cursor.execute('''
+        SELECT taken_at < date('now') OR (SELECT COALESCE(MAX(id), 0) FROM stock_movements) - last_movement >= ?
+        FROM stock_snapshots WHERE id = (SELECT MAX(id) FROM stock_snapshots)
+    ''', (SNAPSHOT_EVERY,)).fetchone()
+    if due is None or due[0]:
+        _take_snapshot(cursor)
+    cursor.executemany("INSERT INTO stock_movements (product_id, delta, reason, ref) VALUES (?, ?, ?, ?)", rows)
+
+def _take_snapshot(cursor):
+    previous = cursor.execute('''
+        SELECT id, last_movement FROM stock_snapshots WHERE id = (SELECT MAX(id) FROM stock_snapshots)
+    ''').fetchone() or (0, 0)
+    last = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM stock_movements").fetchone()[0]
+    cursor.execute("INSERT INTO stock_snapshots (last_movement) VALUES (?)", (last,))
+    snapshot_id = cursor.lastrowid
+    cursor.execute('''
+        INSERT INTO stock_snapshot_items (snapshot_id, product_id, stock)
+        SELECT ?, product_id, SUM(stock) FROM (
+            SELECT product_id, stock FROM stock_snapshot_items WHERE snapshot_id = ?
+            UNION ALL
+            SELECT product_id, delta FROM stock_movements WHERE id > ? AND id <= ?
+        ) GROUP BY product_id
+        HAVING product_id IN (SELECT id FROM products)
+    ''', (snapshot_id, previous[0], previous[1], last))
+    return snapshot_id
+
+def take_stock_snapshot():
+    """Consolidates the journal into a new snapshot right away; returns its id."""
+    with transaction(immediate=True) as cursor:
+        return _take_snapshot(cursor)
+
+def get_stock_at(product_id, when):
+    """Stock of product_id at `when` ('YYYY-MM-DD HH:MM:SS' UTC; a bare date means the end of that day).
+
+    None if `when` predates the journal (the stock kept before it was added).
+    """
+    if len(when) == 10:
+        when += " 23:59:59"
+    conn = get_connection()
+    snapshot = conn.execute('''
+        SELECT id, taken_at, last_movement FROM stock_snapshots
+        WHERE taken_at <= ? ORDER BY taken_at DESC, id DESC LIMIT 1
+    ''', (when,)).fetchone()
+    if snapshot is None:
+        return None
+    snapshot_id, taken_at, last_movement = snapshot
+    base = conn.execute("SELECT stock FROM stock_snapshot_items WHERE snapshot_id = ? AND product_id = ?",
+                        (snapshot_id, product_id)).fetchone()
+    moved = conn.execute('''
+        SELECT COALESCE(SUM(delta), 0) FROM stock_movements
+        WHERE product_id = ? AND moved_at >= ? AND moved_at <= ? AND id > ?
+    ''', (product_id, taken_at, when, last_movement)).fetchone()[0]
+    return (base[0] if base else 0) + moved
+
+def get_stock_movements(product_id, limit=50):
+    """[(id, delta, reason, ref, moved_at)] of a product, newest first."""
+    return _query('''
+        SELECT id, delta, reason, ref, moved_at FROM stock_movements
+        WHERE product_id = ? ORDER BY moved_at DESC, id DESC LIMIT ?
+    ''', (product_id, limit))
+
+def get_stock_drift():
+    """[(id, name, stock, journal stock)] of every product whose stock doesn't match its journal.
+
+    Drift means stock was changed behind this module's back (another tool
+    editing the file, or a code path that forgot _log_stock).
+    """
+    return _query('''
+        WITH latest AS (SELECT id, last_movement FROM stock_snapshots WHERE id = (SELECT MAX(id) FROM stock_snapshots)),
+        journal AS (
+            SELECT product_id, SUM(stock) AS stock FROM (
+                SELECT product_id, stock FROM stock_snapshot_items WHERE snapshot_id = (SELECT id FROM latest)
+                UNION ALL
+                SELECT product_id, delta FROM stock_movements WHERE id > (SELECT last_movement FROM latest)
+            ) GROUP BY product_id
+        )
+        SELECT p.id, p.name, p.stock, COALESCE(j.stock, 0) FROM products p
+        LEFT JOIN journal j ON j.product_id = p.id
+        WHERE abs(p.stock - COALESCE(j.stock, 0)) > 1e-6
+        ORDER BY p.id
+    ''')
+
+def reconcile_stock(reason="AJUSTE"):
+    """Journals the current drift as movements so the journal matches products.stock again; returns the drift."""
+    with transaction(immediate=True) as cursor:
+        drift = get_stock_drift()
+        _log_stock(cursor, {pid: stock - journal for pid, _, stock, journal in drift}, reason)
+    return drift
+
+# Yearly archives
+#
+# archive_year(2024) moves that year's sales, payments and purchases into
+# afterword_2024.db (next to the main file) and registers it in `archives`.
+# Every connection ATTACHes the registered files as archive_<year>; the
+# history reads add an archive to their UNION only when the requested date
+# range reaches into that year. The running totals (ledger_totals,
+# user_totals, daily and per-product rollups) keep counting archived rows,
+# so summaries and analytics don't change when a year is archived.
+_ARCHIVE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS {db}.sales (id INTEGER PRIMARY KEY, product_id INTEGER NOT NULL, user_id INTEGER,
+        quantity INTEGER NOT NULL, total_price REAL NOT NULL, sale_date TIMESTAMP, method TEXT NOT NULL DEFAULT 'Efectivo')""",
+    """CREATE TABLE IF NOT EXISTS {db}.payments (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, amount REAL NOT NULL,
+        method TEXT NOT NULL, payment_date TIMESTAMP)""",
+    """CREATE TABLE IF NOT EXISTS {db}.purchases (id INTEGER PRIMARY KEY, product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL, cost_price REAL NOT NULL, purchase_date TIMESTAMP)""",
+    "CREATE INDEX IF NOT EXISTS {db}.idx_sales_user_date ON sales (user_id, sale_date, product_id, quantity, total_price)",
+    "CREATE INDEX IF NOT EXISTS {db}.idx_sales_date ON sales (sale_date)",
+    "CREATE INDEX IF NOT EXISTS {db}.idx_payments_user_date ON payments (user_id, payment_date, amount, method)",
+    "CREATE INDEX IF NOT EXISTS {db}.idx_payments_date ON payments (payment_date)",
+    "CREATE INDEX IF NOT EXISTS {db}.idx_purchases_date ON purchases (purchase_date)",
+    "CREATE INDEX IF NOT EXISTS {db}.idx_purchases_product ON purchases (product_id, id)",
+)
+
+def archive_path(year):
+    """File an archived year lives in: afterword.db -> afterword_2024.db."""
+    return f"{os.path.splitext(DB_NAME)[0]}_{year}.db"
+
+def _archive_file(path):
+    # Registered paths are relative to the main file, so the folder can be moved as a whole
+    return os.path.join(os.path.dirname(os.path.abspath(DB_NAME)), path)
+
+def _attach(conn, year, path):
+    alias = f"archive_{int(year)}"
+    if alias not in {row[1] for row in conn.execute("PRAGMA database_list")}:
+        conn.execute(f"ATTACH DATABASE ? AS {alias}", (_archive_file(path),))
+    return alias
+
+def _attach_archives(conn):
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archives'").fetchone():
+        for year, path in conn.execute("SELECT year, path FROM archives WHERE year > 0"):
+            _attach(conn, year, path)
+
+def _ledger_tables(table, since=None, until=None):
+    """`table` plus the archived copies ('archive_2024.sales', ...) that may hold rows dated in [since, until]."""
+    first = int(since[:4]) if since else 0
+    last = int(until[:4]) if until else 9999
+    conn = get_connection()
+    return [table] + [f"{_attach(conn, year, path)}.{table}" for year, path in
+                      conn.execute("SELECT year, path FROM archives WHERE year BETWEEN ? AND ?", (first, last))]
+
+def _all_ledger_rows():
+    """{sales}/{payments}/{purchases} sources spanning the hot tables and every archive."""
+    sources = {}
+    for table, columns in LEDGER_COLUMNS.items():
+        tables = _ledger_tables(table)
+        if len(tables) == 1:
+            sources[table] = table
+        else:
+            select = f"SELECT {', '.join(columns)} FROM "
+            sources[table] = "(" + " UNION ALL ".join(select + t for t in tables) + ")"
+    return sources
+
+def get_archives():
+    """[(year, path, sales, payments, purchases)] of every archived year, oldest first."""
+    return _query("SELECT year, path, sales, payments, purchases FROM archives WHERE year > 0 ORDER BY year")
+
+def get_oldest_ledger_year():
+    """Year of the oldest sale, payment or purchase still in the main file (None if there are none)."""
+    dates = [get_connection().execute(f"SELECT MIN({column}) FROM {table}").fetchone()[0]
+             for table, column in LEDGER_DATES.items()]
+    dates = [d for d in dates if d]
+    return int(min(dates)[:4]) if dates else None
+
+def archive_year(year, vacuum=True):
+    """Moves the sales, payments and purchases dated in `year` to archive_path(year).
+
+    Only closed years (before the current one) can be archived. Archiving the
+    same year again moves rows added since. Rows are copied and committed to
+    the archive first, then deleted from the main file and the year
+    registered in a second transaction. A crash in between leaves an
+    unregistered copy that reads ignore and the next run overwrites. Returns
+    {table: rows moved}.
+    """
+    year = int(year)
+    if year >= int(time.strftime("%Y")):
+        raise ValueError(f"Solo se pueden archivar años cerrados: {year}")
+    conn = get_connection()
+    if conn.in_transaction:
+        raise RuntimeError("archive_year no puede correr dentro de una transacción")
+    path = os.path.basename(archive_path(year))
+    alias = _attach(conn, year, path)
+    start, end = f"{year}-01-01", f"{year + 1}-01-01"
+
+    with transaction(immediate=True) as cursor:
+        for sql in _ARCHIVE_SCHEMA:
+            cursor.execute(sql.format(db=alias))
+        for table, columns in LEDGER_COLUMNS.items():
+            cursor.execute(f"""INSERT OR REPLACE INTO {alias}.{table} ({', '.join(columns)})
+                SELECT {', '.join(columns)} FROM main.{table} WHERE {LEDGER_DATES[table]} >= ? AND {LEDGER_DATES[table]} < ?""",
+                (start, end))
+
+    moved = {}
+    with transaction(immediate=True) as cursor:
+        for table in LEDGER_COLUMNS:
+            # Only rows that made it into the archive (not ones backdated into the year meanwhile)
+            cursor.execute(f"""DELETE FROM main.{table} WHERE {LEDGER_DATES[table]} >= ? AND {LEDGER_DATES[table]} < ?
+                AND id IN (SELECT id FROM {alias}.{table})""", (start, end))
+            moved[table] = cursor.rowcount
+        counts = [cursor.execute(f"SELECT COUNT(*) FROM {alias}.{table}").fetchone()[0] for table in LEDGER_COLUMNS]
+        cursor.execute("INSERT OR REPLACE INTO archives (year, path, sales, payments, purchases) VALUES (?, ?, ?, ?, ?)",
+                       (year, path, *counts))
+        _emit(events.LedgersArchived(year))
+    if vacuum:
+        conn.execute("VACUUM main")
+    return moved
+
+# Every public function is timed (see diagnostics.py), except the plumbing called per query
+_UNTIMED = {"connect_db", "get_connection", "close_connections", "configure", "transaction",
+            "history_key", "sales_history_key", "cache_stats", "archive_path"}
+for _name, _fn in list(globals().items()):
+    if inspect.isfunction(_fn) and _fn.__module__ == __name__ and not _name.startswith("_") and _name not in _UNTIMED:
+        globals()[_name] = diagnostics.timed(_name, _fn)
+
 if __name__ == "__main__":
     init_db()
     print("Database initialized.")
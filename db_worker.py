@@ -0,0 +1,102 @@
+# Background database executor for the Tk app
+import queue
+import threading
+from concurrent.futures import Future
+
+import database
+
+class DBExecutor:
+    """Runs database.py calls on a single worker thread, off the Tk main loop.
+
+    Jobs run strictly in submission order, so a read submitted after a write
+    sees that write. The worker thread owns its own pooled connection (see
+    database.get_connection). Results come back to the Tk thread through a
+    queue polled with after(); callbacks therefore always run on the Tk thread
+    and may touch widgets.
+    """
+
+    def __init__(self, root, poll_ms=15):
+        self.root = root
+        self.poll_ms = poll_ms
+        self._jobs = queue.Queue()
+        self._done = queue.Queue()
+        self._calls = queue.Queue()  # see call_soon()
+        self._pending = 0
+        self._polling = False
+        self._thread = threading.Thread(target=self._run, name="db-worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, on_done=None, on_error=None, **kwargs):
+        """Queues fn(*args, **kwargs); on_done(result) / on_error(exc) run later on the Tk thread."""
+        future = Future()
+        self._jobs.put((fn, args, kwargs, future, on_done, on_error))
+        self._pending += 1
+        if not self._polling:
+            self._polling = True
+            self.root.after(self.poll_ms, self._poll)
+        return future
+
+    def call_soon(self, fn, *args):
+        """Runs fn(*args) on the Tk thread: right away if called there, else at the next poll.
+
+        Used to hand events.* notifications published by a job (on the worker
+        thread) to the widgets; they run before that job's on_done.
+        """
+        if threading.current_thread() is self._thread:
+            self._calls.put((fn, args))  # a job is running, so polling is active
+        else:
+            fn(*args)
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            fn, args, kwargs, future, on_done, on_error = job
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+            self._done.put((future, on_done, on_error))
+        database.close_connections()
+
+    def _poll(self):
+        while True:
+            self._drain_calls()  # queued before the result of the job that made them
+            try:
+                future, on_done, on_error = self._done.get_nowait()
+            except queue.Empty:
+                break
+            self._pending -= 1
+            if future.cancelled():
+                continue
+            error = future.exception()
+            if error is not None:
+                if on_error:
+                    on_error(error)
+                else:
+                    self.root.report_callback_exception(type(error), error, error.__traceback__)
+            elif on_done:
+                on_done(future.result())
+        if self._pending > 0:
+            self.root.after(self.poll_ms, self._poll)
+        else:
+            self._polling = False
+
+    def _drain_calls(self):
+        while True:
+            try:
+                fn, args = self._calls.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                fn(*args)
+            except Exception as e:
+                self.root.report_callback_exception(type(e), e, e.__traceback__)
+
+    def shutdown(self, wait=True):
+        """Lets queued jobs (e.g. pending writes) finish, then stops the worker."""
+        self._jobs.put(None)
+        if wait:
+            self._thread.join()
@@ -0,0 +1,149 @@
+# Timings for database.py operations, a slow-query log and the Tk loop lag
+#
+# database.py wraps its public functions with timed(); main.py feeds the
+# event-loop lag with record() and shows snapshot() on the hidden
+# diagnostics screen (Ctrl+Shift+D).
+#
+# With AFTERWORD_TRACE_SQL=1 every connection also traces its statements
+# (trace_statement), so slow-log entries list the SQL each slow operation
+# ran. It is off by default: the trace callback costs more than the timing.
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+
+SLOW_MS = 100.0                    # operations slower than this go to the slow-query log
+SLOW_LOG = "slow_queries.log"
+TRACE_SQL = bool(os.environ.get("AFTERWORD_TRACE_SQL"))
+BOUNDS = [0.05 * 2 ** i for i in range(20)]  # histogram bucket upper bounds in ms (50 µs .. ~26 s)
+
+_lock = threading.Lock()
+_stats = {}               # name -> Histogram
+_local = threading.local()
+slow_log = logging.getLogger("afterword.slow")
+
+class Histogram:
+    """Latency histogram with power-of-two buckets, plus call and row totals."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+
+    def add(self, ms, rows=0):
+        index = 0
+        while index < len(BOUNDS) and ms > BOUNDS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.rows += rows
+
+    def percentile(self, p):
+        """Upper bound (ms) of the bucket holding the p-th percentile; exact max for the last one."""
+        if not self.count:
+            return 0.0
+        wanted, seen = p / 100 * self.count, 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= wanted:
+                return min(BOUNDS[index], self.max_ms) if index < len(BOUNDS) else self.max_ms
+        return self.max_ms
+
+def record(name, ms, rows=0):
+    with _lock:
+        histogram = _stats.get(name)
+        if histogram is None:
+            histogram = _stats[name] = Histogram()
+        histogram.add(ms, rows)
+
+def snapshot():
+    """[(name, calls, p50 ms, p99 ms, max ms, rows)], slowest p99 first."""
+    with _lock:
+        rows = [(name, h.count, h.percentile(50), h.percentile(99), h.max_ms, h.rows) for name, h in _stats.items()]
+    return sorted(rows, key=lambda r: -r[3])
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+def trace_statement(sql):
+    """sqlite3 trace callback: remembers when each statement of the running operation started."""
+    statements = getattr(_local, "statements", None)
+    if statements is not None:
+        statements.append((time.perf_counter(), sql))
+
+def _count(result):
+    return len(result) if isinstance(result, list) else 0
+
+def _finish(name, args, started, outer, rows):
+    ms = (time.perf_counter() - started) * 1000
+    record(name, ms, rows)
+    if outer:
+        statements, _local.statements = _local.statements, None
+        if ms >= SLOW_MS:
+            _log_slow(name, args, ms, started, statements)
+
+def _log_slow(name, args, ms, started, statements):
+    path = os.path.abspath(SLOW_LOG)
+    if not any(getattr(h, "baseFilename", None) == path for h in slow_log.handlers):
+        for handler in list(slow_log.handlers):  # SLOW_LOG was changed since
+            slow_log.removeHandler(handler)
+            handler.close()
+        handler = logging.FileHandler(path, encoding="utf-8", delay=True)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        slow_log.addHandler(handler)
+        slow_log.setLevel(logging.INFO)
+        slow_log.propagate = False
+    # A statement's time is approximated by the gap to the next one (or to the end of the call)
+    ends = [at for at, _ in statements[1:]] + [started + ms / 1000]
+    shown = ", ".join(repr(a) for a in args)
+    lines = [f"{name}({shown[:200]}): {ms:.1f} ms" + (f", {len(statements)} sentencias" if statements else "")]
+    for (at, sql), end in zip(statements, ends):
+        lines.append(f"    {(end - at) * 1000:8.1f} ms  {' '.join(sql.split())[:300]}")
+    slow_log.info("\n".join(lines))
+
+def _timed_items(name, items):
+    spent, rows = 0.0, 0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                spent += time.perf_counter() - started
+            rows += 1
+            yield item
+    finally:
+        record(name, spent * 1000, rows)
+
+def timed(name, fn):
+    """Wraps fn so each call is recorded under `name`.
+
+    A call returning a generator is recorded once it is exhausted (or
+    dropped): only the time spent producing items counts, not the caller's
+    work between them, and rows is the number of items.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        outer = getattr(_local, "statements", None) is None
+        if outer:
+            _local.statements = []
+        started, result = time.perf_counter(), None
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            if inspect.isgenerator(result):
+                if outer:
+                    _local.statements = None
+            else:
+                _finish(name, args, started, outer, _count(result))
+        return _timed_items(name, result) if inspect.isgenerator(result) else result
+    return wrapper
@@ -0,0 +1,51 @@
+# In-process change notifications
+#
+# database.py publishes one of these after each write commits (never for a
+# rolled back transaction). Screens subscribe to the types they show and
+# re-read just the ids in the event instead of reloading whole tables.
+from collections import namedtuple
+import threading
+import traceback
+
+ProductsAdded = namedtuple("ProductsAdded", "ids")         # inserted
+ProductsChanged = namedtuple("ProductsChanged", "ids")     # edited (name, price, cost, ...)
+StockChanged = namedtuple("StockChanged", "ids")           # stock moved (sales, purchases)
+ProductsDeleted = namedtuple("ProductsDeleted", "ids")
+RecipeChanged = namedtuple("RecipeChanged", "product_id")
+UsersChanged = namedtuple("UsersChanged", "ids")           # inserted or edited
+BalanceChanged = namedtuple("BalanceChanged", "ids")       # wallet balance moved (sales, payments)
+UsersDeleted = namedtuple("UsersDeleted", "ids")
+SaleRecorded = namedtuple("SaleRecorded", "user_id lines")  # lines: [(product_id, quantity, total_price), ...]
+PaymentRecorded = namedtuple("PaymentRecorded", "user_id amount method")
+PurchaseRecorded = namedtuple("PurchaseRecorded", "product_id quantity cost")
+TablesImported = namedtuple("TablesImported", "tables")   # bulk load (bulk.py): re-read everything shown
+LedgersArchived = namedtuple("LedgersArchived", "year")    # a closed year moved to its archive file
+
+_subscribers = {}  # event type -> [callback, ...]
+_lock = threading.Lock()
+
+def subscribe(event_type, callback):
+    """Calls callback(event) for every published event of that type; returns callback."""
+    with _lock:
+        _subscribers.setdefault(event_type, []).append(callback)
+    return callback
+
+def unsubscribe(event_type, callback):
+    with _lock:
+        callbacks = _subscribers.get(event_type, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+def publish(event):
+    """Delivers event to its subscribers, in the publishing thread.
+
+    The write behind it has already committed, so a failing subscriber is
+    reported and skipped rather than raised to the writer.
+    """
+    with _lock:
+        callbacks = list(_subscribers.get(type(event), ()))
+    for callback in callbacks:
+        try:
+            callback(event)
+        except Exception:
+            traceback.print_exc()
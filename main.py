@@ -1,33 +1,63 @@
+import time
+_STARTED = time.perf_counter()  # startup timings are measured from here (see mark_startup)
+
 import tkinter as tk
-from tkinter import messagebox, ttk
+from tkinter import messagebox, ttk, filedialog
 import customtkinter as ctk
-from PIL import Image, ImageTk
 import os
+import sys
 from database import (init_db, add_product, get_products, update_product, delete_product, 
-                      record_sale, get_sales_history, add_user, get_users, update_user_balance, delete_user,
-                      record_payment, get_combined_history, record_purchase, get_financial_summary,
-                      add_recipe_item, get_recipe, delete_recipe, update_ingredient_unit_cost, get_user_purchases)
+                      record_sales_batch, add_user, get_users, delete_user,
+                      record_payment, record_purchase, get_financial_summary,
+                      set_recipe, get_recipe, update_ingredient_unit_cost,
+                      get_user_financial_totals, get_products_page, get_users_page, history_key,
+                      get_combined_history_page, HISTORY_KINDS, get_user_financial_history_page,
+                      get_products_by_ids, get_users_by_ids, get_change_counters, get_sale_items, SaleItem)
 from styles import Styles, apply_theme
+from widgets import PickList, VirtualTable, ViewManager
+from search import product_catalog, user_catalog, Debouncer
+from db_worker import DBExecutor
+from costing import CostEngine
+import events
+import bulk
+import analytics
+import diagnostics
+import database
+import backup
+
+_IMPORTED = time.perf_counter()
+
+# `python main.py --timings` (or AFTERWORD_TIMINGS=1) prints how long each startup phase took
+SHOW_TIMINGS = "--timings" in sys.argv or bool(os.environ.get("AFTERWORD_TIMINGS"))
+BACKUP_INTERVAL = 2 * 60 * 60  # seconds between automatic backups while the app is open
 
 class AfterwordApp(ctk.CTk):
     def __init__(self):
         super().__init__()
+        self.startup_timings = {"imports": round((_IMPORTED - _STARTED) * 1000, 1)}
+        if SHOW_TIMINGS:
+            print(f"[inicio] imports: {self.startup_timings['imports']} ms")
 
-        # Database and Theme
-        init_db()
+        # Theme
         apply_theme()
 
+        # All screen reads and every write go through this worker thread.
+        # init_db is queued first, so every later job sees the final schema;
+        # on a current database it is a single PRAGMA read.
+        self.db = DBExecutor(self)
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.run_db(init_db, on_done=lambda _: self.mark_startup("db_ready"),
+                    error_msg="No se pudo abrir la base de datos")
+
+        # Search indexes (synced lazily with the DB change counters)
+        self.product_catalog = product_catalog()
+        self.user_catalog = user_catalog()
+        self.cost_engine = CostEngine()
+
         self.title("MILITAR BOX AFTERWORD")
         self.geometry("1300x850") 
         self.configure(fg_color=Styles.BG_COLOR)
         
-        # Set window icon
-        icon_path = os.path.join("assets", "logo.png")
-        if os.path.exists(icon_path):
-            try:
-                self.iconbitmap(icon_path) if icon_path.endswith('.ico') else self.tk.call('wm', 'iconphoto', self._w, tk.PhotoImage(file=icon_path))
-            except: pass
-
         # Layout
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(0, weight=1)
@@ -36,8 +66,9 @@ class AfterwordApp(ctk.CTk):
         self.sidebar = ctk.CTkFrame(self, width=240, corner_radius=0, fg_color=Styles.SIDEBAR_COLOR, border_width=0)
         self.sidebar.grid(row=0, column=0, sticky="nsew")
         
-        # Logo Integration
-        self.load_logo()
+        # Logo Integration (text until the image is decoded, see load_logo)
+        self.logo_label = ctk.CTkLabel(self.sidebar, text="MILITAR BOX\nAFTERWORD", font=Styles.FONT_HEADER, text_color=Styles.ACCENT_COLOR)
+        self.logo_label.pack(pady=(50, 40), padx=20)
 
         # Navigation
         self.create_nav_button("📦  INVENTARIO", self.show_inventory)
@@ -49,23 +80,70 @@ class AfterwordApp(ctk.CTk):
         # Main Content Area
         self.main_container = ctk.CTkFrame(self, corner_radius=0, fg_color="transparent")
         self.main_container.grid(row=0, column=1, sticky="nsew", padx=40, pady=30)
-        
+        self.register_views()
+        self.subscribe_events()
+        self.bind_all("<Control-D>", lambda e: self.show_diagnostics())  # Ctrl+Shift+D, hidden screen
+        self.mark_startup("shell")
+
+        # The shell is drawn on the first pass of the event loop; the first screen and images come after
+        self.after(0, self.finish_startup)
+
+    def finish_startup(self):
+        self.mark_startup("first_frame")
         self.show_inventory()
+        self.mark_startup("first_screen")
+        self.after_idle(self.load_logo)
+        self.watch_loop_lag()
+        self.backups = backup.BackupService(BACKUP_INTERVAL).start()
+
+    LAG_TICK_MS = 100
+
+    def watch_loop_lag(self, expected=None):
+        """Records how late each after() tick fires: time the Tk loop spent busy elsewhere."""
+        now = time.perf_counter()
+        if expected is not None:
+            diagnostics.record("tk_loop_lag", max(0.0, (now - expected) * 1000))
+        self.after(self.LAG_TICK_MS, self.watch_loop_lag, now + self.LAG_TICK_MS / 1000)
+
+    def mark_startup(self, phase):
+        """Records the ms elapsed since the process started for a startup phase."""
+        self.startup_timings[phase] = round((time.perf_counter() - _STARTED) * 1000, 1)
+        if SHOW_TIMINGS:
+            print(f"[inicio] {phase}: {self.startup_timings[phase]} ms")
+
+    def on_close(self):
+        self.db.shutdown()  # let queued writes finish
+        if hasattr(self, "backups"):
+            self.backups.stop(timeout=5)  # an unfinished copy stays as .part and is cleaned up later
+        self.destroy()
+
+    def run_db(self, fn, *args, on_done=None, owner=None, error_msg="Error"):
+        """Runs fn on the DB worker; on_done(result) runs on the Tk thread unless `owner` was destroyed."""
+        def done(result):
+            if on_done and (owner is None or owner.winfo_exists()):
+                on_done(result)
+        def failed(e):
+            messagebox.showerror("Error", f"{error_msg}: {str(e)}")
+        return self.db.submit(fn, *args, on_done=done, on_error=failed)
 
     def load_logo(self):
+        # Deferred until the first screen is up: PIL and the PNG decode are the slowest part of startup
         logo_path = os.path.join("assets", "logo.png")
         if os.path.exists(logo_path):
             try:
+                from PIL import Image
                 img = Image.open(logo_path)
                 # Resize to fit sidebar width nicely
                 self.logo_img = ctk.CTkImage(light_image=img, dark_image=img, size=(180, 180))
-                self.logo_label = ctk.CTkLabel(self.sidebar, text="", image=self.logo_img)
+                self.logo_label.configure(text="", image=self.logo_img)
             except Exception as e:
-                self.logo_label = ctk.CTkLabel(self.sidebar, text="MILITAR BOX\nAFTERWORD", font=Styles.FONT_HEADER, text_color=Styles.ACCENT_COLOR)
-        else:
-            self.logo_label = ctk.CTkLabel(self.sidebar, text="MILITAR BOX\nAFTERWORD", font=Styles.FONT_HEADER, text_color=Styles.ACCENT_COLOR)
-        
-        self.logo_label.pack(pady=(50, 40), padx=20)
+                pass  # keep the text logo
+
+            # Set window icon
+            try:
+                self.tk.call('wm', 'iconphoto', self._w, tk.PhotoImage(file=logo_path))
+            except: pass
+        self.mark_startup("logo")
 
     def create_nav_button(self, text, command):
         btn = ctk.CTkButton(
@@ -78,9 +156,149 @@ class AfterwordApp(ctk.CTk):
         )
         btn.pack(fill="x", padx=0, pady=2)
 
-    def clear_container(self):
-        for widget in self.main_container.winfo_children():
-            widget.destroy()
+    # Screens are built once by the view manager and kept alive; each refresh
+    # only runs when one of the change counters it depends on moved.
+    def register_views(self):
+        self.views = ViewManager(self.main_container, lambda parent: ctk.CTkFrame(parent, fg_color="transparent"),
+                                 get_change_counters, executor=self.db)
+        self.views.register("inventory", self.build_inventory, self.load_products, ["products", "recipes"])
+        self.views.register("users", self.build_users, self.load_users, ["users"])
+        self.views.register("sales", self.build_sales, lambda: self.refresh_sales(), ["products", "users"])
+        self.views.register("summary", self.build_financial_summary, self.refresh_financial_summary,
+                            ["ledger", "users", "recipes", "costs"])
+        self.views.register("history", self.build_history, lambda: self.history_table.reload(),
+                            ["ledger", "product_names", "user_names"])
+        self.views.register("diagnostics", self.build_diagnostics)
+
+    # Writes publish events.* notifications; built screens patch just the rows they name
+    def subscribe_events(self):
+        def on_tk(event_type, handler):
+            events.subscribe(event_type, lambda event: self.db.call_soon(handler, event))
+        on_tk(events.ProductsAdded, lambda e: self.patch_products(e.ids, new_rows=True))
+        on_tk(events.ProductsChanged, lambda e: self.patch_products(e.ids))
+        on_tk(events.StockChanged, lambda e: self.patch_products(e.ids))
+        on_tk(events.ProductsDeleted, self.remove_products)
+        on_tk(events.UsersChanged, lambda e: self.patch_users(e.ids, new_rows=True))
+        on_tk(events.BalanceChanged, lambda e: self.patch_users(e.ids))
+        on_tk(events.UsersDeleted, self.remove_users)
+        for ledger_event in (events.SaleRecorded, events.PaymentRecorded, events.PurchaseRecorded, events.LedgersArchived):
+            on_tk(ledger_event, self.on_ledger_changed)
+        on_tk(events.TablesImported, self.on_tables_imported)
+        for cost_event in (events.ProductsAdded, events.ProductsChanged, events.ProductsDeleted,
+                           events.RecipeChanged, events.LedgersArchived):
+            on_tk(cost_event, self.on_costs_changed)
+
+    def built(self, attribute):
+        widget = getattr(self, attribute, None)
+        return widget is not None and widget.winfo_exists()
+
+    def patch_products(self, ids, new_rows=False):
+        if self.built("tree") or self.built("cart_tree"):
+            self.run_db(get_products_by_ids, ids, on_done=lambda rows: self.apply_products(rows, new_rows))
+
+    def apply_products(self, rows, new_rows):
+        if self.built("tree"):
+            unseen = [row for row in rows if not self.product_table.update_row(row)]
+            if unseen and new_rows:
+                self.load_products()  # a new product: let the table place it in order
+        if self.built("cart_tree"):
+            ids = {p.id for p in rows}
+            if all(p.type == "INSUMO" for p in rows) and not any(p.id in ids for p in self.all_products):
+                return  # e.g. an insumo's unit cost: nothing the sales screen lists
+            by_id = {p.id: SaleItem(p.id, p.name, p.price, p.stock, p.type) for p in rows if p.type != "INSUMO"}
+            self.all_products = [by_id.pop(p.id, p) for p in self.all_products
+                                 if p.id in by_id or p.id not in ids] + list(by_id.values())
+            self.update_sales_combos()
+
+    def remove_products(self, event):
+        if self.built("tree"):
+            for pid in event.ids:
+                self.product_table.remove_row(pid)
+        if self.built("cart_tree"):
+            self.all_products = [p for p in self.all_products if p.id not in event.ids]
+            self.update_sales_combos()
+
+    def patch_users(self, ids, new_rows=False):
+        if self.built("user_tree") or self.built("cart_tree"):
+            self.run_db(get_users_by_ids, ids, on_done=lambda rows: self.apply_users(rows, new_rows))
+
+    def apply_users(self, rows, new_rows):
+        if self.built("user_tree"):
+            unseen = [row for row in rows if not self.user_table.update_row(row)]
+            if unseen and new_rows:
+                self.load_users()
+        if self.built("cart_tree"):
+            by_id = {u.id: u for u in rows}
+            self.all_users = [by_id.pop(u.id, u) for u in self.all_users] + list(by_id.values())
+            self.set_sales_users()
+
+    def remove_users(self, event):
+        if self.built("user_tree"):
+            for uid in event.ids:
+                self.user_table.remove_row(uid)
+        if self.built("cart_tree"):
+            self.all_users = [u for u in self.all_users if u.id not in event.ids]
+            self.set_sales_users()
+
+    def set_sales_users(self):
+        # Keep the selected user selected even though the label shows the (new) balance
+        selected = self.user_combo.get()
+        index = self.sales_user_names.index(selected) if selected in self.sales_user_names else 0
+        selected_id = self.sales_user_ids[index - 1] if index > 0 else None
+        self.sales_user_names[1:] = [f"{u.name} (Saldo: ${u.balance:.2f})" for u in self.all_users]
+        self.sales_user_ids = [u.id for u in self.all_users]
+        self.user_combo.configure(values=self.sales_user_names)
+        if selected_id in self.sales_user_ids:
+            self.user_combo.set(self.sales_user_names[self.sales_user_ids.index(selected_id) + 1])
+        else:
+            self.user_combo.set(self.sales_user_names[0])
+
+    def on_ledger_changed(self, event):
+        if self.built("summary_tree"):
+            self.refresh_financial_summary()
+        if self.views.current == "history":
+            self.history_table.reload()
+
+    def on_costs_changed(self, event):
+        if self.built("margin_tree"):
+            self.refresh_financial_summary()
+
+    def on_tables_imported(self, event):
+        # A bulk load can touch any row: reload what is built
+        if self.built("tree"):
+            self.load_products()
+        if self.built("user_tree"):
+            self.load_users()
+        if self.built("cart_tree"):
+            self.refresh_sales()
+        self.on_ledger_changed(event)
+
+    def import_products_csv(self):
+        path = filedialog.askopenfilename(title="Importar lista de productos",
+                                          filetypes=[("CSV", "*.csv"), ("JSON Lines", "*.jsonl")])
+        if not path: return
+        load = bulk.import_jsonl if path.endswith(".jsonl") else bulk.import_csv
+        self.run_db(load, "products", path, error_msg="No se pudo importar",
+                    on_done=lambda count: messagebox.showinfo("Éxito", f"{count} productos importados"))
+
+    def show_inventory(self):
+        self.views.show("inventory")
+
+    def show_users(self):
+        self.views.show("users")
+
+    def show_sales(self):
+        self.views.show("sales")
+
+    def show_financial_summary(self):
+        self.views.show("summary")
+
+    def show_diagnostics(self):
+        self.views.show("diagnostics")
+        self.render_diagnostics()
+
+    def show_history(self):
+        self.views.show("history")
 
     def create_card(self, parent, title=None):
         card = ctk.CTkFrame(
@@ -94,39 +312,40 @@ class AfterwordApp(ctk.CTk):
             title_lbl.pack(pady=(15, 10), padx=20, anchor="w")
         return card
 
-    def show_inventory(self):
-        self.clear_container()
-        header_frame = ctk.CTkFrame(self.main_container, fg_color="transparent")
+    def build_inventory(self, frame):
+        header_frame = ctk.CTkFrame(frame, fg_color="transparent")
         header_frame.pack(fill="x", pady=(0, 10))
         ctk.CTkLabel(header_frame, text="INVENTARIO DE PRODUCTOS", font=Styles.FONT_SUBHEADER).pack(side="left")
         
         ctk.CTkButton(header_frame, text="+ NUEVO PRODUCTO", command=self.open_product_window,
                      fg_color=Styles.ACCENT_COLOR, text_color="black", font=Styles.FONT_LABEL).pack(side="right")
+        ctk.CTkButton(header_frame, text="⬆ IMPORTAR CSV", command=self.import_products_csv,
+                     fg_color="transparent", border_width=1, font=Styles.FONT_LABEL).pack(side="right", padx=10)
 
         # Search Bar
-        search_frame = ctk.CTkFrame(self.main_container, fg_color="transparent")
+        search_frame = ctk.CTkFrame(frame, fg_color="transparent")
         search_frame.pack(fill="x", pady=(0, 10))
         ctk.CTkLabel(search_frame, text="🔍", font=Styles.FONT_BODY).pack(side="left", padx=(5, 5))
         self.inv_search_var = tk.StringVar()
-        self.inv_search_var.trace("w", lambda *args: self.load_products(self.inv_search_var.get()))
         search_entry = ctk.CTkEntry(search_frame, textvariable=self.inv_search_var, placeholder_text="Buscar por nombre o categoría...", width=400)
         search_entry.pack(side="left")
+        self.inv_search_var.trace("w", Debouncer(search_entry, self.load_products))
 
-        table_card = self.create_card(self.main_container)
+        table_card = self.create_card(frame)
         table_card.pack(fill="both", expand=True)
 
         columns = ("ID", "Nombre", "Precio", "Stock", "Categoría", "Tipo")
         self.tree = self.create_styled_tree(table_card, columns)
-        self.load_products()
+        self.product_table = VirtualTable(self.tree, self.fetch_products, executor=self.db, args=("",),
+                                          format_row=lambda p: (p.id, p.name, f"${p.price:.2f}", p.stock, p.category, p.type))
 
-        action_frame = ctk.CTkFrame(self.main_container, fg_color="transparent")
+        action_frame = ctk.CTkFrame(frame, fg_color="transparent")
         action_frame.pack(fill="x", pady=20)
         ctk.CTkButton(action_frame, text="✏️ Editar", command=self.edit_selected_product, width=100).pack(side="left", padx=5)
         ctk.CTkButton(action_frame, text="🗑️ Eliminar", command=self.delete_selected_product, fg_color="transparent", text_color=Styles.DANGER, width=100).pack(side="left", padx=5)
 
-    def show_users(self):
-        self.clear_container()
-        header_frame = ctk.CTkFrame(self.main_container, fg_color="transparent")
+    def build_users(self, frame):
+        header_frame = ctk.CTkFrame(frame, fg_color="transparent")
         header_frame.pack(fill="x", pady=(0, 20))
         ctk.CTkLabel(header_frame, text="USUARIOS Y CARTERA", font=Styles.FONT_SUBHEADER).pack(side="left")
         
@@ -134,15 +353,15 @@ class AfterwordApp(ctk.CTk):
                      fg_color=Styles.ACCENT_COLOR, text_color="black", font=Styles.FONT_LABEL).pack(side="right")
 
         # Search Bar for Users
-        search_frame = ctk.CTkFrame(self.main_container, fg_color="transparent")
+        search_frame = ctk.CTkFrame(frame, fg_color="transparent")
         search_frame.pack(fill="x", pady=10)
         ctk.CTkLabel(search_frame, text="🔍 Buscar Usuario:", font=Styles.FONT_LABEL).pack(side="left", padx=10)
         self.user_search_var = tk.StringVar()
-        self.user_search_var.trace("w", lambda *args: self.load_users(self.user_search_var.get()))
         search_entry = ctk.CTkEntry(search_frame, textvariable=self.user_search_var, placeholder_text="Nombre o teléfono...", width=350)
         search_entry.pack(side="left", padx=10)
+        self.user_search_var.trace("w", Debouncer(search_entry, self.load_users))
 
-        table_card = self.create_card(self.main_container)
+        table_card = self.create_card(frame)
         table_card.pack(fill="both", expand=True)
 
         ctk.CTkLabel(table_card, text="(Doble clic para ver historial detallado)", font=("Arial", 10), text_color="gray").pack(pady=2)
@@ -150,9 +369,10 @@ class AfterwordApp(ctk.CTk):
         columns = ("ID", "Nombre", "Teléfono", "Saldo (Cartera)")
         self.user_tree = self.create_styled_tree(table_card, columns)
         self.user_tree.bind("<Double-1>", lambda e: self.open_user_details_window())
-        self.load_users()
+        self.user_table = VirtualTable(self.user_tree, self.fetch_users, executor=self.db, args=("",),
+                                       format_row=lambda u: (u.id, u.name, u.phone, f"${u.balance:.2f}"))
 
-        action_frame = ctk.CTkFrame(self.main_container, fg_color="transparent")
+        action_frame = ctk.CTkFrame(frame, fg_color="transparent")
         action_frame.pack(fill="x", pady=20)
         
         ctk.CTkButton(action_frame, text="💵 Registrar Abono", command=self.open_payment_window, 
@@ -198,11 +418,13 @@ class AfterwordApp(ctk.CTk):
                 m_combo.pack(pady=10)
                 m_combo.set("Efectivo")
 
+                def settled(_):
+                    messagebox.showinfo("Éxito", "Deuda liquidada y registrada en el historial.")
+
                 def confirm():
-                    record_payment(user_data[0], abs(balance), m_combo.get())
-                    self.load_users()
+                    self.run_db(record_payment, user_data[0], abs(balance), m_combo.get(),
+                                on_done=settled, error_msg="No se pudo procesar")
                     method_win.destroy()
-                    messagebox.showinfo("Éxito", "Deuda liquidada y registrada en el historial.")
 
                 ctk.CTkButton(scroll, text="Confirmar Liquidación", command=confirm, fg_color=Styles.SUCCESS).pack(pady=10)
         except Exception as e:
@@ -224,6 +446,7 @@ class AfterwordApp(ctk.CTk):
         vsb = ttk.Scrollbar(container, orient="vertical", command=tree.yview)
         hsb = ttk.Scrollbar(container, orient="horizontal", command=tree.xview)
         tree.configure(yscrollcommand=vsb.set, xscrollcommand=hsb.set)
+        tree.vsb = vsb  # VirtualTable hooks the vertical scroll to page in rows
         
         vsb.pack(side="right", fill="y")
         hsb.pack(side="bottom", fill="x")
@@ -237,15 +460,15 @@ class AfterwordApp(ctk.CTk):
         
         return tree
 
-    def load_users(self, query=""):
-        for item in self.user_tree.get_children():
-            self.user_tree.delete(item)
-        query = query.lower()
-        for user in get_users():
-            if query in str(user[1]).lower() or query in str(user[2]).lower():
-                u_list = list(user)
-                u_list[3] = f"${u_list[3]:.2f}"
-                self.user_tree.insert("", "end", values=u_list)
+    def fetch_users(self, after, limit, query):
+        # Runs on the DB worker thread
+        if not query:
+            return get_users_page(after, limit)
+        return get_users_by_ids(self.user_catalog.page(query, after, limit))
+
+    def load_users(self):
+        self.user_table.args = (self.user_search_var.get(),)
+        self.user_table.reload()
 
     def open_user_details_window(self, user_id=None, user_name=None, balance=None, tree_to_use=None):
         if user_id is None:
@@ -268,8 +491,6 @@ class AfterwordApp(ctk.CTk):
         scroll.pack(fill="both", expand=True, padx=5, pady=5)
 
         # Summary Header Card
-        total_bought, total_paid = get_user_financial_totals(user_id)
-        
         header_card = self.create_card(scroll, f"Estado de Cuenta: {user_name}")
         header_card.pack(fill="x", padx=10, pady=10)
         
@@ -280,13 +501,21 @@ class AfterwordApp(ctk.CTk):
             f = ctk.CTkFrame(p, fg_color="transparent")
             f.pack(side="left", fill="both", expand=True)
             ctk.CTkLabel(f, text=lbl, font=("Arial", 11, "bold")).pack()
-            ctk.CTkLabel(f, text=f"${val:.2f}" if isinstance(val, (int, float)) else val, 
-                         font=Styles.FONT_SUBHEADER, text_color=color).pack()
+            value_lbl = ctk.CTkLabel(f, text=f"${val:.2f}" if isinstance(val, (int, float)) else val, 
+                                     font=Styles.FONT_SUBHEADER, text_color=color)
+            value_lbl.pack()
+            return value_lbl
 
-        add_stat(stats_frame, "Total Consumido", total_bought, Styles.TEXT_COLOR)
-        add_stat(stats_frame, "Total Abonado", total_paid, Styles.SUCCESS)
+        bought_lbl = add_stat(stats_frame, "Total Consumido", "...", Styles.TEXT_COLOR)
+        paid_lbl = add_stat(stats_frame, "Total Abonado", "...", Styles.SUCCESS)
         add_stat(stats_frame, "Saldo Pendiente", balance, Styles.ACCENT_COLOR)
 
+        def show_totals(totals):
+            total_bought, total_paid = totals
+            bought_lbl.configure(text=f"${total_bought:.2f}")
+            paid_lbl.configure(text=f"${total_paid:.2f}")
+        self.run_db(get_user_financial_totals, user_id, on_done=show_totals, owner=win)
+
         # History Table Card
         history_card = self.create_card(scroll, "Movimientos (Ventas y Abonos)")
         history_card.pack(fill="both", expand=True, padx=10, pady=10)
@@ -295,11 +524,8 @@ class AfterwordApp(ctk.CTk):
         columns = ("ID", "Tipo", "Detalle", "Info", "Monto", "Fecha")
         tree = self.create_styled_tree(history_card, columns)
         
-        history = get_user_financial_history(user_id)
-        for row in history:
-            r_list = list(row)
-            r_list[4] = f"${r_list[4]:.2f}"
-            tree.insert("", "end", values=r_list)
+        VirtualTable(tree, lambda before, limit: get_user_financial_history_page(user_id, before, limit),
+                     key=history_key, format_row=lambda r: (*r[:4], f"${r[4]:.2f}", r[5]), executor=self.db)
 
         ctk.CTkButton(win, text="Cerrar", command=win.destroy, fg_color=Styles.CARD_BG).pack(pady=10)
 
@@ -328,8 +554,7 @@ class AfterwordApp(ctk.CTk):
         def save():
             name = name_entry.get()
             if not name: return
-            add_user(name, phone_entry.get())
-            self.load_users()
+            self.run_db(add_user, name, phone_entry.get())
             win.destroy()
 
         ctk.CTkButton(scroll, text="Guardar Usuario", command=save, fg_color=Styles.ACCENT_COLOR, text_color="black").pack(pady=20)
@@ -358,15 +583,17 @@ class AfterwordApp(ctk.CTk):
         method_combo.pack(pady=10)
         method_combo.set("Efectivo")
 
+        def paid(_):
+            messagebox.showinfo("Éxito", "Abono registrado correctamente")
+
         def pay():
             try:
                 amt = float(amt_entry.get())
-                record_payment(user_data[0], amt, method_combo.get())
-                self.load_users()
-                win.destroy()
-                messagebox.showinfo("Éxito", "Abono registrado correctamente")
             except Exception as e:
                 messagebox.showerror("Error", "Monto inválido")
+                return
+            self.run_db(record_payment, user_data[0], amt, method_combo.get(), on_done=paid)
+            win.destroy()
 
         ctk.CTkButton(scroll, text="Confirmar Abono", command=pay, fg_color=Styles.SUCCESS).pack(pady=20)
 
@@ -375,13 +602,11 @@ class AfterwordApp(ctk.CTk):
         if not selected: return
         uid = self.user_tree.item(selected[0])['values'][0]
         if messagebox.askyesno("Confirmar", "¿Eliminar usuario?"):
-            delete_user(uid)
-            self.load_users()
+            self.run_db(delete_user, uid)
 
-    def show_sales(self):
-        self.clear_container()
+    def build_sales(self, frame):
         
-        scroll = ctk.CTkScrollableFrame(self.main_container, fg_color="transparent")
+        scroll = ctk.CTkScrollableFrame(frame, fg_color="transparent")
         scroll.pack(fill="both", expand=True)
 
         ctk.CTkLabel(scroll, text="REGISTRAR NUEVA VENTA", font=Styles.FONT_SUBHEADER).pack(pady=(0, 20), anchor="w")
@@ -389,18 +614,20 @@ class AfterwordApp(ctk.CTk):
         sales_card = self.create_card(scroll)
         sales_card.pack(pady=10, fill="both", expand=True)
 
-        # Only allow selling "Productos" and "Productos Compuestos"
-        self.all_products = [p for p in get_products() if p[5] != "INSUMO"]
-        self.all_users = get_users()
+        # Filled in by show_sales_data() once the worker has read them
+        self.all_products = []
+        self.sales_shown = []  # the products behind prod_combo's values
+        self.all_users = []
+        self.sales_user_ids = []  # ids behind self.sales_user_names[1:]
         
         # Row 0: Search Product
         r0 = ctk.CTkFrame(sales_card, fg_color="transparent")
         r0.pack(fill="x", padx=30, pady=(20, 10))
         ctk.CTkLabel(r0, text="🔍 Buscar:", font=Styles.FONT_LABEL).pack(side="left", padx=10)
         self.sales_search_var = tk.StringVar()
-        self.sales_search_var.trace("w", self.update_sales_combos)
         search_entry = ctk.CTkEntry(r0, textvariable=self.sales_search_var, placeholder_text="Nombre del producto...", width=350)
         search_entry.pack(side="left", padx=10)
+        self.sales_search_var.trace("w", Debouncer(search_entry, self.update_sales_combos))
 
         # Row 1: Product Selection
         r1 = ctk.CTkFrame(sales_card, fg_color="transparent")
@@ -413,10 +640,26 @@ class AfterwordApp(ctk.CTk):
         r2 = ctk.CTkFrame(sales_card, fg_color="transparent")
         r2.pack(fill="x", padx=30, pady=10)
         ctk.CTkLabel(r2, text="Cliente/Cartera:", font=Styles.FONT_LABEL).pack(side="left", padx=10)
-        user_names = ["-- Venta Directa (Contado) --"] + [f"{u[1]} (Saldo: ${u[3]:.2f})" for u in self.all_users]
+        user_names = self.sales_user_names = ["-- Venta Directa (Contado) --"]
         self.user_combo = ctk.CTkComboBox(r2, values=user_names, width=350)
         self.user_combo.pack(side="left", padx=10)
 
+        # Payment method of a direct sale (wallet sales are recorded as "Cartera")
+        ctk.CTkLabel(r2, text="Método:", font=Styles.FONT_LABEL).pack(side="left", padx=10)
+        self.sale_method_combo = ctk.CTkComboBox(r2, values=["Efectivo", "Nequi"], width=120)
+        self.sale_method_combo.pack(side="left", padx=10)
+        self.sale_method_combo.set("Efectivo")
+
+        def load_sales_data():
+            # Runs on the DB worker thread
+            return get_sale_items(), get_users()
+
+        def show_sales_data(data):
+            # Only "Productos" and "Productos Compuestos" are sold (get_sale_items leaves insumos out)
+            self.all_products, self.all_users = data
+            self.set_sales_users()
+            self.update_sales_combos()
+
         # Row 3: Quantity
         r3 = ctk.CTkFrame(sales_card, fg_color="transparent")
         r3.pack(fill="x", padx=30, pady=10)
@@ -425,84 +668,151 @@ class AfterwordApp(ctk.CTk):
         self.qty_entry.pack(side="left", padx=10)
         self.qty_entry.insert(0, "1")
 
+        # Cart: list of [product, qty]
+        self.cart = []
+
+        def find_selected_product():
+            # Format is "Name - $Price (S: Stock)"
+            selection = self.prod_combo.get()
+            for p in self.all_products:
+                if selection == f"{p.name} - ${p.price:.2f} (S: {p.stock})":
+                    return p
+            return None
+
+        def add_to_cart():
+            # Get and validate quantity
+            qty_str = self.qty_entry.get()
+            if not qty_str or not qty_str.isdigit() or int(qty_str) <= 0:
+                messagebox.showerror("Error", "Por favor ingresa una cantidad válida")
+                return False
+            qty = int(qty_str)
+
+            prod = find_selected_product()
+            if not prod:
+                messagebox.showerror("Error", "Producto no encontrado en la selección")
+                return False
+
+            # Quick check against the shown stock; record_sales_batch checks again (recipes
+            # included) under the write lock, so another station can't oversell in between
+            in_cart = sum(q for p, q in self.cart if p.id == prod.id)
+            if prod.type != "COMPUESTO" and in_cart + qty > prod.stock:
+                messagebox.showerror("Error", "Stock insuficiente")
+                return False
+
+            self.cart.append([prod, qty])
+            refresh_cart()
+            return True
+
+        def remove_from_cart():
+            # Highest index first, so each delete leaves the other positions valid
+            for index in sorted((self.cart_tree.index(item) for item in self.cart_tree.selection()), reverse=True):
+                del self.cart[index]
+            refresh_cart()
+
+        def refresh_cart():
+            self.cart_tree.delete(*self.cart_tree.get_children())
+            for prod, qty in self.cart:
+                self.cart_tree.insert("", "end", values=(prod.name, qty, f"${prod.price * qty:.2f}"))
+            total = sum(prod.price * qty for prod, qty in self.cart)
+            self.cart_total_lbl.configure(text=f"Total: ${total:.2f}")
+
+        ctk.CTkButton(r3, text="+ Agregar al Carrito", command=add_to_cart,
+                      fg_color=Styles.ACCENT_COLOR, text_color="black").pack(side="left", padx=10)
+
+        cart_card = self.create_card(scroll, "Carrito")
+        cart_card.pack(pady=10, fill="both", expand=True)
+        self.cart_tree = self.create_styled_tree(cart_card, ("Producto", "Cantidad", "Subtotal"))
+        self.cart_tree.configure(height=5)
+
+        cart_actions = ctk.CTkFrame(cart_card, fg_color="transparent")
+        cart_actions.pack(fill="x", padx=20, pady=10)
+        ctk.CTkButton(cart_actions, text="🗑️ Quitar", command=remove_from_cart,
+                      fg_color="transparent", text_color=Styles.DANGER, width=100).pack(side="left")
+        self.cart_total_lbl = ctk.CTkLabel(cart_actions, text="Total: $0.00", font=Styles.FONT_CARD_TITLE, text_color=Styles.ACCENT_COLOR)
+        self.cart_total_lbl.pack(side="right")
+
         def process_sale():
             try:
-                # Get and validate quantity
-                qty_str = self.qty_entry.get()
-                if not qty_str or not qty_str.isdigit():
-                    messagebox.showerror("Error", "Por favor ingresa una cantidad válida")
+                # An empty cart sells the current selection directly
+                if not self.cart and not add_to_cart():
                     return
-                qty = int(qty_str)
 
-                # Get and validate product selection
-                selection = self.prod_combo.get()
-                if not selection:
-                    messagebox.showerror("Error", "Por favor selecciona un producto")
-                    return
-                
-                # More robust matching: Extract name and price to find the product
-                # Format is "Name - $Price (S: Stock)"
-                prod = None
-                for p in self.all_products:
-                    match_str = f"{p[1]} - ${p[2]:.2f} (S: {p[3]})"
-                    if selection == match_str:
-                        prod = p
-                        break
-                
-                if not prod:
-                    messagebox.showerror("Error", "Producto no encontrado en la selección")
-                    return
-                
                 # Get and validate user selection
                 u_sel = self.user_combo.get()
                 user_id = None
                 if u_sel != user_names[0]:
                     # Format is "Name (Saldo: $XX.XX)"
                     for u in self.all_users:
-                        match_user = f"{u[1]} (Saldo: ${u[3]:.2f})"
+                        match_user = f"{u.name} (Saldo: ${u.balance:.2f})"
                         if u_sel == match_user:
-                            user_id = u[0]
+                            user_id = u.id
                             break
                     if user_id is None:
                         messagebox.showerror("Error", "Usuario no encontrado")
                         return
 
-                if qty > prod[3]:
-                    messagebox.showerror("Error", "Stock insuficiente")
-                    return
-                
-                total = prod[2] * qty
-                record_sale(prod[0], qty, total, user_id)
-                messagebox.showinfo("Éxito", f"Venta registrada correctamente por ${total:.2f}")
-                self.show_sales() # Refresh view
+                lines = [(prod.id, qty, prod.price * qty) for prod, qty in self.cart]
+                total = sum(line[2] for line in lines)
+                method = "Cartera" if user_id else self.sale_method_combo.get()
+
+                def recorded(_):
+                    # Stock and balances were already patched from the sale's change events
+                    messagebox.showinfo("Éxito", f"Venta registrada correctamente por ${total:.2f}")
+                    self.cart.clear()
+                    refresh_cart()
+                    self.user_combo.set(user_names[0])
+
+                self.run_db(record_sales_batch, lines, user_id, method, on_done=recorded, owner=self.cart_tree,
+                            error_msg="No se registró la venta")
             except Exception as e:
                 messagebox.showerror("Error", f"Ocurrió un error inesperado: {str(e)}")
 
-        ctk.CTkButton(sales_card, text="Confirmar Venta 💰", command=process_sale, fg_color=Styles.SUCCESS).pack(pady=20, padx=30, anchor="e")
-        self.update_sales_combos()
+        ctk.CTkButton(scroll, text="Confirmar Venta 💰", command=process_sale, fg_color=Styles.SUCCESS).pack(pady=20, padx=30, anchor="e")
+        self.refresh_sales = lambda: self.run_db(load_sales_data, on_done=show_sales_data, owner=self.cart_tree)
+        self.prod_combo.set("Cargando...")
+        self.refresh_sales()
 
     def update_sales_combos(self, *args):
-        query = self.sales_search_var.get().lower()
-        # Ensure only non-insumos appear here (safety check)
-        filtered = [f"{p[1]} - ${p[2]:.2f} (S: {p[3]})" for p in self.all_products 
-                    if (query in p[1].lower() or (p[4] and query in p[4].lower()))]
+        query = self.sales_search_var.get()
+        if not query:
+            self.show_sales_matches(query, None)
+            return
+        # The catalog syncs from the DB before searching, so it runs on the worker
+        self.run_db(self.product_catalog.search, query, 200, owner=self.prod_combo,
+                    on_done=lambda ids: self.show_sales_matches(query, ids))
+
+    def show_sales_matches(self, query, ids):
+        if query != self.sales_search_var.get():
+            return  # typed on since; the newer search fills the combo
+        shown = self.all_products
+        if ids is not None:
+            # Ensure only non-insumos appear here (safety check)
+            by_id = {p.id: p for p in self.all_products}
+            shown = [by_id[i] for i in ids if i in by_id]
+        # Keep the cashier's pick selected if it is still listed; its label changes with the stock
+        labels = [f"{p.name} - ${p.price:.2f} (S: {p.stock})" for p in self.sales_shown]
+        selected = self.prod_combo.get()
+        selected_id = self.sales_shown[labels.index(selected)].id if selected in labels else None
+        filtered = [f"{p.name} - ${p.price:.2f} (S: {p.stock})" for p in shown]
+        self.sales_shown = shown
         self.prod_combo.configure(values=filtered)
-        if filtered:
+        ids = [p.id for p in shown]
+        if selected_id in ids:
+            self.prod_combo.set(filtered[ids.index(selected_id)])
+        elif filtered:
             self.prod_combo.set(filtered[0])
         else:
             self.prod_combo.set("")
 
-    def load_products(self, query=""):
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        query = query.lower()
-        for prod in get_products():
-            if query in prod[1].lower() or query in str(prod[4]).lower():
-                p_list = list(prod)
-                p_list[2] = f"${p_list[2]:.2f}"
-                # The DB now has 'type' at index 5 potentially, but SELECT * might return it
-                # I should check database.py SELECT * output
-                self.tree.insert("", "end", values=p_list)
+    def fetch_products(self, after, limit, query):
+        # Runs on the DB worker thread
+        if not query:
+            return get_products_page(after, limit)
+        return get_products_by_ids(self.product_catalog.page(query, after, limit))
+
+    def load_products(self):
+        self.product_table.args = (self.inv_search_var.get(),)
+        self.product_table.reload()
 
     def edit_selected_product(self):
         selected = self.tree.selection()
@@ -522,8 +832,7 @@ class AfterwordApp(ctk.CTk):
         if not selected: return
         pid = self.tree.item(selected[0])['values'][0]
         if messagebox.askyesno("Confirmar", "¿Eliminar?"):
-            delete_product(pid)
-            self.load_products()
+            self.run_db(delete_product, pid)
 
     def open_product_window(self, product=None):
         win = ctk.CTkToplevel(self)
@@ -618,9 +927,8 @@ class AfterwordApp(ctk.CTk):
         
         ingredient_items = [] # List of (combo, qty_entry)
         
-        all_prods = get_products()
-        # Allow any existing product to be an ingredient
-        item_choices = [f"{p[1]} (ID: {p[0]})" for p in all_prods]
+        # Any existing product can be an ingredient; filled by the load at the end
+        all_prods = []
 
         def add_ingredient_row(ing_id=None, qty=1):
             row = ctk.CTkFrame(recipe_list, fg_color="transparent")
@@ -632,16 +940,15 @@ class AfterwordApp(ctk.CTk):
             unit_var = ctk.StringVar(value="")
             
             if ing_id:
-                matching = [p for p in all_prods if p[0] == ing_id]
+                matching = [p for p in all_prods if p.id == ing_id]
                 if matching: 
-                    name_var.set(matching[0][1])
-                    if len(matching[0]) > 6: unit_var.set(f"({matching[0][6]})")
+                    name_var.set(matching[0].name)
+                    unit_var.set(f"({matching[0].unit or 'unid'})")
 
             def pick_item(p, nv, iv, uv):
-                nv.set(p[1])
-                iv.set(str(p[0]))
-                if len(p) > 6: uv.set(f"({p[6]})")
-                else: uv.set("(unid)")
+                nv.set(p.name)
+                iv.set(str(p.id))
+                uv.set(f"({p.unit or 'unid'})")
 
             btn = ctk.CTkButton(row, textvariable=name_var, width=180, anchor="w", 
                                 fg_color=Styles.CARD_BG, border_width=1, border_color=Styles.BORDER_COLOR,
@@ -666,13 +973,21 @@ class AfterwordApp(ctk.CTk):
 
         ctk.CTkButton(recipe_frame, text="+ Añadir Ingrediente", command=add_ingredient_row, height=25).pack(pady=5)
 
-        if product:
-            # Load existing recipe
-            recipe_data = get_recipe(product[0])
+        toggle_ui() # Initial check
+
+        product_id = int(product[0]) if product else None
+
+        def load_form():
+            # Runs on the DB worker thread
+            return get_products(), get_recipe(product_id) if product_id else []
+
+        def show_form(data):
+            prods, recipe_data = data
+            all_prods[:] = prods
             for ing_id, name, qty in recipe_data:
                 add_ingredient_row(ing_id, qty)
-        
-        toggle_ui() # Initial check
+
+        self.run_db(load_form, on_done=show_form, owner=win, error_msg="No se cargó el producto")
 
         def save():
             try:
@@ -691,6 +1006,9 @@ class AfterwordApp(ctk.CTk):
                     messagebox.showerror("Error", "Falta el nombre")
                     return
 
+                # Price and stock as stored, not as formatted in the table
+                current = next((p for p in all_prods if p.id == product_id), None)
+
                 # Price is mandatory for Products
                 if ui_type != "INSUMO":
                     try:
@@ -699,53 +1017,62 @@ class AfterwordApp(ctk.CTk):
                         messagebox.showerror("Error", "Precio de venta inválido")
                         return
                 else:
-                    price = product[2] if product else 0
+                    price = current.price if current else (product[2] if product else 0)
 
-                stock = product[3] if product else 0
+                stock = current.stock if current else (product[3] if product else 0)
 
-                if product: 
-                    update_product(product[0], name, price, stock, category, p_type, unit)
-                    pid = product[0]
-                else: 
-                    add_product(name, price, stock, category, p_type, unit)
-                    # Need to get the last ID for new product
-                    pid = get_products()[-1][0]
-                
-                # Save Recipe/Composition
-                delete_recipe(pid)
+                # Save Recipe/Composition (replaced atomically, rejects cycles)
+                items = []
                 if ui_type == "PRODUCTO COMPUESTO":
                     for iv, qe, r in ingredient_items:
                         sel_id = iv.get()
                         if sel_id:
-                            add_recipe_item(pid, int(sel_id), float(qe.get()))
-                
-                self.load_products()
-                win.destroy()
-                messagebox.showinfo("Éxito", "Guardado correctamente")
+                            items.append((int(sel_id), float(qe.get())))
+
+                def persist():
+                    # Runs on the DB worker thread
+                    if product: 
+                        update_product(product_id, name, price, stock, category, p_type, unit)
+                        pid = product_id
+                    else: 
+                        pid = add_product(name, price, stock, category, p_type, unit)
+                    set_recipe(pid, items)
+
+                def saved(_):
+                    if win.winfo_exists():
+                        win.destroy()
+                    messagebox.showinfo("Éxito", "Guardado correctamente")
+
+                self.run_db(persist, on_done=saved)
             except Exception as e:
                 messagebox.showerror("Error", f"Error: {str(e)}")
 
         ctk.CTkButton(scroll_container, text="Guardar Cambios", command=save, fg_color=Styles.ACCENT_COLOR, text_color="black").pack(pady=20)
 
-    def show_history(self):
-        self.clear_container()
-        ctk.CTkLabel(self.main_container, text="HISTORIAL DE MOVIMIENTOS (VENTAS Y ABONOS)", font=Styles.FONT_SUBHEADER).pack(pady=(0, 20), anchor="w")
-        table_card = self.create_card(self.main_container)
+    def build_history(self, frame):
+        header = ctk.CTkFrame(frame, fg_color="transparent")
+        header.pack(fill="x", pady=(0, 20))
+        ctk.CTkLabel(header, text="HISTORIAL DE MOVIMIENTOS (VENTAS Y ABONOS)", font=Styles.FONT_SUBHEADER).pack(side="left")
+        kind_combo = ctk.CTkComboBox(header, values=["TODOS", *HISTORY_KINDS], width=140)
+        kind_combo.pack(side="right")
+        table_card = self.create_card(frame)
         table_card.pack(fill="both", expand=True)
 
         # Columns: ID, Tipo (VENTA/PAGO), Detalle (Producto/Usuario), Info/Método (Cant/Nequi/Efectivo), Total, Fecha
         columns = ("ID", "Tipo", "Detalle", "Info/Método", "Total", "Fecha")
         tree = self.create_styled_tree(table_card, columns)
-        
-        for trans in get_combined_history():
-            t_list = list(trans)
-            t_list[4] = f"${t_list[4]:.2f}"
-            tree.insert("", "end", values=t_list)
+        # args: (since, until, kind, user_id)
+        self.history_table = table = VirtualTable(tree, get_combined_history_page, key=history_key,
+                                                  format_row=lambda t: (*t[:4], f"${t[4]:.2f}", t[5]), executor=self.db)
 
-    def show_financial_summary(self):
-        self.clear_container()
+        def filter_kind(choice):
+            table.args = (None, None, None if choice == "TODOS" else choice)
+            table.reload()
+        kind_combo.configure(command=filter_kind)
+
+    def build_financial_summary(self, frame):
         
-        scroll = ctk.CTkScrollableFrame(self.main_container, fg_color="transparent")
+        scroll = ctk.CTkScrollableFrame(frame, fg_color="transparent")
         scroll.pack(fill="both", expand=True)
 
         header = ctk.CTkFrame(scroll, fg_color="transparent")
@@ -755,27 +1082,27 @@ class AfterwordApp(ctk.CTk):
         ctk.CTkButton(header, text="+ REGISTRAR ENTRADA (COMPRA)", command=self.open_purchase_window,
                       fg_color=Styles.ACCENT_COLOR, text_color="black").pack(side="right")
 
-        # Top Stats
-        total_s, total_p, user_stats = get_financial_summary()
-        
+        # Top Stats (filled in by refresh_financial_summary)
         stats_frame = ctk.CTkFrame(scroll, fg_color="transparent")
         stats_frame.pack(fill="x", pady=10)
         
         # Total Sales Card
         c1 = self.create_card(stats_frame, "Ingresos (Ventas)")
         c1.pack(side="left", fill="both", expand=True, padx=5)
-        ctk.CTkLabel(c1, text=f"${total_s:.2f}", font=Styles.FONT_HEADER, text_color=Styles.SUCCESS).pack(pady=10)
+        self.summary_sales_lbl = ctk.CTkLabel(c1, text="...", font=Styles.FONT_HEADER, text_color=Styles.SUCCESS)
+        self.summary_sales_lbl.pack(pady=10)
 
         # Total Purchases Card
         c2 = self.create_card(stats_frame, "Inversión (Compras)")
         c2.pack(side="left", fill="both", expand=True, padx=5)
-        ctk.CTkLabel(c2, text=f"${total_p:.2f}", font=Styles.FONT_HEADER, text_color=Styles.DANGER).pack(pady=10)
+        self.summary_purchases_lbl = ctk.CTkLabel(c2, text="...", font=Styles.FONT_HEADER, text_color=Styles.DANGER)
+        self.summary_purchases_lbl.pack(pady=10)
 
         # Profit Card
         c3 = self.create_card(stats_frame, "Balance Neto")
         c3.pack(side="left", fill="both", expand=True, padx=5)
-        balance_color = Styles.SUCCESS if (total_s - total_p) >= 0 else Styles.DANGER
-        ctk.CTkLabel(c3, text=f"${(total_s - total_p):.2f}", font=Styles.FONT_HEADER, text_color=balance_color).pack(pady=10)
+        self.summary_balance_lbl = ctk.CTkLabel(c3, text="...", font=Styles.FONT_HEADER)
+        self.summary_balance_lbl.pack(pady=10)
 
         # User Sales List
         list_card = self.create_card(scroll, "Ventas por Cliente")
@@ -784,13 +1111,10 @@ class AfterwordApp(ctk.CTk):
         ctk.CTkLabel(list_card, text="(Doble clic para ver historial completo de cartera)", font=("Arial", 10), text_color="gray").pack(pady=2)
 
         columns = ("ID", "Cliente", "Total Comprado", "Saldo Actual")
-        tree = self.create_styled_tree(list_card, columns)
+        tree = self.summary_tree = self.create_styled_tree(list_card, columns)
         
         # Hide the ID column
         tree.column("ID", width=0, stretch=False)
-        
-        for uid, name, amount, balance in user_stats:
-            tree.insert("", "end", values=(uid, name, f"${amount:.2f}", f"${balance:.2f}"))
 
         def open_detailed_from_summary(event):
             selected = tree.selection()
@@ -800,6 +1124,105 @@ class AfterwordApp(ctk.CTk):
 
         tree.bind("<Double-1>", open_detailed_from_summary)
 
+        # Per-product margins from the rolled-up recipe costs (see costing.py)
+        margin_card = self.create_card(scroll, "Márgenes por Producto")
+        margin_card.pack(fill="both", expand=True, pady=10)
+        ctk.CTkLabel(margin_card, text="(Costo según recetas y última compra; menor margen primero)",
+                     font=("Arial", 10), text_color="gray").pack(pady=2)
+        self.margin_tree = self.create_styled_tree(margin_card, ("Producto", "Precio", "Costo", "Margen", "%"))
+
+        # Monthly trend from the daily rollups (see analytics.py)
+        trend_card = self.create_card(scroll, "Tendencia Mensual (12 meses)")
+        trend_card.pack(fill="both", expand=True, pady=10)
+        self.trend_tree = self.create_styled_tree(trend_card, ("Mes", "Ventas", "Compras", "Neto"))
+
+        self.refresh_financial_summary()
+
+    def refresh_financial_summary(self):
+        def load():
+            # Runs on the DB worker thread
+            return (get_financial_summary(), self.cost_engine.margins(),
+                    analytics.trend("month", since=analytics.month_start(11)))
+        self.run_db(load, on_done=self.render_financial_summary, owner=self.summary_tree)
+
+    def render_financial_summary(self, result):
+        (total_s, total_p, user_stats), margins, trend = result
+        self.summary_sales_lbl.configure(text=f"${total_s:.2f}")
+        self.summary_purchases_lbl.configure(text=f"${total_p:.2f}")
+        balance_color = Styles.SUCCESS if (total_s - total_p) >= 0 else Styles.DANGER
+        self.summary_balance_lbl.configure(text=f"${(total_s - total_p):.2f}", text_color=balance_color)
+
+        tree = self.summary_tree
+        tree.delete(*tree.get_children())
+        for uid, name, amount, balance in user_stats:
+            tree.insert("", "end", values=(uid, name, f"${amount:.2f}", f"${balance:.2f}"))
+
+        tree = self.margin_tree
+        tree.delete(*tree.get_children())
+        for pid, name, price, cost, margin, percent in margins:
+            if cost is None:
+                tree.insert("", "end", values=(name, f"${price:.2f}", "Sin costo", "-", "-"))
+            else:
+                tree.insert("", "end", values=(name, f"${price:.2f}", f"${cost:.2f}", f"${margin:.2f}", f"{percent:.1f}%" if percent is not None else "-"))
+
+        tree = self.trend_tree
+        tree.delete(*tree.get_children())
+        for month, revenue, outflow in trend:
+            tree.insert("", "end", values=(month[:7], f"${revenue:.2f}", f"${outflow:.2f}", f"${revenue - outflow:.2f}"))
+
+    def build_diagnostics(self, frame):
+        header = ctk.CTkFrame(frame, fg_color="transparent")
+        header.pack(fill="x", pady=(0, 20))
+        ctk.CTkLabel(header, text="DIAGNÓSTICO", font=Styles.FONT_SUBHEADER).pack(side="left")
+        ctk.CTkButton(header, text="Reiniciar contadores", command=lambda: (diagnostics.reset(), self.render_diagnostics()),
+                      fg_color="transparent", border_width=1, width=160).pack(side="right")
+        ctk.CTkButton(header, text="Respaldar ahora", command=lambda: self.backups.run_now(),
+                      fg_color="transparent", border_width=1, width=160).pack(side="right", padx=10)
+
+        self.diag_info_lbl = ctk.CTkLabel(frame, text="", font=Styles.FONT_BODY, justify="left", anchor="w")
+        self.diag_info_lbl.pack(fill="x", pady=5)
+
+        card = self.create_card(frame, "Tiempos por operación (ms)")
+        card.pack(fill="both", expand=True, pady=10)
+        self.diag_tree = self.create_styled_tree(card, ("Operación", "Llamadas", "p50", "p99", "Máx", "Filas"))
+        self.diag_job = None
+
+    def render_diagnostics(self):
+        # In-memory numbers only: safe to read on the Tk thread, refreshed every second while visible
+        if self.diag_job is not None:
+            self.after_cancel(self.diag_job)
+            self.diag_job = None
+        if not self.built("diag_tree") or self.views.current != "diagnostics":
+            return
+        lag = next((row for row in diagnostics.snapshot() if row[0] == "tk_loop_lag"), None)
+        startup = ", ".join(f"{phase} {ms:.0f}" for phase, ms in self.startup_timings.items())
+        cache = ", ".join(f"{name} {s['hits']}/{s['hits'] + s['misses']}" for name, s in database.cache_stats().items())
+        self.diag_info_lbl.configure(text=(
+            f"Retraso del bucle Tk: p50 {lag[2]:.1f} ms, p99 {lag[3]:.1f} ms, máx {lag[4]:.1f} ms\n" if lag else "") +
+            f"Inicio (ms): {startup}\nCaché (aciertos/lecturas): {cache or '-'}\n"
+            f"Operaciones de más de {diagnostics.SLOW_MS:.0f} ms se anotan en {diagnostics.SLOW_LOG}\n" +
+            self.backup_status())
+
+        tree = self.diag_tree
+        tree.delete(*tree.get_children())
+        for name, calls, p50, p99, max_ms, rows in diagnostics.snapshot():
+            tree.insert("", "end", values=(name, calls, f"{p50:.2f}", f"{p99:.2f}", f"{max_ms:.2f}", rows or ""))
+        self.diag_job = self.after(1000, self.render_diagnostics)
+
+    def backup_status(self):
+        service = getattr(self, "backups", None)
+        if service is None:
+            return "Respaldos: -"
+        if service.running:
+            return "Respaldo en curso..."
+        if service.last_error is not None:
+            return f"Último respaldo falló: {service.last_error}"
+        result = service.last_result
+        if result is None:
+            return f"Respaldos: cada {BACKUP_INTERVAL // 3600} h en {backup.BACKUP_DIR}/"
+        return (f"Último respaldo: {os.path.basename(result.path)}, {result.bytes / 1e6:.1f} MB en "
+                f"{result.seconds:.1f} s ({result.mb_per_s:.1f} MB/s), integridad ok")
+
     def open_purchase_window(self):
         win = ctk.CTkToplevel(self)
         win.title("Registrar Entrada")
@@ -814,10 +1237,10 @@ class AfterwordApp(ctk.CTk):
         form.pack(padx=10, pady=10, fill="both")
 
         ctk.CTkLabel(form, text="Producto / Insumo:").pack(pady=5, anchor="w", padx=20)
-        prods = get_products()
-        prod_names = [f"{p[1]} [{p[5]}] (Stock: {p[3]})" for p in prods]
-        prod_combo = ctk.CTkComboBox(form, values=prod_names, width=300)
+        prods = []  # filled by the load below
+        prod_combo = ctk.CTkComboBox(form, values=[], width=300)
         prod_combo.pack(pady=5, padx=20)
+        prod_combo.set("Cargando...")
 
         ctk.CTkLabel(form, text="Cantidad que entra:").pack(pady=5, anchor="w", padx=20)
         qty_frame = ctk.CTkFrame(form, fg_color="transparent")
@@ -838,14 +1261,13 @@ class AfterwordApp(ctk.CTk):
         cost_label.pack(pady=10)
 
         def on_prod_change(choice):
-            matching = [p for p in prods if f"{p[1]} [{p[5]}]" in choice]
+            matching = [p for p in prods if f"{p.name} [{p.type}]" in choice]
             if matching:
                 prod = matching[0]
-                if len(prod) > 6: unit_label_p.configure(text=f"({prod[6]})")
-                else: unit_label_p.configure(text="(unid)")
+                unit_label_p.configure(text=f"({prod.unit or 'unid'})")
                 
                 # Logic: INSUMO = Total Cost | PRODUCTO = Unit Price
-                if prod[5] == "INSUMO":
+                if prod.type == "INSUMO":
                     cost_prompt_label.configure(text="Costo TOTAL de esta compra ($):")
                 else:
                     cost_prompt_label.configure(text="Costo UNITARIO por item ($):")
@@ -862,8 +1284,8 @@ class AfterwordApp(ctk.CTk):
                 q = float(qty_e.get())
                 c = float(cost_e.get())
                 sel = prod_combo.get()
-                matching = [p for p in prods if f"{p[1]} [{p[5]}]" in sel]
-                p_type = matching[0][5] if matching else "PRODUCTO"
+                matching = [p for p in prods if f"{p.name} [{p.type}]" in sel]
+                p_type = matching[0].type if matching else "PRODUCTO"
 
                 if q > 0:
                     if p_type == "INSUMO":
@@ -879,10 +1301,10 @@ class AfterwordApp(ctk.CTk):
         def save():
             try:
                 sel = prod_combo.get()
-                matching = [p for p in prods if f"{p[1]} [{p[5]}]" in sel]
+                matching = [p for p in prods if f"{p.name} [{p.type}]" in sel]
                 if not matching: return
                 prod = matching[0]
-                p_id, p_type = prod[0], prod[5]
+                p_id, p_type = prod.id, prod.type
                 
                 q, c = float(qty_e.get()), float(cost_e.get())
                 
@@ -891,22 +1313,35 @@ class AfterwordApp(ctk.CTk):
                 if p_type != "INSUMO":
                     cost_to_record = c * q
                 
-                record_purchase(p_id, q, cost_to_record)
-                
-                if p_type == "INSUMO":
-                    update_ingredient_unit_cost(p_id, c, q)
-                
+                def persist():
+                    # Runs on the DB worker thread
+                    record_purchase(p_id, q, cost_to_record)
+                    if p_type == "INSUMO":
+                        update_ingredient_unit_cost(p_id, c, q)
+
+                def saved(_):
+                    self.show_financial_summary()
+                    msg = f"Entrada registrada satisfactoriamente."
+                    if p_type == "INSUMO":
+                        msg += f"\nEl costo de '{prod.name}' se actualizó a ${c/q:.2f} por unidad."
+                    messagebox.showinfo("Éxito", msg)
+
                 win.destroy()
-                self.show_financial_summary()
-                msg = f"Entrada registrada satisfactoriamente."
-                if p_type == "INSUMO":
-                    msg += f"\nEl costo de '{prod[1]}' se actualizó a ${c/q:.2f} por unidad."
-                messagebox.showinfo("Éxito", msg)
+                self.run_db(persist, on_done=saved, error_msg="Datos inválidos")
             except Exception as e:
                 messagebox.showerror("Error", f"Datos inválidos: {str(e)}")
 
         ctk.CTkButton(scroll, text="Guardar Entrada", command=save, fg_color=Styles.ACCENT_COLOR, text_color="black").pack(pady=20)
 
+        def show_products(loaded):
+            prods[:] = loaded
+            prod_names = [f"{p.name} [{p.type}] (Stock: {p.stock})" for p in prods]
+            prod_combo.configure(values=prod_names)
+            prod_combo.set(prod_names[0] if prod_names else "")
+            on_prod_change(prod_combo.get())
+
+        self.run_db(get_products, on_done=show_products, owner=win, error_msg="No se cargaron los productos")
+
     def open_product_picker(self, callback):
         win = ctk.CTkToplevel(self)
         win.title("Seleccionar Item")
@@ -922,14 +1357,14 @@ class AfterwordApp(ctk.CTk):
         columns = ("ID", "Nombre", "Precio", "Stock", "Tipo")
         tree = self.create_styled_tree(container, columns)
         
-        for p in get_products():
-            tree.insert("", "end", values=p)
+        picks = PickList(tree, key=lambda p: p.id,
+                         format_row=lambda p: (p.id, p.name, f"${p.price:.2f}", p.stock, p.type))
+        self.run_db(get_products, on_done=picks.fill, owner=tree, error_msg="No se cargaron los productos")
 
         def select():
-            selected = tree.selection()
-            if not selected: return
-            item_data = tree.item(selected[0], "values")
-            callback(item_data)
+            product = picks.selected()
+            if product is None: return
+            callback(product)
             win.destroy()
 
         # Add double-click to select
@@ -0,0 +1,223 @@
+# In-memory incremental search for the product and user catalogs
+from bisect import bisect_left, insort
+from functools import lru_cache
+import threading
+import unicodedata
+
+import database
+
+@lru_cache(maxsize=4096)
+def normalize(text):
+    """Lowercases and strips accents: 'Proteína ÁCIDA' -> 'proteina acida'."""
+    text = str(text or "")
+    if not text.isascii():
+        text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    return text.casefold()
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class Catalog:
+    """Token + trigram index over (id, name, *extra_fields) rows.
+
+    Rows are split into tokens; each distinct token keeps the ids it appears
+    in, and the (small) token vocabulary is indexed by trigram. A query word
+    of one or two letters matches tokens starting with it, longer words match
+    tokens containing them, and every word of the query must match.
+
+    load() returns the rows to index and version() a counter that changes when
+    they may have changed (see database.get_change_counter); search() re-syncs
+    the rows whose text differs before answering.
+
+    Ranking: names starting with the query first, then the other matches,
+    alphabetically by name within each group.
+    """
+
+    DENSE = 5000  # above this many candidates, walk the name order instead of sorting them
+
+    def __init__(self, load, version):
+        self.load = load
+        self.version = version
+        self._lock = threading.RLock()  # the DB worker thread and the Tk thread may both search
+        self._reset()
+
+    def _reset(self):
+        self.synced_version = None
+        self.names = {}       # id -> normalized name
+        self.tokens = {}      # id -> tuple of normalized tokens
+        self.by_name = []     # sorted (name, id)
+        self.postings = {}    # token -> set of ids
+        self.vocab = []       # sorted distinct tokens
+        self.vocab_grams = {} # trigram -> set of tokens
+        self.ranked = None    # (version, query, ids, id -> position) of the last page() query
+
+    def sync(self):
+        with self._lock:
+            version = self.version()
+            if version == self.synced_version:
+                return
+            rows = self.load()
+            if not self.names or abs(len(rows) - len(self.names)) > 1000:
+                self.rebuild(rows)
+            else:
+                fresh = {row[0] for row in rows}
+                for item_id in [i for i in self.names if i not in fresh]:
+                    self.remove(item_id)
+                for row in rows:
+                    self.upsert(row)
+            self.synced_version = version
+
+    @staticmethod
+    def _split(row):
+        name = normalize(row[1])
+        tokens = tuple(dict.fromkeys(" ".join([name] + [normalize(v) for v in row[2:]]).split()))
+        return name, tokens
+
+    def rebuild(self, rows):
+        """Bulk (re)indexes everything with one sort instead of an insort per row."""
+        self._reset()
+        for row in rows:
+            item_id = row[0]
+            name, tokens = self._split(row)
+            self.names[item_id], self.tokens[item_id] = name, tokens
+            for token in tokens:
+                ids = self.postings.get(token)
+                if ids is None:
+                    ids = self.postings[token] = set()
+                ids.add(item_id)
+        self.by_name = sorted((name, item_id) for item_id, name in self.names.items())
+        self.vocab = sorted(self.postings)
+        for token in self.vocab:
+            for gram in trigrams(token):
+                self.vocab_grams.setdefault(gram, set()).add(token)
+
+    def upsert(self, row):
+        item_id = row[0]
+        name, tokens = self._split(row)
+        if self.names.get(item_id) == name and self.tokens.get(item_id) == tokens:
+            return
+        self.remove(item_id)
+        self.names[item_id], self.tokens[item_id] = name, tokens
+        insort(self.by_name, (name, item_id))
+        for token in tokens:
+            if token not in self.postings:
+                self.postings[token] = set()
+                insort(self.vocab, token)
+                for gram in trigrams(token):
+                    self.vocab_grams.setdefault(gram, set()).add(token)
+            self.postings[token].add(item_id)
+
+    def remove(self, item_id):
+        name = self.names.pop(item_id, None)
+        if name is None:
+            return
+        self.by_name.pop(bisect_left(self.by_name, (name, item_id)))
+        for token in self.tokens.pop(item_id):
+            ids = self.postings[token]
+            ids.discard(item_id)
+            if not ids:
+                del self.postings[token]
+                self.vocab.pop(bisect_left(self.vocab, token))
+                for gram in trigrams(token):
+                    self.vocab_grams[gram].discard(token)
+
+    def _matching_tokens(self, word):
+        if len(word) < 3:
+            start = bisect_left(self.vocab, word)
+            end = bisect_left(self.vocab, word + "\uffff", start)
+            return set(self.vocab[start:end])
+        grams = sorted((self.vocab_grams.get(g, set()) for g in trigrams(word)), key=len)
+        return {token for token in grams[0].intersection(*grams[1:]) if word in token}
+
+    def search(self, query, limit=50):
+        """Returns up to `limit` ids, best match first."""
+        with self._lock:
+            return self._search(query, limit)
+
+    def _search(self, query, limit):
+        self.sync()
+        query = " ".join(normalize(query).split())
+        if not query:
+            return [item_id for _, item_id in self.by_name[:limit]]
+
+        wanted = [self._matching_tokens(word) for word in query.split()]
+        if not all(wanted):
+            return []
+
+        tokens = self.tokens
+        if len(wanted) == 1:
+            only = wanted[0]
+            def matches(item_id):
+                return not only.isdisjoint(tokens[item_id])
+        else:
+            def matches(item_id):
+                return all(not tokens_w.isdisjoint(tokens[item_id]) for tokens_w in wanted)
+
+        # Names starting with the query are a contiguous slice of by_name
+        result = []
+        index = bisect_left(self.by_name, (query,))
+        while len(result) < limit and index < len(self.by_name) and self.by_name[index][0].startswith(query):
+            if matches(self.by_name[index][1]):
+                result.append(self.by_name[index][1])
+            index += 1
+        if len(result) >= limit:
+            return result
+        first = set(result)
+
+        sizes = [sum(len(self.postings[t]) for t in tokens_w) for tokens_w in wanted]
+        if min(sizes) > self.DENSE and limit < self.DENSE:
+            # Many likely hits: walking the name order finds `limit` of them quickly.
+            # Checked in slices of 256 names, a comprehension being much cheaper per name than a loop.
+            walked = list(result)
+            for start in range(0, min(len(self.by_name), self.DENSE), 256):
+                walked += [i for _, i in self.by_name[start:start + 256] if i not in first and matches(i)]
+                if len(walked) >= limit:
+                    return walked[:limit]
+            # the words rarely occur together after all
+
+        # Few hits: collect the rarest word's ids, keep those matching the rest, sort by name
+        rarest = wanted[sizes.index(min(sizes))]
+        candidates = set().union(*(self.postings[t] for t in rarest)) - first
+        rest = sorted((self.names[i], i) for i in candidates if matches(i))
+        return result + [item_id for _, item_id in rest[:limit - len(result)]]
+
+    def page(self, query, after=None, limit=100):
+        """Keyset page over every match of `query`, ranked as search() does: the ids after id `after`.
+
+        The full ranking is computed on the first page and kept until the
+        query or the catalog changes, so the following pages are slices.
+        """
+        with self._lock:
+            self.sync()
+            query = " ".join(normalize(query).split())
+            if self.ranked is None or self.ranked[:2] != (self.synced_version, query):
+                ids = self._search(query, len(self.names))
+                self.ranked = (self.synced_version, query, ids, {item_id: n for n, item_id in enumerate(ids)})
+            _, _, ids, position = self.ranked
+        start = position[after] + 1 if after in position else 0
+        return ids[start:start + limit]
+
+def product_catalog():
+    return Catalog(database.get_product_search_fields, lambda: database.get_change_counter("product_names"))
+
+def user_catalog():
+    return Catalog(database.get_user_search_fields, lambda: database.get_change_counter("user_names"))
+
+class Debouncer:
+    """Calls `callback` once the input has been quiet for `delay_ms` (Tk after())."""
+
+    def __init__(self, widget, callback, delay_ms=150):
+        self.widget = widget
+        self.callback = callback
+        self.delay_ms = delay_ms
+        self._job = None
+
+    def __call__(self, *args):
+        if self._job is not None:
+            self.widget.after_cancel(self._job)
+        self._job = self.widget.after(self.delay_ms, self._fire)
+
+    def _fire(self):
+        self._job = None
+        if self.widget.winfo_exists():
+            self.callback()
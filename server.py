@@ -0,0 +1,323 @@
+# Local HTTP/JSON API over database.py, for the web-port and extra counter terminals
+#
+#   python server.py                          # http://127.0.0.1:8765/api/products
+#   python server.py --host 0.0.0.0 --port 8765 --readers 4
+#
+# Writes run one at a time on a single writer thread (SQLite allows one
+# writer anyway, and this keeps them from queueing on the file lock); reads
+# run concurrently on a pool of read-only connections, which WAL lets
+# proceed while a write is in progress. Product and user lists carry an ETag
+# built from their change counter, so a tablet polling with If-None-Match
+# gets a bodyless 304 until something actually changed.
+import argparse
+import asyncio
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+
+import analytics
+import bulk
+import database
+
+MAX_BODY = 1024 * 1024
+STATUS_TEXT = {200: "OK", 201: "Created", 204: "No Content", 304: "Not Modified", 400: "Bad Request",
+               404: "Not Found", 405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large",
+               500: "Internal Server Error"}
+
+class HttpError(Exception):
+    def __init__(self, status, message, **extra):
+        super().__init__(message)
+        self.status = status
+        self.payload = {"error": message, **extra}
+
+def _rows(table, rows):
+    return [dict(zip(bulk.TABLES[table], row)) for row in rows]
+
+def _one(table, rows, item_id):
+    if not rows:
+        raise HttpError(404, f"No existe: {item_id}")
+    return _rows(table, rows)[0]
+
+def _field(body, name, kind=str, default=...):
+    value = body.get(name, default)
+    if value is ...:
+        raise HttpError(400, f"Falta el campo '{name}'")
+    try:
+        return value if value is None or value is default else kind(value)
+    except (TypeError, ValueError):
+        raise HttpError(400, f"Valor inválido para '{name}'")
+
+def _etag(counter):
+    return f'"{counter}-{database.get_change_counter(counter)}"'
+
+# Handlers: (path params, query dict, JSON body) -> payload, or (status, payload)
+def list_products(params, query, body):
+    return _rows("products", database.get_products())
+
+def get_product(params, query, body):
+    return _one("products", database.get_products_by_ids([int(params["id"])]), params["id"])
+
+def _product_fields(body, stock=0):
+    return (_field(body, "name"), _field(body, "price", float), _field(body, "stock", float, stock),
+            _field(body, "category", str, ""), _field(body, "type", str, "PRODUCTO"), _field(body, "unit", str, "unid"))
+
+def create_product(params, query, body):
+    return 201, {"id": database.add_product(*_product_fields(body))}
+
+def update_product(params, query, body):
+    # A PUT replaces the stock too, so it has to say what it is (a default of 0 would wipe it)
+    database.update_product(int(params["id"]), *_product_fields(body, stock=...))
+    return 204, None
+
+def delete_product(params, query, body):
+    database.delete_product(int(params["id"]))
+    return 204, None
+
+def list_users(params, query, body):
+    return _rows("users", database.get_users())
+
+def get_user(params, query, body):
+    return _one("users", database.get_users_by_ids([int(params["id"])]), params["id"])
+
+def create_user(params, query, body):
+    return 201, {"id": database.add_user(_field(body, "name"), _field(body, "phone", str, ""))}
+
+def delete_user(params, query, body):
+    database.delete_user(int(params["id"]))
+    return 204, None
+
+def get_recipe(params, query, body):
+    return [{"ingredient_id": i, "name": name, "quantity": qty} for i, name, qty in database.get_recipe(int(params["id"]))]
+
+def set_recipe(params, query, body):
+    items = [(_field(item, "ingredient_id", int), _field(item, "quantity", float)) for item in _field(body, "items", list)]
+    database.set_recipe(int(params["id"]), items)
+    return 204, None
+
+def stock_movements(params, query, body):
+    columns = ("id", "delta", "reason", "ref", "moved_at")
+    rows = database.get_stock_movements(int(params["id"]), min(int(query.get("limit", 50)), 1000))
+    return [dict(zip(columns, row)) for row in rows]
+
+def stock_at(params, query, body):
+    """?at=YYYY-MM-DD[ HH:MM:SS] (UTC); stock is null before the journal started."""
+    at = _field(query, "at")
+    return {"at": at, "stock": database.get_stock_at(int(params["id"]), at)}
+
+def _sale_lines(body):
+    lines = [(_field(line, "product_id", int), _field(line, "quantity", float), _field(line, "total_price", float))
+             for line in _field(body, "lines", list)]
+    if any(quantity <= 0 for _, quantity, _ in lines):
+        raise HttpError(400, "La cantidad debe ser mayor que cero")  # a negative sale would add stock
+    return lines
+
+def check_stock(params, query, body):
+    return {"shortages": [s._asdict() for s in database.check_stock(_sale_lines(body))]}
+
+def record_sale(params, query, body):
+    try:
+        database.record_sales_batch(_sale_lines(body), _field(body, "user_id", int, None),
+                                    _field(body, "method", str, "Efectivo"))
+    except database.InsufficientStockError as e:
+        raise HttpError(409, str(e), shortages=[s._asdict() for s in e.shortages])
+    return 201, None
+
+def record_payment(params, query, body):
+    database.record_payment(_field(body, "user_id", int), _field(body, "amount", float), _field(body, "method"))
+    return 201, None
+
+def record_purchase(params, query, body):
+    database.record_purchase(_field(body, "product_id", int), _field(body, "quantity", float), _field(body, "cost_price", float))
+    return 201, None
+
+def history(params, query, body):
+    """Newest first; pass back `next` as ?before=... for the following page."""
+    before = json.loads(query["before"]) if query.get("before") else None
+    rows = database.get_combined_history_page(before, min(int(query.get("limit", 200)), 1000), query.get("since"),
+                                              query.get("until"), query.get("kind"),
+                                              int(query["user_id"]) if query.get("user_id") else None)
+    columns = ("id", "type", "detail", "info", "amount", "date")
+    return {"rows": [dict(zip(columns, row)) for row in rows],
+            "next": json.dumps(database.history_key(rows[-1])) if rows else None}
+
+def summary(params, query, body):
+    total_sales, total_purchases, users = database.get_financial_summary()
+    return {"sales_total": total_sales, "purchases_total": total_purchases,
+            "users": [dict(zip(("id", "name", "total_bought", "balance"), row)) for row in users]}
+
+def sales_analytics(params, query, body):
+    rows = analytics.sales_series(query.get("bucket", "day"), query.get("by"), query.get("since"), query.get("until"))
+    return [dict(zip(("bucket", "key", "revenue", "units", "sales"), row)) for row in rows]
+
+# (method, path pattern, handler, "read" or "write", change counter for the ETag)
+ROUTES = [
+    ("GET", r"/api/products", list_products, "read", "products"),
+    ("POST", r"/api/products", create_product, "write", None),
+    ("GET", r"/api/products/(?P<id>\d+)", get_product, "read", None),
+    ("PUT", r"/api/products/(?P<id>\d+)", update_product, "write", None),
+    ("DELETE", r"/api/products/(?P<id>\d+)", delete_product, "write", None),
+    ("GET", r"/api/products/(?P<id>\d+)/recipe", get_recipe, "read", None),
+    ("PUT", r"/api/products/(?P<id>\d+)/recipe", set_recipe, "write", None),
+    ("GET", r"/api/products/(?P<id>\d+)/movements", stock_movements, "read", None),
+    ("GET", r"/api/products/(?P<id>\d+)/stock", stock_at, "read", None),
+    ("GET", r"/api/users", list_users, "read", "users"),
+    ("POST", r"/api/users", create_user, "write", None),
+    ("GET", r"/api/users/(?P<id>\d+)", get_user, "read", None),
+    ("DELETE", r"/api/users/(?P<id>\d+)", delete_user, "write", None),
+    ("POST", r"/api/stock-check", check_stock, "read", None),
+    ("POST", r"/api/sales", record_sale, "write", None),
+    ("POST", r"/api/payments", record_payment, "write", None),
+    ("POST", r"/api/purchases", record_purchase, "write", None),
+    ("GET", r"/api/history", history, "read", None),
+    ("GET", r"/api/summary", summary, "read", None),
+    ("GET", r"/api/analytics/sales", sales_analytics, "read", None),
+]
+ROUTES = [(method, re.compile(pattern + "$"), handler, kind, etag) for method, pattern, handler, kind, etag in ROUTES]
+
+def _read_only():
+    # Before every read: the reader's pooled connection refuses writes, whatever a handler does.
+    # Set each time because close_connections() / configure() hand the thread a new connection.
+    database.get_connection().execute("PRAGMA query_only = ON")
+
+def _run_read(handler, params, query, body, etag_counter, if_none_match):
+    _read_only()
+    etag = _etag(etag_counter) if etag_counter else None  # read before the rows: a race only costs a refetch
+    if etag and if_none_match == etag:
+        return 304, None, etag
+    return (*_result(handler(params, query, body)), etag)
+
+def _run_write(handler, params, query, body):
+    return (*_result(handler(params, query, body)), None)
+
+def _result(result):
+    return result if isinstance(result, tuple) else (200, result)
+
+class ApiServer:
+    def __init__(self, host="127.0.0.1", port=8765, readers=4):
+        self.host, self.port = host, port
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="api-writer")
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="api-reader")
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        for pool in (self.writer, self.readers):
+            pool.shutdown(wait=True)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HttpError as e:
+                    writer.write(self._response(e.status, e.payload, {}, False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, target, headers, body = request
+                status, payload, extra = await self.dispatch(method, target, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(self._response(status, payload, extra, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        try:
+            method, target, _ = line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise HttpError(400, "Solicitud HTTP inválida")
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY:
+            raise HttpError(413, "Cuerpo demasiado grande")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), target, headers, body
+
+    async def dispatch(self, method, target, headers, body):
+        """(status, payload, extra headers) for one request."""
+        if method == "OPTIONS":  # CORS preflight from the web-port dev server
+            return 204, None, {"Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
+                               "Access-Control-Allow-Headers": "Content-Type, If-None-Match"}
+        url = urlsplit(target)
+        query = dict(parse_qsl(url.query))
+        allowed = False
+        for route_method, pattern, handler, kind, etag_counter in ROUTES:
+            match = pattern.match(url.path)
+            if not match:
+                continue
+            allowed = True
+            if route_method != method:
+                continue
+            loop = asyncio.get_running_loop()
+            try:
+                data = json.loads(body) if body else {}
+                if kind == "read":
+                    status, payload, etag = await loop.run_in_executor(
+                        self.readers, _run_read, handler, match.groupdict(), query, data,
+                        etag_counter, headers.get("if-none-match"))
+                else:
+                    status, payload, etag = await loop.run_in_executor(
+                        self.writer, _run_write, handler, match.groupdict(), query, data)
+            except HttpError as e:
+                return e.status, e.payload, {}
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                return 400, {"error": str(e)}, {}
+            except Exception as e:
+                return 500, {"error": str(e)}, {}
+            return status, payload, {"ETag": etag} if etag else {}
+        if allowed:
+            return 405, {"error": f"Método no permitido: {method}"}, {}
+        return 404, {"error": f"Ruta desconocida: {url.path}"}, {}
+
+    @staticmethod
+    def _response(status, payload, extra, keep_alive):
+        body = b"" if payload is None or status in (204, 304) else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers = {"Content-Type": "application/json; charset=utf-8", "Content-Length": str(len(body)),
+                   "Access-Control-Allow-Origin": "*", "Access-Control-Expose-Headers": "ETag",
+                   "Connection": "keep-alive" if keep_alive else "close", **extra}
+        head = f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+        return (head + "\r\n").encode("latin-1") + body
+
+def main():
+    parser = argparse.ArgumentParser(description="API HTTP/JSON local sobre la base de datos de Afterword")
+    parser.add_argument("--host", default="127.0.0.1", help="0.0.0.0 para aceptar otras terminales de la red")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--readers", type=int, default=4, help="conexiones de solo lectura concurrentes")
+    args = parser.parse_args()
+    database.init_db()
+    print(f"Sirviendo en http://{args.host}:{args.port}/api/")
+    try:
+        asyncio.run(ApiServer(args.host, args.port, args.readers).serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
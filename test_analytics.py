@@ -0,0 +1,56 @@
+import analytics
+import database
+from test_db import temp_db
+
+def add_sale(product_id, quantity, total, day, method="Efectivo"):
+    with database.transaction() as cursor:
+        cursor.execute("INSERT INTO sales (product_id, quantity, total_price, sale_date, method) VALUES (?, ?, ?, ?, ?)",
+                       (product_id, quantity, total, day + " 10:00:00", method))
+
+def test_buckets_and_groupings():
+    with temp_db():
+        agua = database.add_product("Agua", 3000.0, 100, "bebidas")
+        barra = database.add_product("Barra", 5000.0, 100, "")
+        add_sale(agua, 2, 6000.0, "2026-01-05")              # Monday
+        add_sale(agua, 1, 3000.0, "2026-01-11", "Nequi")     # Sunday, same week
+        add_sale(barra, 1, 5000.0, "2026-01-12")
+        add_sale(barra, 3, 15000.0, "2026-02-01")
+        database.record_purchase(agua, 10, 12000.0)
+
+        assert analytics.sales_series("week") == [("2026-01-05", None, 9000.0, 3, 2), ("2026-01-12", None, 5000.0, 1, 1),
+                                                  ("2026-01-26", None, 15000.0, 3, 1)]
+        assert analytics.sales_series("month", "category", until="2026-02-01") == [
+            ("2026-01-01", "Sin categoría", 5000.0, 1, 1), ("2026-01-01", "bebidas", 9000.0, 3, 2)]
+        assert analytics.sales_series("month", "method", since="2026-01-06") == [
+            ("2026-01-01", "Efectivo", 5000.0, 1, 1), ("2026-01-01", "Nequi", 3000.0, 1, 1),
+            ("2026-02-01", "Efectivo", 15000.0, 3, 1)]
+        assert analytics.sales_series("day", "product", "2026-02-01", "2026-02-02") == [("2026-02-01", barra, 15000.0, 3, 1)]
+
+        this_month = analytics.month_start()
+        assert analytics.purchases_series("month", "product", since=this_month) == [(this_month, agua, 12000.0, 10, 1)]
+        assert analytics.trend("month")[:2] == [("2026-01-01", 14000.0, 0.0), ("2026-02-01", 15000.0, 0.0)]
+        assert database.rebuild_aggregates() == []
+
+def test_rollup_reads_skip_sales():
+    with temp_db():
+        statements = []
+        conn = database.get_connection()
+        conn.set_trace_callback(statements.append)
+        try:
+            analytics.sales_series("month", "category", "2026-01-01", "2027-01-01")
+        finally:
+            conn.set_trace_callback(None)
+        plan = " ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + statements[-1]))
+        assert "FROM sales_daily r" in statements[-1]
+        assert "SEARCH r USING PRIMARY KEY (day>? AND day<?)" in plan and "SCAN" not in plan
+
+def test_month_start():
+    from datetime import date
+    assert analytics.month_start(0, date(2026, 3, 15)) == "2026-03-01"
+    assert analytics.month_start(11, date(2026, 3, 15)) == "2025-04-01"
+
+if __name__ == "__main__":
+    test_buckets_and_groupings()
+    test_rollup_reads_skip_sales()
+    test_month_start()
+    print("Analytics OK")
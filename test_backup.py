@@ -0,0 +1,112 @@
+import os
+import sqlite3
+import tempfile
+import threading
+
+import backup
+import database
+from test_db import temp_db
+
+def seed(sales=200):
+    database.add_product("Agua", 4000.0, 100000, "bebidas")
+    database.add_user("Cliente", "300")
+    database.record_sales_batch([(1, 1, 4000.0)] * sales, 1)
+
+def count(path, table="sales"):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    finally:
+        conn.close()
+
+def test_backup_and_rotation():
+    with temp_db() as db, tempfile.TemporaryDirectory() as tmp:
+        seed()
+        results = [backup.run_backup(tmp, keep=2, pages=4, pause=0) for _ in range(3)]
+        assert [r.path for r in results[1:]] == backup.get_backups(tmp)
+        last = results[-1]
+        assert last.files == [os.path.basename(db)] and last.pages > 0 and last.bytes > 0
+        copy = os.path.join(last.path, os.path.basename(db))
+        assert count(copy) == 200
+        conn = sqlite3.connect(copy)
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+        conn.close()
+        assert any(row[0] == "backup" for row in backup.diagnostics.snapshot())
+    print("Backup OK")
+
+def test_backup_while_writing():
+    with temp_db() as db, tempfile.TemporaryDirectory() as tmp:
+        seed(2000)
+        done = threading.Event()
+
+        def writer():
+            while not done.is_set():
+                database.record_sale(1, 1, 4000.0, 1)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            result = backup.run_backup(tmp, pages=1, pause=0.001, max_restarts=2)
+        finally:
+            done.set()
+            thread.join()
+        copied = count(os.path.join(result.path, os.path.basename(db)))
+        assert 2000 <= copied <= count(db)
+    print("Backup under writes OK")
+
+def test_backup_includes_archives():
+    with temp_db() as db, tempfile.TemporaryDirectory() as tmp:
+        seed(3)
+        with database.transaction() as cursor:
+            cursor.execute("INSERT INTO sales (product_id, user_id, quantity, total_price, sale_date) "
+                           "VALUES (1, 1, 1, 4000, '2023-05-01 10:00:00')")
+        database.archive_year(2023)
+        result = backup.run_backup(tmp)
+        archive = os.path.basename(database.archive_path(2023))
+        assert result.files == [os.path.basename(db), archive]
+        assert count(os.path.join(result.path, archive)) == 1
+
+        # The backup folder works as a database on its own
+        previous = database.DB_NAME
+        database.configure(os.path.join(result.path, os.path.basename(db)))
+        try:
+            assert len(database.get_user_purchases(1)) == 4
+        finally:
+            database.configure(previous)
+    print("Backup with archives OK")
+
+def test_backup_service():
+    with temp_db(), tempfile.TemporaryDirectory() as tmp:
+        seed(3)
+        service = backup.BackupService(directory=tmp).start()
+        try:
+            result = service.run_now().result(timeout=30)
+            assert service.last_result == result and service.last_error is None
+            assert backup.get_backups(tmp) == [result.path]
+        finally:
+            service.stop(timeout=30)
+    print("Backup service OK")
+
+def test_corrupt_copy_is_not_published():
+    with temp_db(), tempfile.TemporaryDirectory() as tmp:
+        seed(3)
+        original = backup.copy_database
+        def corrupt(source, target, **options):
+            raise backup.BackupError("Respaldo dañado")
+        backup.copy_database = corrupt
+        try:
+            backup.run_backup(tmp)
+            assert False, "corrupt backup published"
+        except backup.BackupError:
+            pass
+        finally:
+            backup.copy_database = original
+        assert os.listdir(tmp) == []
+    print("Corrupt backup OK")
+
+if __name__ == "__main__":
+    test_backup_and_rotation()
+    test_backup_while_writing()
+    test_backup_includes_archives()
+    test_backup_service()
+    test_corrupt_copy_is_not_published()
@@ -0,0 +1,21 @@
+import json
+
+import bench
+import database
+
+TINY = {"insumos": 10, "products": 10, "compounds": 6, "recipe_depth": 2, "users": 5,
+        "days": 3, "sales_per_day": 5, "payments_per_day": 2, "purchases_per_day": 1}
+
+def test_bench_runs_on_tiny_dataset():
+    previous = database.DB_NAME
+    report = bench.run(TINY, repeat=1)
+    assert database.DB_NAME == previous  # the temp database is never left configured
+    assert report["meta"]["rows"]["sales"] >= 15
+    assert {"record_sale_compound", "get_combined_history_full", "get_financial_summary",
+            "get_user_financial_history", "search_prefix"} <= set(report["results"])
+    json.dumps(report)
+    assert bench.compare(report, report)[0].endswith("(1.00x)")
+
+if __name__ == "__main__":
+    test_bench_runs_on_tiny_dataset()
+    print("Bench OK")
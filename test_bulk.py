@@ -0,0 +1,108 @@
+import io
+import json
+
+import bulk
+import database
+from test_db import temp_db
+
+WEB_BACKUP = {
+    "products": [
+        {"id": 1, "name": "Creatina Monohidratada", "price": 0, "stock": 1000, "category": "Insumos", "type": "INSUMO", "unit": "gr"},
+        {"id": 2, "name": "Whey Protein Vainilla", "price": 95000, "stock": 10, "category": "Proteínas", "type": "PRODUCTO SIMPLE", "unit": "unid"},
+        {"id": 3, "name": "Batido Energético", "price": 12000, "stock": 0, "category": "Combos", "type": "PRODUCTO COMPUESTO", "unit": "unid"},
+    ],
+    "users": [{"id": 1700000000101, "name": "Baki Hanma", "phone": "3001234567", "balance": 24000}],
+    "recipes": [{"id": 501, "productId": 3, "ingredientId": 1, "quantity": 5}],
+    "sales": [{"id": 1700000000201, "productId": 3, "quantity": 2, "totalPrice": 24000, "userId": 1700000000101,
+               "method": "Nequi", "saleDate": "2026-01-31T15:04:05.123Z"}],
+    "payments": [],
+    "purchases": [{"id": 1700000000301, "productId": 1, "quantity": 1000, "costPrice": 80000, "date": "2026-01-30T10:00:00.000Z"}],
+}
+
+def test_import_web_backup_and_export_round_trip():
+    with temp_db():
+        counts = bulk.import_web_backup(io.StringIO(json.dumps(WEB_BACKUP)))
+        assert counts == {"products": 3, "users": 1, "recipes": 1, "sales": 1, "purchases": 1}
+
+        assert [p[5] for p in database.get_products()] == ["INSUMO", "PRODUCTO", "COMPUESTO"]
+        assert database.get_users()[0][3] == -24000  # web debt is positive, here it is negative
+        assert database.get_sales_history()[0][5] == "2026-01-31 15:04:05"
+        assert database.get_flattened_recipe(3) == [(1, 5.0)]
+        # Triggers were dropped during the load; the totals were rebuilt and indexes are back
+        assert database.get_financial_summary()[:2] == (24000.0, 80000.0)
+        assert database.rebuild_aggregates() == []
+        indexes = {row[0] for row in database.get_connection().execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert "idx_sales_user_date" in indexes
+
+        out = io.StringIO()
+        bulk.export_web_backup(out)
+        exported = json.loads(out.getvalue())
+        assert exported["products"][2]["type"] == "PRODUCTO COMPUESTO"
+        assert exported["users"][0]["balance"] == 24000
+        assert exported["sales"][0]["saleDate"] == "2026-01-31T15:04:05.000Z"
+        assert exported["sales"][0]["method"] == "Nequi"
+
+def test_csv_price_list_upserts_and_streams():
+    with temp_db():
+        database.add_product("Agua", 3000.0, 10, "bebidas")
+        price_list = io.StringIO("id,name,price,stock,category\n1,Agua,3500,10,bebidas\n,Barra,5000,20,snacks\n")
+        assert bulk.import_csv("products", price_list) == 2
+        assert [(p[1], p[2]) for p in database.get_products()] == [("Agua", 3500.0), ("Barra", 5000.0)]
+        assert database.get_stock_movements(2)[0][1:3] == (20, "IMPORTACION")  # stock loaded is journaled
+        assert database.get_stock_drift() == []
+
+        # Many chunks; memory holds one chunk at a time
+        rows = ({"product_id": 1, "quantity": 1, "total_price": 3500.0, "sale_date": f"2026-01-01 10:{i // 60 % 60:02d}:{i % 60:02d}"}
+                for i in range(2500))
+        assert bulk.import_rows({"sales": rows}, chunk_size=1000) == {"sales": 2500}
+        assert database.get_financial_summary()[0] == 2500 * 3500.0  # triggers kept (table had rows)
+
+        out = io.StringIO()
+        assert bulk.export_csv("sales", out) == 2500
+        assert out.getvalue().splitlines()[0] == "id,product_id,user_id,quantity,total_price,sale_date,method"
+
+def test_empty_cells_get_defaults():
+    for seeded in (True, False):  # triggers kept / indexes and totals rebuilt at the end
+        with temp_db():
+            if seeded:
+                database.add_product("Agua", 3000.0, 10, "bebidas")
+            else:
+                bulk.import_csv("products", io.StringIO("id,name,price,stock\n1,Agua,3000,10\n"))
+            sales = io.StringIO("product_id,user_id,quantity,total_price,sale_date,method\n"
+                                "1,,1,3000,2026-01-05 10:00:00,Nequi\n1,,2,6000,,\n")
+            assert bulk.import_csv("sales", sales) == 2
+            defaulted = database.get_connection().execute(
+                "SELECT sale_date IS NOT NULL, method FROM sales WHERE quantity = 2").fetchone()
+            assert defaulted == (1, "Efectivo")  # CURRENT_TIMESTAMP and the method's default, not NULLs
+            assert len(database.get_sales_history()) == 2
+            assert len(database.get_combined_history_page(limit=10)) == 2
+            assert database.get_financial_summary()[0] == 9000.0
+
+            # An upsert leaves the columns it has no value for alone
+            category = database.get_products()[0].category
+            bulk.import_csv("products", io.StringIO("id,name,price,stock,category\n1,Agua,3500,10,\n"))
+            assert database.get_products()[0][1:5] == ("Agua", 3500.0, 10, category)
+
+def test_bad_imports_roll_back():
+    with temp_db():
+        database.add_product("Agua", 3000.0, 10, "bebidas")
+        try:
+            bulk.import_rows({"sales": [{"product_id": 1, "quantity": 1, "total_price": 1.0},
+                                        {"product_id": 99, "quantity": 1, "total_price": 1.0}]})
+            assert False, "dangling product accepted"
+        except bulk.BulkImportError as e:
+            assert "sales" in str(e)
+        try:
+            bulk.import_csv("products", io.StringIO("name,precio\nAgua,1\n"))
+            assert False, "unknown column accepted"
+        except bulk.BulkImportError:
+            pass
+        assert database.get_sales_history() == []
+        assert len(database.get_products()) == 1
+
+if __name__ == "__main__":
+    test_import_web_backup_and_export_round_trip()
+    test_csv_price_list_upserts_and_streams()
+    test_empty_cells_get_defaults()
+    test_bad_imports_roll_back()
+    print("Bulk OK")
@@ -0,0 +1,66 @@
+import database
+from costing import CostEngine
+from test_db import temp_db
+
+def test_rollup_and_incremental_recompute():
+    with temp_db():
+        leche = database.add_product("Leche", 2.0, 1000, "insumos", "INSUMO", "ml")
+        whey = database.add_product("Whey", 50.0, 1000, "insumos", "INSUMO", "gr")
+        agua = database.add_product("Agua", 3000.0, 10, "bebidas")
+        base = database.add_product("Base batido", 0, 0, "bases", "COMPUESTO")
+        batido = database.add_product("Batido", 8000.0, 0, "bebidas", "COMPUESTO")
+        combo = database.add_product("Combo", 10000.0, 0, "combos", "COMPUESTO")
+        database.set_recipe(base, [(leche, 200), (whey, 30)])      # 400 + 1500
+        database.set_recipe(batido, [(base, 1), (leche, 50)])      # 1900 + 100
+        database.set_recipe(combo, [(batido, 1), (agua, 1)])
+
+        engine = CostEngine()
+        assert engine.cost(base) == 1900
+        assert engine.cost(batido) == 2000
+        assert engine.cost(combo) is None  # Agua was never bought
+
+        database.record_purchase(agua, 10, 15000.0)
+        assert engine.cost(combo) == 3500
+        assert engine.last_recomputed == {agua, combo}
+
+        # A new whey price only touches whey and what is made from it
+        database.update_ingredient_unit_cost(whey, 6000.0, 100)
+        assert engine.cost(batido) == 2300
+        assert engine.last_recomputed == {whey, base, batido, combo}
+
+        before = engine.last_recomputed
+        engine.cost(batido)  # nothing changed: no re-read, no recompute
+        assert engine.last_recomputed is before
+
+        margins = {row[0]: row for row in engine.margins()}
+        assert leche not in margins and base in margins
+        assert margins[batido][3:] == (2300, 5700, 71.25)
+        assert margins[combo][3] == 3800
+        assert [row[0] for row in engine.margins()] == [agua, combo, batido, base]  # base sells at 0: no %
+
+def test_cycles_and_deleted_ingredients():
+    edges = [(1, 2, 1), (2, 1, 1), (3, 4, 2)]
+    products = [(1, "A", "COMPUESTO", 10.0, None), (2, "B", "COMPUESTO", 10.0, None),
+                (3, "C", "COMPUESTO", 10.0, None)]
+    engine = CostEngine(lambda: products, lambda: edges, lambda: 1)
+    assert engine.all_costs() == {1: None, 2: None, 3: None}
+
+def test_cost_survives_archiving():
+    with temp_db():
+        agua = database.add_product("Agua", 3000.0, 10, "bebidas")
+        with database.transaction() as cursor:
+            cursor.execute("INSERT INTO purchases (product_id, quantity, cost_price, purchase_date) "
+                           "VALUES (?, 10, 15000, '2020-03-01 09:00:00')", (agua,))
+        engine = CostEngine()
+        assert engine.cost(agua) == 1500
+        database.archive_year(2020)
+        assert engine.cost(agua) == 1500  # the last purchase now lives in the 2020 archive
+
+        database.record_purchase(agua, 10, 18000.0)
+        assert engine.cost(agua) == 1800  # a newer purchase in the main file wins
+
+if __name__ == "__main__":
+    test_rollup_and_incremental_recompute()
+    test_cycles_and_deleted_ingredients()
+    test_cost_survives_archiving()
+    print("Costing OK")
@@ -1,5 +1,34 @@
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import database
+import diagnostics
 from database import init_db, add_product, get_products, update_product, delete_product, record_sale, get_sales_history
 
+@contextmanager
+def temp_db(initialized=True):
+    """Points database.py at a fresh, initialized temporary database file.
+
+    The slow-query log goes into the same temporary folder.
+    """
+    previous, slow_log = database.DB_NAME, diagnostics.SLOW_LOG
+    with tempfile.TemporaryDirectory() as tmp:
+        database.configure(os.path.join(tmp, "test.db"))
+        diagnostics.SLOW_LOG = os.path.join(tmp, "slow_queries.log")
+        try:
+            if initialized:
+                init_db()
+            yield database.DB_NAME
+        finally:
+            database.configure(previous)
+            diagnostics.SLOW_LOG = slow_log
+            for handler in list(diagnostics.slow_log.handlers):  # release the file before tmp goes
+                diagnostics.slow_log.removeHandler(handler)
+                handler.close()
+
 def test_db():
     print("Testing database...")
     init_db()
@@ -36,5 +65,473 @@ def test_db():
     
     print("All tests passed!")
 
+def test_connection_pool():
+    with temp_db():
+        conn = database.get_connection()
+        assert database.get_connection() is conn
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+        # Each thread gets its own long-lived connection
+        other = []
+        t = threading.Thread(target=lambda: other.append(database.get_connection()))
+        t.start(); t.join()
+        assert other[0] is not conn
+
+        # A long-lived thread reopens after close_connections() / configure() from another thread
+        ask, answered, answer = threading.Event(), threading.Event(), []
+        def worker():
+            for _ in range(2):
+                ask.wait(); ask.clear()
+                connection = database.get_connection()
+                answer.append((connection, connection.execute("PRAGMA database_list").fetchone()[2]))
+                answered.set()
+        t = threading.Thread(target=worker)
+        t.start()
+        ask.set()
+        answered.wait()
+        with temp_db() as second:
+            ask.set()
+            t.join()
+        assert answer[1][0] is not answer[0][0] and answer[1][1] == second
+        conn = database.get_connection()
+
+        # A failing transaction leaves nothing behind
+        try:
+            with database.transaction() as cursor:
+                cursor.execute("INSERT INTO users (name, phone) VALUES ('Rollback', '')")
+                raise RuntimeError("boom")
+        except RuntimeError:
+            pass
+        assert database.get_users() == []
+        print("Connection pool OK")
+
+def test_aggregates():
+    with temp_db():
+        database.add_product("Agua", 4000.0, 20, "bebidas")
+        database.add_user("Cliente", "300")
+        record_sale(1, 2, 8000.0, 1)
+        record_sale(1, 1, 4000.0)
+        database.record_payment(1, 5000.0, "Nequi")
+        database.record_purchase(1, 10, 20000.0)
+
+        total_sales, total_purchases, user_sales = database.get_financial_summary()
+        assert (total_sales, total_purchases) == (12000.0, 20000.0)
+        assert user_sales == [(1, "Cliente", 8000.0, -3000.0)]
+        assert database.get_user_financial_totals(1) == (8000.0, 5000.0)
+        assert database.get_user_financial_totals(99) == (0.0, 0.0)
+        day = database.get_connection().execute("SELECT date(sale_date) FROM sales").fetchone()[0]
+        assert database.get_daily_totals(day) == (12000.0, 5000.0, 20000.0)
+
+        assert database.rebuild_aggregates() == []
+        database.get_connection().execute("UPDATE user_totals SET total_bought = 0")
+        assert database.rebuild_aggregates() == [("user_totals", 1, (0.0, 1, 5000.0), (8000.0, 1, 5000.0))]
+        assert database.get_user_financial_totals(1) == (8000.0, 5000.0)
+        print("Aggregates OK")
+
+def test_flattened_recipes():
+    with temp_db():
+        database.add_product("Leche", 8.0, 1000, "insumos", "INSUMO", "ml")
+        database.add_product("Proteina", 100.0, 500, "insumos", "INSUMO", "gr")
+        database.add_product("Base Batido", 0.0, 0, "", "COMPUESTO")
+        database.add_product("Batido", 12000.0, 0, "bebidas", "COMPUESTO")
+        database.set_recipe(3, [(1, 200), (2, 10)])
+        database.set_recipe(4, [(3, 1), (2, 30)])
+        assert sorted(database.get_flattened_recipe(4)) == [(1, 200.0), (2, 40.0)]
+        assert database.get_flattened_recipe(1) == [(1, 1)]
+
+        record_sale(4, 2, 24000.0)
+        stock = {p[0]: p[3] for p in get_products()}
+        assert (stock[1], stock[2]) == (600, 420)
+
+        # Editing a recipe invalidates the cached expansion
+        database.set_recipe(3, [(1, 100)])
+        assert sorted(database.get_flattened_recipe(4)) == [(1, 100.0), (2, 30.0)]
+
+        # Cycles are rejected and leave the previous recipe untouched
+        for bad in ([(4, 1)], [(3, 1)]):
+            try:
+                database.set_recipe(3, bad)
+                assert False, "cycle accepted"
+            except ValueError:
+                pass
+        assert database.get_recipe(3) == [(1, "Leche", 100.0)]
+
+        # Readers on other threads while the recipe keeps changing never cache a stale expansion
+        done = threading.Event()
+        def reader():
+            while not done.is_set():
+                database.get_flattened_recipe(4)
+        readers = [threading.Thread(target=reader) for _ in range(3)]
+        for t in readers: t.start()
+        for grams in range(100, 140):
+            database.set_recipe(3, [(1, grams)])
+        done.set()
+        for t in readers: t.join()
+        assert sorted(database.get_flattened_recipe(4)) == [(1, 139.0), (2, 30.0)]
+        print("Flattened recipes OK")
+
+def test_sales_batch():
+    with temp_db():
+        database.add_product("Leche", 8.0, 1000, "insumos", "INSUMO", "ml")
+        database.add_product("Batido", 12000.0, 0, "bebidas", "COMPUESTO")
+        database.add_product("Agua", 4000.0, 10, "bebidas")
+        database.set_recipe(2, [(1, 250)])
+        database.add_user("Cliente", "300")
+
+        database.record_sales_batch([(2, 2, 24000.0), (3, 3, 12000.0), (2, 1, 12000.0)], 1, "Nequi")
+        stock = {p[0]: p[3] for p in get_products()}
+        assert (stock[1], stock[3]) == (250, 7)
+        assert len(get_sales_history()) == 3
+        assert database.get_users()[0][3] == -48000.0
+
+        # All or nothing: a bad line rolls back the whole cart
+        try:
+            database.record_sales_batch([(3, 1, 4000.0), (3, 1, None)])
+            assert False, "invalid line accepted"
+        except Exception:
+            pass
+        assert {p[0]: p[3] for p in get_products()}[3] == 7
+        assert len(get_sales_history()) == 3
+        print("Sales batch OK")
+
+def test_stock_reservation():
+    with temp_db():
+        database.add_product("Leche", 8.0, 600, "insumos", "INSUMO", "ml")
+        database.add_product("Batido", 12000.0, 0, "bebidas", "COMPUESTO")
+        database.add_product("Agua", 4000.0, 7, "bebidas")
+        database.set_recipe(2, [(1, 250)])
+
+        # Every shortage is reported and nothing is recorded
+        cart = [(2, 2, 24000.0), (3, 5, 20000.0), (2, 1, 12000.0), (3, 3, 12000.0)]
+        expected = [database.Shortage(1, "Leche", 750, 600), database.Shortage(3, "Agua", 8, 7)]
+        assert database.check_stock(cart) == expected
+        try:
+            database.record_sales_batch(cart)
+            assert False, "oversold"
+        except database.InsufficientStockError as e:
+            assert e.shortages == expected
+            assert "Leche" in str(e)
+        assert [p[3] for p in get_products()] == [600, 0, 7]
+        assert get_sales_history() == []
+
+        # Two stations selling the last units at once: exactly one sale goes through
+        barrier, results = threading.Barrier(2), []
+        def station():
+            barrier.wait()
+            try:
+                database.record_sale(3, 5, 20000.0)
+                results.append("ok")
+            except database.InsufficientStockError:
+                results.append("short")
+        threads = [threading.Thread(target=station) for _ in range(2)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert sorted(results) == ["ok", "short"]
+        assert [p[3] for p in get_products()] == [600, 0, 2]
+
+        # A writer holding the lock past the busy timeout: the sale retries instead of failing
+        timeout, delay = database.BUSY_TIMEOUT, database.RETRY_DELAY
+        database.BUSY_TIMEOUT, database.RETRY_DELAY = 0.05, 0.1
+        database.close_connections()
+        try:
+            blocker = database.connect_db()
+            blocker.execute("BEGIN IMMEDIATE")
+            release = threading.Timer(0.15, blocker.commit)
+            release.start()
+            database.record_sale(3, 1, 4000.0)
+            release.join()
+            blocker.close()
+        finally:
+            database.BUSY_TIMEOUT, database.RETRY_DELAY = timeout, delay
+            database.close_connections()
+        assert get_products()[2][3] == 1
+        print("Stock reservation OK")
+
+def test_history_pages():
+    with temp_db():
+        database.add_product("Agua", 4000.0, 100, "bebidas")
+        database.add_user("Cliente", "300")
+        for i in range(7):
+            record_sale(1, 1, 4000.0, 1)
+            database.record_payment(1, 1000.0, "Efectivo")
+
+        # Same-second rows must neither repeat nor go missing across pages
+        pages, before = [], None
+        while True:
+            page = database.get_combined_history_page(before, limit=3)
+            if not page: break
+            pages.extend(page)
+            before = database.history_key(page[-1])
+        assert sorted(pages) == sorted(database.get_combined_history())
+        assert len(set(pages)) == 14
+
+        user_rows, before = [], None
+        while True:
+            page = database.get_user_financial_history_page(1, before, limit=4)
+            if not page: break
+            user_rows.extend(page)
+            before = database.history_key(page[-1])
+        assert sorted(user_rows) == sorted(database.get_user_financial_history(1))
+
+        for i in range(5):
+            database.add_product(f"Item {i}", 1.0, 1, "varios")
+        first = database.get_products_page(None, 3, "item")
+        rest = database.get_products_page(first[-1][0], 3, "item")
+        assert [p[1] for p in first + rest] == [f"Item {i}" for i in range(5)]
+        print("History pages OK")
+
+def test_history_filters():
+    with temp_db():
+        database.add_product("Agua", 4000.0, 100, "bebidas")
+        database.add_user("Ana", "300")
+        database.add_user("Beto", "301")
+        with database.transaction() as cursor:
+            for day in range(1, 11):
+                date = f"2026-01-{day:02d} 10:00:00"
+                cursor.execute("INSERT INTO sales (product_id, quantity, total_price, user_id, sale_date) VALUES (1, 1, 4000, ?, ?)",
+                               (1 + day % 2, date))
+                cursor.execute("INSERT INTO payments (user_id, amount, method, payment_date) VALUES (1, 1000, 'Nequi', ?)", (date,))
+
+        january = database.get_combined_history(since="2026-01-03", until="2026-01-06")
+        assert {row[5][:10] for row in january} == {"2026-01-03", "2026-01-04", "2026-01-05"}
+        assert len(january) == 6
+        assert {row[1] for row in database.get_combined_history(kind="PAGO")} == {"PAGO"}
+        assert len(database.get_combined_history(kind="VENTA", user_id=2)) == 5
+        assert len(database.get_combined_history(user_id=1)) == 15
+
+        # The generators page with keyset queries and yield the same rows as the wrappers
+        stream = database.iter_sales_history(user_id=1, batch=2)
+        assert next(stream)[5] == "2026-01-10 10:00:00"
+        assert len(list(stream)) == 4
+        assert list(database.iter_combined_history(batch=3)) == database.get_combined_history()
+        assert [row[0] for row in database.get_sales_history(until="2026-01-03")] == [2, 1]
+        try:
+            database.get_combined_history(kind="COMPRA")
+            assert False, "unknown kind accepted"
+        except ValueError:
+            pass
+        print("History filters OK")
+
+def test_table_cache():
+    with temp_db():
+        database.add_product("Agua", 4000.0, 10, "bebidas")
+        database.add_user("Ana", "300")
+        before = database.cache_stats().get("products", {"hits": 0, "misses": 0})
+
+        first = get_products()
+        assert get_products() == first
+        stats = database.cache_stats()["products"]
+        assert (stats["misses"] - before["misses"], stats["hits"] - before["hits"]) == (1, 1)
+
+        # Every write path that touches the rows invalidates the cached copy
+        ledger = database.get_change_counters()["ledger"]
+        record_sale(1, 2, 8000.0, 1)
+        assert database.get_change_counters()["ledger"] == ledger + 1
+        assert get_products()[0][3] == 8
+        assert database.get_users()[0][3] == -8000.0
+        database.record_payment(1, 3000.0, "Nequi")
+        assert database.get_users()[0][3] == -5000.0
+        database.record_purchase(1, 5, 10000.0)
+        assert get_products()[0][3] == 13
+        update_product(1, "Agua grande", 5000.0, 13, "bebidas")
+        database.add_user("Beto", "301")
+        assert get_products()[0][1] == "Agua grande"
+        assert [u[1] for u in database.get_users()] == ["Ana", "Beto"]
+
+        # Callers get their own list
+        get_products().clear()
+        assert len(get_products()) == 1
+        print("Table cache OK")
+
+def test_init_db_is_noop_when_current():
+    with temp_db():
+        conn = database.get_connection()
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            init_db()
+        finally:
+            conn.set_trace_callback(None)
+        assert statements == ["PRAGMA user_version"]
+        print("Init no-op OK")
+
+def test_migrations():
+    # A file written by the first release: no versioning, no type/unit/user_id columns
+    with temp_db(initialized=False):
+        conn = database.get_connection()
+        conn.executescript('''
+            CREATE TABLE products (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, price REAL NOT NULL,
+                                   stock INTEGER NOT NULL, category TEXT);
+            CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, phone TEXT, balance REAL DEFAULT 0.0);
+            CREATE TABLE sales (id INTEGER PRIMARY KEY AUTOINCREMENT, product_id INTEGER NOT NULL, quantity INTEGER NOT NULL,
+                                total_price REAL NOT NULL, sale_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+            INSERT INTO products (name, price, stock, category) VALUES ('Agua', 4000, 10, 'bebidas');
+            INSERT INTO sales (product_id, quantity, total_price) VALUES (1, 2, 8000);
+        ''')
+        init_db()
+        assert database.get_schema_version() == database.SCHEMA_VERSION
+        assert get_products()[0][1:] == ("Agua", 4000.0, 10, "bebidas", "PRODUCTO", "unid")
+        assert database.get_financial_summary()[0] == 8000.0  # aggregates built from the old ledger
+        assert database.rebuild_aggregates() == []
+
+    # A failing step leaves the file exactly as it was
+    with temp_db(initialized=False):
+        database.MIGRATIONS.append(("CREATE TABLE broken (",))
+        try:
+            init_db()
+            assert False, "broken migration applied"
+        except Exception:
+            pass
+        finally:
+            database.MIGRATIONS.pop()
+        tables = database.get_connection().execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        assert tables == [] and database.get_schema_version() == 0
+
+    # Files from a newer build are refused instead of being downgraded
+    with temp_db():
+        database.get_connection().execute(f"PRAGMA user_version = {database.SCHEMA_VERSION + 1}")
+        try:
+            init_db()
+            assert False, "newer schema accepted"
+        except RuntimeError:
+            pass
+    print("Migrations OK")
+
+def test_archive_year():
+    with temp_db() as path:
+        database.add_product("Agua", 4000.0, 100, "bebidas")
+        database.add_user("Cliente", "300")
+        with database.transaction() as cursor:
+            for day in ("2023-03-01 10:00:00", "2023-11-30 18:00:00", "2024-01-02 09:00:00"):
+                cursor.execute("INSERT INTO sales (product_id, user_id, quantity, total_price, sale_date) VALUES (1, 1, 1, 4000, ?)", (day,))
+                cursor.execute("INSERT INTO payments (user_id, amount, method, payment_date) VALUES (1, 1000, 'Efectivo', ?)", (day,))
+                cursor.execute("INSERT INTO purchases (product_id, quantity, cost_price, purchase_date) VALUES (1, 10, 2000, ?)", (day,))
+        record_sale(1, 1, 4000.0, 1)
+        history = database.get_combined_history()
+        user_history = database.get_user_financial_history(1)
+        summary = database.get_financial_summary()
+        assert database.get_oldest_ledger_year() == 2023
+
+        moved = database.archive_year(2023)
+        assert moved == {"sales": 2, "payments": 2, "purchases": 2}
+        assert os.path.exists(database.archive_path(2023))
+        assert database.get_archives() == [(2023, os.path.basename(database.archive_path(2023)), 2, 2, 2)]
+        assert database.get_oldest_ledger_year() == 2024
+        conn = database.get_connection()
+        assert conn.execute("SELECT COUNT(*) FROM main.sales WHERE sale_date < '2024-01-01'").fetchone()[0] == 0
+
+        # Reads that reach into 2023 see the archived rows, totals never changed
+        assert sorted(database.get_combined_history()) == sorted(history)
+        assert sorted(database.get_user_financial_history(1)) == sorted(user_history)
+        assert len(database.get_user_purchases(1)) == 4
+        page = database.get_combined_history_page(None, 50, "2023-01-01", "2024-01-01")
+        assert [row[5][:10] for row in page] == ["2023-11-30", "2023-11-30", "2023-03-01", "2023-03-01"]
+        assert database._ledger_tables("sales", "2024-01-01") == ["sales"]
+        assert database.get_financial_summary() == summary
+        assert database.rebuild_aggregates() == []
+
+        # New connections attach the archive; archiving again moves nothing twice
+        database.close_connections()
+        assert len(database.get_combined_history()) == len(history)
+        assert database.archive_year(2023) == {"sales": 0, "payments": 0, "purchases": 0}
+        for year in (int(time.strftime("%Y")), 2999):
+            try:
+                database.archive_year(year)
+                assert False, "open year archived"
+            except ValueError:
+                pass
+        database.close_connections()
+    print("Archive OK")
+
+def test_stock_journal():
+    with temp_db():
+        conn = database.get_connection()
+        insumo = add_product("Leche", 100.0, 1000, "insumos", "INSUMO", "ml")
+        batido = add_product("Batido", 8000.0, 0, "bebidas", "COMPUESTO")
+        database.add_recipe_item(batido, insumo, 250)
+        database.record_purchase(insumo, 500, 50000.0)
+        database.record_sales_batch([(batido, 2, 16000.0)])
+        update_product(insumo, "Leche", 100.0, 900, "insumos", "INSUMO", "ml")
+        assert get_products()[0][3] == 900
+
+        moves = database.get_stock_movements(insumo)
+        assert [(m[1], m[2]) for m in moves] == [(-100, "AJUSTE"), (-500, "VENTA"), (500, "COMPRA"), (1000, "ALTA")]
+        assert moves[1][3] == conn.execute("SELECT MAX(id) FROM sales").fetchone()[0]
+        assert database.get_stock_drift() == []
+
+        # Spread the journal over three days: snapshot 1 on the 1st, movements on the 2nd and 3rd
+        conn.execute("UPDATE stock_snapshots SET taken_at = '2026-03-01 00:00:00'")
+        conn.execute("UPDATE stock_movements SET moved_at = '2026-03-02 10:00:00' WHERE reason IN ('ALTA', 'COMPRA')")
+        conn.execute("UPDATE stock_movements SET moved_at = '2026-03-03 10:00:00' WHERE reason IN ('VENTA', 'AJUSTE')")
+        assert database.get_stock_at(insumo, "2026-02-28") is None
+        assert database.get_stock_at(insumo, "2026-03-01") == 0
+        assert database.get_stock_at(insumo, "2026-03-02") == 1500
+        assert database.get_stock_at(insumo, "2026-03-03 09:00:00") == 1500
+        assert database.get_stock_at(insumo, "2026-03-03") == 900
+
+        # A snapshot consolidates the journal; later queries start from it
+        snapshot = database.take_stock_snapshot()
+        conn.execute("UPDATE stock_snapshots SET taken_at = '2026-03-04 00:00:00' WHERE id = ?", (snapshot,))
+        assert conn.execute("SELECT stock FROM stock_snapshot_items WHERE snapshot_id = ? AND product_id = ?",
+                            (snapshot, insumo)).fetchone()[0] == 900
+        conn.execute("INSERT INTO stock_movements (product_id, delta, reason, moved_at) VALUES (?, -50, 'VENTA', '2026-03-05 10:00:00')",
+                     (insumo,))
+        assert database.get_stock_at(insumo, "2026-03-05") == 850
+        assert database.get_stock_at(insumo, "2026-03-02") == 1500
+
+        # The first movement of a new day takes the day's snapshot before it is written
+        database.record_purchase(insumo, 150, 15000.0)
+        assert conn.execute("SELECT COUNT(*) FROM stock_snapshots").fetchone()[0] == 3
+
+        # Changes made behind database.py's back show up as drift until reconciled
+        conn.execute("UPDATE products SET stock = 42 WHERE id = ?", (insumo,))
+        assert database.get_stock_drift() == [(insumo, "Leche", 42, 1000)]
+        database.reconcile_stock()
+        assert database.get_stock_drift() == []
+        assert database.get_stock_movements(insumo, 1)[0][1:3] == (-958, "AJUSTE")
+
+        # Each line of a cart is journaled under its own sale
+        database.record_purchase(insumo, 500, 50000.0)
+        database.record_sales_batch([(batido, 1, 8000.0), (insumo, 10, 1000.0)])
+        first, second = [row[0] for row in conn.execute("SELECT id FROM sales ORDER BY id DESC LIMIT 2")][::-1]
+        assert [(m[1], m[3]) for m in database.get_stock_movements(insumo, 2)] == [(-10, second), (-250, first)]
+        assert database.get_stock_drift() == []
+    print("Stock journal OK")
+
+def test_typed_rows():
+    with temp_db():
+        leche = add_product("Leche", 100.0, 1000, "insumos", "INSUMO", "ml")
+        agua = add_product("Agua", 3000.0, 5, "bebidas")
+        database.add_user("Ana", "300")
+        product = get_products()[1]
+        assert product == (agua, "Agua", 3000.0, 5, "bebidas", "PRODUCTO", "unid")  # still a tuple
+        assert (product.name, product.price, product.unit) == ("Agua", 3000.0, "unid")
+        assert database.get_users()[0].balance == 0.0
+        assert database.get_sale_items() == [database.SaleItem(agua, "Agua", 3000.0, 5, "PRODUCTO")]
+        assert database.get_products_by_ids([leche])[0].type == "INSUMO"
+        assert database.get_users_page(None, 10)[0].name == "Ana"
+
+        # A column added by a later migration doesn't reach the screens
+        database.get_connection().execute("ALTER TABLE products ADD COLUMN barcode TEXT")
+        update_product(agua, "Agua", 3500.0, 5, "bebidas")
+        assert get_products()[1] == (agua, "Agua", 3500.0, 5, "bebidas", "PRODUCTO", "unid")
+        assert database.get_products_page(None, 10)[1].price == 3500.0
+        assert database.get_sale_items()[0].price == 3500.0
+        assert database.cache_stats()["sale_items"]["misses"] == 2
+    print("Typed rows OK")
+
 if __name__ == "__main__":
     test_db()
+    test_connection_pool()
+    test_aggregates()
+    test_flattened_recipes()
+    test_sales_batch()
+    test_stock_reservation()
+    test_history_pages()
+    test_history_filters()
+    test_table_cache()
+    test_init_db_is_noop_when_current()
+    test_migrations()
+    test_archive_year()
+    test_stock_journal()
+    test_typed_rows()
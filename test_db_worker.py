@@ -0,0 +1,65 @@
+import threading
+import time
+
+import database
+from db_worker import DBExecutor
+from test_db import temp_db
+
+class FakeRoot:
+    """Stands in for the Tk root: runs after() callbacks when pumped."""
+
+    def __init__(self):
+        self.scheduled = []
+        self.errors = []
+
+    def after(self, ms, callback):
+        self.scheduled.append(callback)
+
+    def report_callback_exception(self, exc_type, exc, tb):
+        self.errors.append(exc)
+
+    def pump(self, timeout=5):
+        deadline = time.time() + timeout
+        while self.scheduled and time.time() < deadline:
+            callbacks, self.scheduled = self.scheduled, []
+            for callback in callbacks:
+                callback()
+            time.sleep(0.01)
+
+def test_executor_orders_jobs_and_returns_on_tk_thread():
+    with temp_db():
+        root = FakeRoot()
+        db = DBExecutor(root, poll_ms=1)
+        results, threads = [], []
+
+        def done(result):
+            results.append(result)
+            threads.append(threading.current_thread())
+
+        db.submit(database.add_product, "Agua", 2.0, 10, "bebidas", on_done=done)
+        # Queued behind the write, so it sees it; a self-referencing recipe is rejected
+        db.submit(lambda: [p[1] for p in database.get_products()], on_done=done)
+        db.submit(database.add_recipe_item, 1, 1, 1, on_error=lambda e: results.append(type(e)))
+        failing = db.submit(lambda: 1 / 0)
+        root.pump()
+        db.shutdown()
+
+        assert results == [1, ["Agua"], ValueError]
+        assert all(t is threading.main_thread() for t in threads)
+        assert isinstance(root.errors[0], ZeroDivisionError)
+        assert isinstance(failing.exception(), ZeroDivisionError)
+
+def test_call_soon_runs_before_the_jobs_result():
+    root = FakeRoot()
+    db = DBExecutor(root, poll_ms=1)
+    order = []
+    db.submit(lambda: db.call_soon(order.append, "event"), on_done=lambda _: order.append("done"))
+    db.call_soon(order.append, "direct")  # already on the Tk thread: runs now
+    root.pump()
+    db.shutdown()
+    assert order == ["direct", "event", "done"]
+
+if __name__ == "__main__":
+    test_executor_orders_jobs_and_returns_on_tk_thread()
+    test_call_soon_runs_before_the_jobs_result()
+    print("DB worker OK")
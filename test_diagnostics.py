@@ -0,0 +1,48 @@
+import os
+
+import database
+import diagnostics
+from test_db import temp_db
+
+def test_histogram_percentiles():
+    histogram = diagnostics.Histogram()
+    for ms in [0.04] * 50 + [1.0] * 48 + [30.0, 700.0]:
+        histogram.add(ms)
+    assert histogram.percentile(50) == 0.05
+    assert histogram.percentile(98) == 1.6
+    assert histogram.percentile(99) == 51.2
+    assert histogram.percentile(100) == 700.0
+
+def test_database_calls_are_timed():
+    diagnostics.reset()
+    with temp_db():
+        database.add_product("Agua", 3000.0, 10, "bebidas")
+        database.record_sale(1, 1, 3000.0)
+        assert len(database.get_products()) == 1
+        assert len(list(database.iter_sales_history(batch=1))) == 1
+    stats = {row[0]: row for row in diagnostics.snapshot()}
+    assert stats["get_products"][1] == 1 and stats["get_products"][5] == 1
+    assert stats["record_sale"][1] == 1 and stats["record_sales_batch"][1] == 1  # nested calls count too
+    assert stats["iter_sales_history"][5] == 1
+    assert stats["get_sales_history_page"][1] == 2  # the page after the last row is empty
+    assert "get_connection" not in stats
+
+def test_slow_log_lists_statements():
+    slow_ms, trace = diagnostics.SLOW_MS, diagnostics.TRACE_SQL
+    diagnostics.SLOW_MS, diagnostics.TRACE_SQL = 0.0, True
+    try:
+        with temp_db() as db:
+            database.add_product("Agua", 3000.0, 10, "bebidas")
+            assert os.path.dirname(diagnostics.SLOW_LOG) == os.path.dirname(db)
+            with open(diagnostics.SLOW_LOG, encoding="utf-8") as f:
+                text = f.read()
+    finally:
+        diagnostics.SLOW_MS, diagnostics.TRACE_SQL = slow_ms, trace
+    assert "add_product('Agua', 3000.0, 10, 'bebidas')" in text
+    assert "INSERT INTO products" in text
+
+if __name__ == "__main__":
+    test_histogram_percentiles()
+    test_database_calls_are_timed()
+    test_slow_log_lists_statements()
+    print("Diagnostics OK")
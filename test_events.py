@@ -0,0 +1,86 @@
+import database
+import events
+from test_db import temp_db
+
+class Recorder:
+    """Subscribes to every event type and keeps what was published."""
+
+    TYPES = (events.ProductsAdded, events.ProductsChanged, events.StockChanged, events.ProductsDeleted,
+             events.RecipeChanged, events.UsersChanged, events.BalanceChanged, events.UsersDeleted,
+             events.SaleRecorded, events.PaymentRecorded, events.PurchaseRecorded)
+
+    def __init__(self):
+        self.seen = []
+
+    def record(self, event):
+        self.seen.append(event)
+
+    def __enter__(self):
+        for event_type in self.TYPES:
+            events.subscribe(event_type, self.record)
+        return self
+
+    def __exit__(self, *exc):
+        for event_type in self.TYPES:
+            events.unsubscribe(event_type, self.record)
+
+    def take(self):
+        seen, self.seen = self.seen, []
+        return seen
+
+def test_writes_publish_typed_events():
+    with temp_db(), Recorder() as recorder:
+        database.add_product("Leche", 10.0, 1000, "insumos", "INSUMO", "ml")
+        database.add_product("Batido", 9000.0, 0, "bebidas", "COMPUESTO")
+        database.add_user("Ana", "300")
+        assert recorder.take() == [events.ProductsAdded([1]), events.ProductsAdded([2]), events.UsersChanged([1])]
+
+        database.update_product(2, "Batido", 9500.0, 0, "bebidas", "COMPUESTO")
+        assert recorder.take() == [events.ProductsChanged([2])]
+
+        database.set_recipe(2, [(1, 250)])
+        assert recorder.take() == [events.RecipeChanged(2)]  # one per replacement
+
+        database.record_sale(2, 2, 18000.0, 1)
+        assert recorder.take() == [events.StockChanged([1]), events.SaleRecorded(1, [(2, 2, 18000.0)]),
+                                   events.BalanceChanged([1])]
+
+        database.record_payment(1, 5000.0, "Nequi")
+        database.record_purchase(1, 500, 20000.0)
+        assert recorder.take() == [events.PaymentRecorded(1, 5000.0, "Nequi"), events.BalanceChanged([1]),
+                                   events.StockChanged([1]), events.PurchaseRecorded(1, 500, 20000.0)]
+
+def test_events_wait_for_commit():
+    with temp_db(), Recorder() as recorder:
+        database.add_user("Ana", "300")
+        recorder.take()
+
+        with database.transaction():
+            database.record_payment(1, 1000.0, "Efectivo")
+            assert recorder.seen == []  # not committed yet
+        assert len(recorder.take()) == 2
+
+        try:
+            with database.transaction():
+                database.record_payment(1, 1000.0, "Efectivo")
+                raise RuntimeError("abort")
+        except RuntimeError:
+            pass
+        assert recorder.take() == []  # rolled back: nothing happened
+
+def test_failing_subscriber_does_not_fail_the_write():
+    def broken(event):
+        raise ValueError("subscriber bug")
+    with temp_db():
+        events.subscribe(events.UsersChanged, broken)
+        try:
+            assert database.add_user("Ana", "300") == 1
+        finally:
+            events.unsubscribe(events.UsersChanged, broken)
+        assert len(database.get_users()) == 1
+
+if __name__ == "__main__":
+    test_writes_publish_typed_events()
+    test_events_wait_for_commit()
+    test_failing_subscriber_does_not_fail_the_write()
+    print("Events OK")
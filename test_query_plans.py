@@ -0,0 +1,136 @@
+import inspect
+import re
+
+import database
+from test_db import temp_db
+
+# Infrastructure helpers that don't run queries of their own
+NOT_QUERIES = {"connect_db", "get_connection", "close_connections", "configure", "transaction", "init_db",
+               "history_key", "sales_history_key", "cache_stats", "archive_path"}
+
+# Functions whose job is to read a whole table; everything else must hit an index
+ALLOWED_FULL_SCANS = {
+    "get_products": "lists the whole catalog",
+    "get_users": "lists every user",
+    "get_sale_items": "lists the sellable catalog",
+    "get_product_search_fields": "loads the in-memory search index",
+    "get_user_search_fields": "loads the in-memory search index",
+    "get_financial_summary": "lists the per-user totals",
+    "get_change_counters": "reads the handful of change counters",
+    "get_cost_inputs": "loads the cost roll-up inputs",
+    "get_recipe_edges": "loads the cost roll-up inputs",
+    "rebuild_aggregates": "recomputes totals from the full ledgers",
+    "archive_year": "copies and counts a whole year of ledgers",
+    "get_stock_drift": "checks every product against its journal",
+    "reconcile_stock": "checks every product against its journal",
+    "take_stock_snapshot": "consolidates the journal for every product",
+}
+
+FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+CTE_NAME = re.compile(r"(\w+)\s*(?:\([^)]*\))?\s+AS\s*\(", re.I)
+
+def seed():
+    database.add_product("Insumo", 1.0, 100, "insumos", "INSUMO", "ml")
+    database.add_product("Batido", 10.0, 0, "bebidas", "COMPUESTO")
+    database.add_recipe_item(2, 1, 3)
+    database.add_user("Cliente", "300")
+
+def deduct():
+    with database.transaction() as cursor:
+        database.deduct_recipe_recursive(cursor, 2, 1)
+
+# Calls every public query function once; extend when database.py grows
+EXERCISE = [
+    ("add_product", lambda: database.add_product("Agua", 2.0, 10, "bebidas")),
+    ("get_products", database.get_products),
+    ("get_sale_items", database.get_sale_items),
+    ("update_product", lambda: database.update_product(3, "Agua", 2.5, 10, "bebidas")),
+    ("add_user", lambda: database.add_user("Otro", "")),
+    ("get_users", database.get_users),
+    ("update_user_balance", lambda: database.update_user_balance(1, 5)),
+    ("record_payment", lambda: database.record_payment(1, 5, "Nequi")),
+    ("add_recipe_item", lambda: database.add_recipe_item(2, 3, 1)),
+    ("get_recipe", lambda: database.get_recipe(2)),
+    ("set_recipe", lambda: database.set_recipe(2, [(1, 3), (3, 1)])),
+    ("get_flattened_recipe", lambda: database.get_flattened_recipe(2)),
+    ("deduct_recipe_recursive", deduct),
+    ("check_stock", lambda: database.check_stock([(2, 1, 10.0), (3, 1, 2.0)])),
+    ("record_sale", lambda: database.record_sale(2, 1, 10.0, 1)),
+    ("record_sales_batch", lambda: database.record_sales_batch([(2, 1, 10.0), (3, 2, 5.0)], 1, "Nequi")),
+    ("record_purchase", lambda: database.record_purchase(1, 10, 20.0)),
+    ("update_ingredient_unit_cost", lambda: database.update_ingredient_unit_cost(1, 20.0, 10)),
+    ("get_user_purchases", lambda: database.get_user_purchases(1)),
+    ("get_user_financial_history", lambda: database.get_user_financial_history(1)),
+    ("get_user_financial_totals", lambda: database.get_user_financial_totals(1)),
+    ("get_sales_history", database.get_sales_history),
+    ("get_combined_history", database.get_combined_history),
+    ("get_sales_history_page", lambda: database.get_sales_history_page(None, 50, "2026-01-01", "2026-02-01", 1)),
+    ("iter_sales_history", lambda: list(database.iter_sales_history(since="2026-01-01"))),
+    ("iter_combined_history", lambda: list(database.iter_combined_history(until="2099-01-01", kind="VENTA"))),
+    ("get_change_counter", lambda: database.get_change_counter("product_names")),
+    ("get_change_counters", database.get_change_counters),
+    ("get_cost_inputs", database.get_cost_inputs),
+    ("get_recipe_edges", database.get_recipe_edges),
+    ("get_product_search_fields", database.get_product_search_fields),
+    ("get_user_search_fields", database.get_user_search_fields),
+    ("get_products_by_ids", lambda: database.get_products_by_ids([2, 1])),
+    ("get_users_by_ids", lambda: database.get_users_by_ids([1])),
+    ("get_products_page", lambda: database.get_products_page(1, 50, "agua")),
+    ("get_users_page", lambda: database.get_users_page(None, 50)),
+    ("get_combined_history_page", lambda: database.get_combined_history_page(("2026-01-01", 5, "VENTA"), 50)),
+    ("get_combined_history_page", lambda: database.get_combined_history_page(None, 50, "2026-01-01", None, None, 1)),
+    ("get_user_financial_history_page", lambda: database.get_user_financial_history_page(1, None, 50)),
+    ("get_schema_version", database.get_schema_version),
+    ("get_daily_totals", lambda: database.get_daily_totals("2026-01-01")),
+    ("get_financial_summary", database.get_financial_summary),
+    ("rebuild_aggregates", database.rebuild_aggregates),
+    ("take_stock_snapshot", database.take_stock_snapshot),
+    ("get_stock_at", lambda: database.get_stock_at(1, "2099-01-01")),
+    ("get_stock_movements", lambda: database.get_stock_movements(1)),
+    ("get_stock_drift", database.get_stock_drift),
+    ("reconcile_stock", database.reconcile_stock),
+    ("archive_year", lambda: database.archive_year(2020, vacuum=False)),
+    ("get_archives", database.get_archives),
+    ("get_oldest_ledger_year", database.get_oldest_ledger_year),
+    ("get_combined_history_page", lambda: database.get_combined_history_page(None, 50, "2020-06-01", "2021-01-01")),
+    ("get_user_purchases", lambda: database.get_user_purchases(1)),
+    ("delete_recipe", lambda: database.delete_recipe(2)),
+    ("delete_user", lambda: database.delete_user(2)),
+    ("delete_product", lambda: database.delete_product(3)),
+]
+
+def public_query_functions():
+    return {name for name, fn in inspect.getmembers(database, inspect.isfunction)
+            if fn.__module__ == "database" and not name.startswith("_") and name not in NOT_QUERIES}
+
+def test_every_query_function_is_exercised():
+    missing = public_query_functions() - {name for name, _ in EXERCISE}
+    assert not missing, f"Add these to EXERCISE in test_query_plans.py: {sorted(missing)}"
+
+def test_no_full_table_scans():
+    with temp_db():
+        seed()
+        conn = database.get_connection()
+        offenders = []
+        for name, call in EXERCISE:
+            statements = []
+            conn.set_trace_callback(statements.append)
+            try:
+                call()
+            finally:
+                conn.set_trace_callback(None)
+
+            for sql in statements:
+                if not re.match(r"\s*(SELECT|UPDATE|DELETE|WITH)\b", sql, re.I):
+                    continue
+                plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+                ctes = set(CTE_NAME.findall(sql))
+                scans = [step for step in plan if FULL_SCAN.match(step) and FULL_SCAN.match(step).group(1) not in ctes]
+                if scans and name not in ALLOWED_FULL_SCANS:
+                    offenders.append((name, " ".join(sql.split())[:80], scans))
+        assert not offenders, "Full table scans:\n" + "\n".join(map(str, offenders))
+
+if __name__ == "__main__":
+    test_every_query_function_is_exercised()
+    test_no_full_table_scans()
+    print("Query plans OK")
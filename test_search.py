@@ -0,0 +1,57 @@
+import database
+from search import Catalog, normalize, product_catalog
+from test_db import temp_db
+
+def test_normalize():
+    assert normalize("Proteína ÁCIDA") == "proteina acida"
+    assert normalize(None) == ""
+
+def test_catalog_ranking():
+    rows = [(1, "Batido de Proteína", "bebidas"), (2, "Proteína Whey", "suplementos"),
+            (3, "Agua", "bebidas"), (4, "Barra proteica", "snacks")]
+    catalog = Catalog(lambda: rows, lambda: 1)
+    assert catalog.search("proteina") == [2, 1]
+    assert catalog.search("PROT") == [2, 4, 1]
+    assert catalog.search("beb") == [3, 1]
+    assert catalog.search("prot whe") == [2]
+    assert catalog.search("xyz") == []
+    assert catalog.search("") == [3, 4, 1, 2]
+    assert catalog.page("prot", after=2, limit=1) == [4]
+
+def test_catalog_pages_every_match():
+    rows = [(i, f"Barra {i:05d}", "snacks") for i in range(1, 2501)] + [(9000, "Agua", "bebidas")]
+    catalog = Catalog(lambda: rows, lambda: 1)
+    seen, after = [], None
+    while True:
+        page = catalog.page("barra", after, 200)
+        if not page:
+            break
+        seen += page
+        after = page[-1]
+    assert seen == list(range(1, 2501))  # no cap on how far the pages go
+    assert catalog.page("barra", 2500, 200) == []
+    assert catalog.page("agua") == [9000]
+
+def test_catalog_follows_writes():
+    with temp_db():
+        database.add_product("Agua", 4000.0, 10, "bebidas")
+        catalog = product_catalog()
+        assert catalog.search("agua") == [1]
+
+        database.add_product("Agua con gas", 4500.0, 10, "bebidas")
+        database.update_product(1, "Agua natural", 4000.0, 10, "bebidas")
+        assert catalog.search("agua") == [2, 1]
+        database.delete_product(2)
+        assert catalog.search("gas") == []
+
+        # Stock-only changes don't force a resync
+        version = catalog.synced_version
+        database.record_sale(1, 1, 4000.0)
+        assert database.get_change_counter("product_names") == version
+        print("Search OK")
+
+if __name__ == "__main__":
+    test_normalize()
+    test_catalog_ranking()
+    test_catalog_pages_every_match()
+    test_catalog_follows_writes()
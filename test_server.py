@@ -0,0 +1,97 @@
+import asyncio
+import http.client
+import json
+import threading
+from urllib.parse import quote
+
+import database
+import server
+from server import ApiServer
+from test_db import temp_db
+
+class RunningServer:
+    """ApiServer on a free port, its event loop in a background thread."""
+
+    def __enter__(self):
+        self.loop = asyncio.new_event_loop()
+        self.api = ApiServer(port=0, readers=2)
+        started = threading.Event()
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.api.start())
+            started.set()
+            self.loop.run_forever()
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait(5)
+        self.conn = http.client.HTTPConnection("127.0.0.1", self.api.port, timeout=5)
+        return self
+
+    def request(self, method, path, body=None, headers=None):
+        self.conn.request(method, path, json.dumps(body) if body is not None else None, headers or {})
+        response = self.conn.getresponse()
+        data = response.read()
+        return response.status, json.loads(data) if data else None, response.getheader("ETag")
+
+    def __exit__(self, *exc):
+        self.conn.close()
+        asyncio.run_coroutine_threadsafe(self.api.close(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+
+def test_crud_sales_and_etags():
+    with temp_db(), RunningServer() as api:
+        status, created, _ = api.request("POST", "/api/products", {"name": "Agua", "price": 3000, "stock": 5, "category": "bebidas"})
+        assert (status, created) == (201, {"id": 1})
+        assert api.request("POST", "/api/users", {"name": "Ana", "phone": "300"})[1] == {"id": 1}
+
+        status, products, etag = api.request("GET", "/api/products")
+        assert status == 200 and products[0]["name"] == "Agua" and products[0]["type"] == "PRODUCTO"
+        assert api.request("GET", "/api/products", headers={"If-None-Match": etag})[0] == 304
+
+        status, error, _ = api.request("POST", "/api/sales", {"lines": [{"product_id": 1, "quantity": 6, "total_price": 18000}]})
+        assert status == 409 and error["shortages"] == [{"product_id": 1, "name": "Agua", "needed": 6, "available": 5}]
+
+        for quantity in (0, -3):
+            negative = {"lines": [{"product_id": 1, "quantity": quantity, "total_price": -9000}]}
+            assert api.request("POST", "/api/sales", negative)[0] == 400
+
+        sale = {"lines": [{"product_id": 1, "quantity": 2, "total_price": 6000}], "user_id": 1, "method": "Cartera"}
+        assert api.request("POST", "/api/sales", sale)[0] == 201
+        status, products, new_etag = api.request("GET", "/api/products", headers={"If-None-Match": etag})
+        assert status == 200 and products[0]["stock"] == 3 and new_etag != etag
+        assert api.request("GET", "/api/users/1")[1]["balance"] == -6000
+        assert [m["reason"] for m in api.request("GET", "/api/products/1/movements")[1]] == ["VENTA", "ALTA"]
+        assert api.request("GET", "/api/products/1/stock?at=2099-01-01")[1] == {"at": "2099-01-01", "stock": 3}
+        assert api.request("GET", "/api/products/1/stock")[0] == 400
+
+        history = api.request("GET", "/api/history?limit=1")[1]
+        assert [row["type"] for row in history["rows"]] == ["VENTA"]
+        assert api.request("GET", "/api/history?limit=1&before=" + quote(history["next"]))[1]["rows"] == []
+
+        status, error, _ = api.request("PUT", "/api/products/1", {"name": "Agua", "price": 3500})
+        assert status == 400 and "stock" in error["error"]
+        assert api.request("PUT", "/api/products/1", {"name": "Agua", "price": 3500, "stock": 3})[0] == 204
+        assert [m["reason"] for m in api.request("GET", "/api/products/1/movements")[1]] == ["VENTA", "ALTA"]
+
+        assert api.request("GET", "/api/products/9")[0] == 404
+        assert api.request("PATCH", "/api/products/1")[0] == 405
+        assert api.request("POST", "/api/payments", {"user_id": 1})[0] == 400
+        assert api.request("GET", "/api/history?kind=OTRO")[0] == 400
+
+def test_reads_are_read_only():
+    with temp_db(), RunningServer() as api:
+        def read_then_check():
+            server._run_read(server.summary, {}, {}, None, None, None)
+            return database.get_connection().execute("PRAGMA query_only").fetchone()[0]
+        assert api.request("GET", "/api/summary")[0] == 200
+        assert [api.api.readers.submit(read_then_check).result() for _ in range(4)] == [1] * 4
+
+        # Still so once close_connections() has given the readers new pooled connections
+        database.close_connections()
+        assert [api.api.readers.submit(read_then_check).result() for _ in range(4)] == [1] * 4
+
+if __name__ == "__main__":
+    test_crud_sales_and_etags()
+    test_reads_are_read_only()
+    print("Server OK")
@@ -0,0 +1,181 @@
+from collections import namedtuple
+
+from widgets import PickList, ViewManager, VirtualTable
+
+class FakeFrame:
+    def __init__(self, parent):
+        self.visible = False
+
+    def pack(self, **kwargs):
+        self.visible = True
+
+    def pack_forget(self):
+        self.visible = False
+
+    def tkraise(self):
+        pass
+
+def test_view_manager_builds_once_and_refreshes_on_change():
+    counters = {"products": 1, "users": 1}
+    calls = []
+    views = ViewManager(None, FakeFrame, lambda: dict(counters))
+    views.register("inventory", lambda frame: calls.append("build inventory"),
+                   lambda: calls.append("refresh inventory"), ["products"])
+    views.register("users", lambda frame: calls.append("build users"),
+                   lambda: calls.append("refresh users"), ["users"])
+
+    views.show("inventory")
+    views.show("users")
+    assert not views.views["inventory"]["frame"].visible
+    assert views.views["users"]["frame"].visible
+
+    views.show("inventory")           # nothing changed: no rebuild, no refresh
+    counters["users"] += 1
+    views.show("inventory")           # unrelated counter
+    counters["products"] += 1
+    views.show("users")
+    views.show("inventory")
+    views.show("inventory")
+    assert calls == ["build inventory", "build users", "refresh users", "refresh inventory"]
+
+class FakeTree:
+    """The slice of ttk.Treeview that VirtualTable uses, with a 10-row viewport."""
+
+    def __init__(self):
+        self.rows, self.items, self.top, self.idle, self.selected = [], {}, 0, [], ()
+
+    def configure(self, yscrollcommand=None):
+        self.on_scroll = yscrollcommand
+
+    def winfo_exists(self):
+        return True
+
+    def after_idle(self, fn):
+        self.idle.append(fn)
+
+    def insert(self, parent, index, iid, values):
+        self.rows.insert(len(self.rows) if index == "end" else index, iid)
+        self.items[iid] = values
+
+    def delete(self, *iids):
+        for iid in iids:
+            self.rows.remove(iid)
+            del self.items[iid]
+
+    def item(self, iid, values):
+        self.items[iid] = values
+
+    def move(self, iid, parent, index):
+        self.rows.remove(iid)
+        self.rows.insert(index, iid)
+
+    def exists(self, iid):
+        return iid in self.items
+
+    def get_children(self):
+        return tuple(self.rows)
+
+    def selection(self):
+        return self.selected
+
+    def yview(self):
+        n = len(self.rows) or 1
+        return self.top / n, min(self.top + 10, n) / n
+
+    def yview_moveto(self, fraction):
+        self.top = round(fraction * len(self.rows))
+
+    def scroll_to(self, index):
+        """Scrolls like the user would and runs what that scheduled."""
+        self.top = max(0, min(index, len(self.rows) - 10))
+        self.on_scroll(*self.yview())
+        while self.idle:
+            self.idle.pop(0)()
+
+def make_table(data, **kwargs):
+    reads = []
+    def fetch(after, limit, query=""):
+        reads.append(after)
+        rows = [row for row in data if row[0] > (after or 0) and query in row[1]]
+        return rows[:limit]
+    tree = FakeTree()
+    return tree, VirtualTable(tree, fetch, page_size=10, max_pages=3, **kwargs), reads
+
+def test_virtual_table_pages_through_a_bounded_window():
+    data = [(i, f"fila {i}") for i in range(1, 96)]
+    tree, table, reads = make_table(data)
+    assert tree.rows == [str(i) for i in range(1, 11)] and not table.exhausted
+
+    for _ in range(10):
+        tree.scroll_to(len(tree.rows))  # to the bottom
+    assert table.exhausted and tree.rows[-1] == "95"
+    assert len(tree.rows) <= 30 and len(table.values) == len(tree.rows)  # evicted rows are gone
+    assert table.first_page == 7 and tree.rows[0] == "71"
+
+    for _ in range(10):
+        tree.scroll_to(0)  # back to the top: earlier pages are read again, from their remembered keys
+    assert table.first_page == 0 and tree.rows[:10] == [str(i) for i in range(1, 11)]
+    assert len(tree.rows) <= 30 and not table.exhausted
+    assert all(after in (None, *range(10, 96, 10)) for after in reads)
+
+def test_virtual_table_reload_patches_the_window():
+    data = [(i, f"fila {i}") for i in range(1, 96)]
+    tree, table, reads = make_table(data)
+    for _ in range(5):
+        tree.scroll_to(len(tree.rows))
+    first, window = table.first_page, list(tree.rows)
+    assert first > 0
+
+    # Reload re-reads only the window: an edit, a deletion and a new row inside it
+    data[int(window[0]) - 1] = (int(window[0]), "editada")
+    data.remove((int(window[1]), f"fila {window[1]}"))
+    reads.clear()
+    table.reload()
+    assert len(reads) == len(table.pages) and reads[0] == table.page_keys[first]
+    assert tree.items[window[0]] == (int(window[0]), "editada")
+    assert window[1] not in tree.rows and tree.rows == sorted(tree.rows, key=int)
+    assert len(tree.rows) == len(window)  # the row after the window moved up into it
+
+    # A new search starts over at the first page
+    table.args = ("fila 9",)
+    table.reload()
+    assert table.first_page == 0 and tree.rows == ["9"] + [str(i) for i in range(90, 96)]
+    assert table.exhausted
+
+def test_virtual_table_end_of_data():
+    tree, table, reads = make_table([(i, f"fila {i}") for i in range(1, 21)])
+    tree.scroll_to(len(tree.rows))
+    tree.scroll_to(len(tree.rows))
+    assert tree.rows == [str(i) for i in range(1, 21)] and table.exhausted
+    calls = len(reads)
+    tree.scroll_to(len(tree.rows))  # nothing left: no more reads
+    assert len(reads) == calls
+
+    tree, table, reads = make_table([])
+    assert tree.rows == [] and table.exhausted
+    tree.scroll_to(0)
+    assert reads == [None]
+
+def test_pick_list_returns_the_selected_row():
+    Product = namedtuple("Product", "id name price unit")
+    products = [Product(1, "Leche", 2.5, "ml"), Product(7, "Whey", 50.0, "gr")]
+    tree = FakeTree()
+    picks = PickList(tree, key=lambda p: p.id, format_row=lambda p: (p.id, p.name, f"${p.price:.2f}"))
+    picks.fill(products)
+    assert tree.rows == ["1", "7"] and tree.items["7"] == (7, "Whey", "$50.00")
+    assert picks.selected() is None
+
+    tree.selected = ("7",)
+    picked = picks.selected()
+    assert picked is products[1] and (picked.name, picked.id, picked.unit) == ("Whey", 7, "gr")
+
+    picks.fill(products[:1])  # refilling replaces the rows
+    assert tree.rows == ["1"] and picks.selected() is None
+
+if __name__ == "__main__":
+    test_view_manager_builds_once_and_refreshes_on_change()
+    test_virtual_table_pages_through_a_bounded_window()
+    test_virtual_table_reload_patches_the_window()
+    test_virtual_table_end_of_data()
+    test_pick_list_returns_the_selected_row()
+    print("Widgets OK")
@@ -0,0 +1,317 @@
+# Reusable widgets for Militar Box Afterwod
+
+LOADING_IID = "__loading__"
+
+class VirtualTable:
+    """Feeds a Treeview (see AfterwordApp.create_styled_tree) page by page from the database.
+
+    Only a window of at most `max_pages` pages lives in the tree. Scrolling
+    near the bottom appends the next page (keyset pagination) and evicts the
+    first one; scrolling near the top of a window that starts past the first
+    page fetches the page before it again and evicts the last one. Each page
+    is re-read from the key it starts after (one remembered key per page), so
+    fetch_page only ever reads forward. reload() re-reads the window and
+    patches the rows in place (update / insert / delete by key) instead of
+    clearing and re-inserting the whole tree.
+
+    fetch_page(after_key, limit, *args) must return up to `limit` rows that come
+    after `after_key` (None for the first page); key(row) gives a row's position.
+    `args` (e.g. the search text) is read on the Tk thread and can be changed
+    before calling reload(), which then starts over at the first page. With
+    an `executor` (db_worker.DBExecutor) pages are fetched on the worker
+    thread and a loading row is shown meanwhile.
+    """
+
+    def __init__(self, tree, fetch_page, key=lambda row: row[0], format_row=tuple,
+                 page_size=100, prefetch=0.85, executor=None, args=(), max_pages=5):
+        self.tree = tree
+        self.fetch_page = fetch_page
+        self.key = key
+        self.format_row = format_row
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.executor = executor
+        self.args = tuple(args)
+        self.max_pages = max(2, max_pages)
+
+        self.page_keys = [None]  # page_keys[i]: the key page i starts after (known up to the page after the window)
+        self.first_page = 0      # index of the window's first page
+        self.pages = []          # iids of each page in the window, in display order
+        self.values = {}         # iid -> values currently shown
+        self.exhausted = False   # the window's last page is the end of the data
+        self._loaded_args = None
+        self._scheduled = False
+        self._busy = False
+        self._generation = 0
+
+        scrollbar = getattr(tree, "vsb", None)
+
+        def on_scroll(first, last):
+            if scrollbar is not None:
+                scrollbar.set(first, last)
+            if self._scheduled:
+                return
+            if float(last) >= self.prefetch and not self.exhausted:
+                self._scheduled = True
+                self.tree.after_idle(self.load_more)
+            elif float(first) <= 1 - self.prefetch and self.first_page > 0:
+                self._scheduled = True
+                self.tree.after_idle(self.load_previous)
+
+        tree.configure(yscrollcommand=on_scroll)
+        self.reload()
+
+    @property
+    def order(self):
+        """iids in the window, in display order."""
+        return [iid for page in self.pages for iid in page]
+
+    def _iid(self, row):
+        return str(self.key(row))
+
+    def _run(self, fn, args, on_done):
+        if self.executor is None:
+            on_done(fn(*args))
+        else:
+            self.executor.submit(fn, *args, on_done=on_done)
+
+    def _fetch(self, index, on_rows):
+        self._busy = True
+        generation = self._generation
+
+        def done(rows):
+            self._busy = False
+            if generation == self._generation and self.tree.winfo_exists():
+                on_rows(rows)
+        self._run(self.fetch_page, (self.page_keys[index], self.page_size, *self.args), done)
+
+    def _set_page_key(self, index, rows):
+        # The page after a full one starts after its last row; keys past it may be stale now
+        del self.page_keys[index + 1:]
+        if len(rows) == self.page_size:
+            self.page_keys.append(self.key(rows[-1]))
+
+    def load_more(self):
+        """Appends the page after the window, evicting the first page if the window is full."""
+        self._scheduled = False
+        index = self.first_page + len(self.pages)
+        if self.exhausted or self._busy or index >= len(self.page_keys) or not self.tree.winfo_exists():
+            return
+        self._fetch(index, lambda rows: self._append(index, rows))
+
+    def _append(self, index, rows):
+        if index != self.first_page + len(self.pages):
+            return
+        anchor = self._first_visible()
+        self._set_page_key(index, rows)
+        self.exhausted = len(rows) < self.page_size
+        page = [self._put(row) for row in rows if self._iid(row) not in self.values]
+        if page:
+            self.pages.append(page)
+        if len(self.pages) > self.max_pages:
+            self._drop(self.pages.pop(0))
+            self.first_page += 1
+        self._show(anchor)
+
+    def load_previous(self):
+        """Re-reads the page before the window, evicting the last page if the window is full."""
+        self._scheduled = False
+        if self.first_page == 0 or self._busy or not self.tree.winfo_exists():
+            return
+        index = self.first_page - 1
+        self._fetch(index, lambda rows: self._prepend(index, rows))
+
+    def _prepend(self, index, rows):
+        if index != self.first_page - 1:
+            return
+        anchor = self._first_visible()
+        page = []
+        for row in rows:
+            if self._iid(row) in self.values:
+                break  # rows were deleted before the window: the page now runs into it
+            page.append(self._put(row, len(page)))
+        self.pages.insert(0, page)
+        self.first_page = index
+        if len(self.pages) > self.max_pages:
+            self._drop(self.pages.pop())
+            del self.page_keys[self.first_page + len(self.pages) + 1:]
+            self.exhausted = False
+        self._show(anchor)
+
+    def _first_visible(self):
+        order = self.order
+        if not order:
+            return None
+        return order[min(int(float(self.tree.yview()[0]) * len(order)), len(order) - 1)]
+
+    def _show(self, anchor):
+        # Rows added or evicted above keep the row that was at the top where the user left it
+        order = self.order
+        if anchor in self.values and order:
+            self.tree.yview_moveto(order.index(anchor) / len(order))
+
+    def _drop(self, iids):
+        if iids:
+            self.tree.delete(*iids)
+        for iid in iids:
+            del self.values[iid]
+
+    def reload(self):
+        """Re-reads the pages of the window (one page after a change of args) and patches the tree."""
+        if not self.tree.winfo_exists():
+            return
+        restart = self.args != self._loaded_args
+        if restart:
+            self.first_page, self.page_keys = 0, [None]
+        self._generation += 1
+        generation = self._generation
+        self._busy = True
+        if self.executor is not None and not self.values and not self.tree.exists(LOADING_IID):
+            self.tree.insert("", "end", iid=LOADING_IID, values=("", "Cargando..."))
+        count = 1 if restart else max(len(self.pages), 1)
+        args = self.args
+        self._run(self._fetch_pages, (self.page_keys[self.first_page], count, args),
+                  lambda pages: self._apply(pages, args, generation))
+
+    def _fetch_pages(self, after, count, args):
+        pages = []
+        while len(pages) < count:
+            rows = self.fetch_page(after, self.page_size, *args)
+            pages.append(rows)
+            if len(rows) < self.page_size:
+                break
+            after = self.key(rows[-1])
+        return pages
+
+    def _apply(self, pages, args, generation):
+        if generation != self._generation or not self.tree.winfo_exists():
+            return
+        self._busy = False
+        if self.tree.exists(LOADING_IID):
+            self.tree.delete(LOADING_IID)
+        if not any(pages) and self.first_page > 0:
+            # Everything from the window on is gone: start over from the top
+            self.first_page, self._loaded_args = 0, None
+            return self.reload()
+
+        keep = {self._iid(row) for rows in pages for row in rows}
+        self._drop([iid for iid in self.order if iid not in keep])
+        self.pages = []
+        for offset, rows in enumerate(pages):
+            self._set_page_key(self.first_page + offset, rows)
+            if rows:
+                self.pages.append([self._put(row) for row in rows])
+        # Rows new to the tree were appended at the end; restore the display order if needed
+        order = self.order
+        if list(self.tree.get_children()) != order:
+            for index, iid in enumerate(order):
+                self.tree.move(iid, "", index)
+
+        self.exhausted = len(pages[-1]) < self.page_size
+        self._loaded_args = args
+
+    def _put(self, row, index="end"):
+        iid, values = self._iid(row), tuple(self.format_row(row))
+        if iid in self.values:
+            if self.values[iid] != values:
+                self.tree.item(iid, values=values)
+        else:
+            self.tree.insert("", index, iid=iid, values=values)
+        self.values[iid] = values
+        return iid
+
+    def update_row(self, row):
+        """Refreshes one row if it is loaded; returns whether it was."""
+        iid, values = self._iid(row), tuple(self.format_row(row))
+        if iid not in self.values:
+            return False
+        if self.values[iid] != values:
+            self.tree.item(iid, values=values)
+            self.values[iid] = values
+        return True
+
+    def remove_row(self, key):
+        iid = str(key)
+        if iid in self.values:
+            self._drop([iid])
+            for page in self.pages:
+                if iid in page:
+                    page.remove(iid)
+
+class PickList:
+    """Lists rows in a Treeview and hands back the selected row itself.
+
+    The Treeview only keeps formatted strings (prices as "$3000.00", numbers
+    as text), so the rows are kept by iid and selected() returns the
+    original object, e.g. a database.Product.
+    """
+
+    def __init__(self, tree, key=lambda row: row[0], format_row=tuple):
+        self.tree = tree
+        self.key = key
+        self.format_row = format_row
+        self.rows = {}
+
+    def fill(self, rows):
+        self.tree.delete(*self.tree.get_children())
+        self.rows = {}
+        for row in rows:
+            iid = str(self.key(row))
+            self.tree.insert("", "end", iid=iid, values=tuple(self.format_row(row)))
+            self.rows[iid] = row
+
+    def selected(self):
+        """The selected row, or None."""
+        selection = self.tree.selection()
+        return self.rows.get(selection[0]) if selection else None
+
+class ViewManager:
+    """Builds each screen once and switches between them without destroying them.
+
+    register(name, build, refresh, counters): build(frame) creates the screen's
+    widgets in a frame made by make_frame(container) and loads its data;
+    refresh() reloads that data. show(name) hides the current screen
+    (pack_forget) and shows the other one, calling refresh() only if one of
+    the screen's change counters (database.get_change_counters) moved since
+    its data was last loaded.
+    """
+
+    def __init__(self, container, make_frame, read_counters, executor=None):
+        self.container = container
+        self.make_frame = make_frame
+        self.read_counters = read_counters
+        self.executor = executor
+        self.views = {}
+        self.current = None
+
+    def register(self, name, build, refresh=None, counters=()):
+        self.views[name] = {"build": build, "refresh": refresh, "counters": tuple(counters),
+                            "frame": None, "seen": None}
+
+    def show(self, name):
+        view = self.views[name]
+        # Read the counters before any (re)load is queued, so `seen` is never newer than the data
+        self._run(self.read_counters, lambda counters: self._check(name, counters))
+        if view["frame"] is None:
+            view["frame"] = self.make_frame(self.container)
+            view["build"](view["frame"])
+        if self.current is not None and self.current != name:
+            self.views[self.current]["frame"].pack_forget()
+        view["frame"].pack(fill="both", expand=True)
+        view["frame"].tkraise()
+        self.current = name
+
+    def _run(self, fn, on_done):
+        if self.executor is None:
+            on_done(fn())
+        else:
+            self.executor.submit(fn, on_done=on_done)
+
+    def _check(self, name, counters):
+        view = self.views[name]
+        seen = tuple(counters.get(counter, 0) for counter in view["counters"])
+        first = view["seen"] is None
+        if seen != view["seen"]:
+            view["seen"] = seen
+            if not first and view["refresh"]:
+                view["refresh"]()